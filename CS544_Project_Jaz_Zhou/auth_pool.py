@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+DEFAULT_MAX_WORKERS = 4    # Concurrent bcrypt hashes
+DEFAULT_MAX_PENDING = 64   # Logins allowed to wait for a worker before rejecting
+
+AUTH_SECONDS = metrics.histogram("chat_auth_seconds", "Password checks, including the wait for a worker")
+AUTH_REJECTED = metrics.counter("chat_auth_rejected_total", "Password checks refused because the queue was full")
+
+
+class AuthPoolBusy(Exception):
+    pass
+
+
+class AuthWorkerPool:
+    """
+    Bounded thread pool for password hashing. bcrypt releases the GIL, so the
+    hashes run in parallel while the event loop keeps serving other users.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, max_pending=DEFAULT_MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.executor = None
+        self.pending = 0  # Submitted and not finished, only touched on the event loop
+        self.running = 0
+        self.rejected = 0
+        self.hash_count = 0
+        self.hash_time_total = 0.0
+        self.hash_time_max = 0.0
+        self.lock = threading.Lock()
+
+    def configure(self, max_workers=None, max_pending=None):
+        if max_workers is not None:
+            self.max_workers = max_workers
+        if max_pending is not None:
+            self.max_pending = max_pending
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def _get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                               thread_name_prefix="auth")
+        return self.executor
+
+    def _timed(self, func, args):
+        with self.lock:
+            self.running += 1
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.running -= 1
+                self.hash_count += 1
+                self.hash_time_total += elapsed
+                self.hash_time_max = max(self.hash_time_max, elapsed)
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_workers + self.max_pending:
+            self.rejected += 1
+            AUTH_REJECTED.inc()
+            raise AuthPoolBusy("Authentication queue is full")
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), self._timed, func, args)
+        finally:
+            self.pending -= 1
+            AUTH_SECONDS.observe(time.perf_counter() - started)
+
+    def queue_depth(self):
+        with self.lock:
+            return max(self.pending - self.running, 0)
+
+    def stats(self):
+        with self.lock:
+            average = self.hash_time_total / self.hash_count if self.hash_count else 0.0
+            return {
+                "max_workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "in_flight": self.pending,
+                "running": self.running,
+                "queue_depth": max(self.pending - self.running, 0),
+                "rejected": self.rejected,
+                "hashes": self.hash_count,
+                "hash_ms_avg": average * 1000,
+                "hash_ms_max": self.hash_time_max * 1000,
+            }
+
+
+auth_pool = AuthWorkerPool()
@@ -0,0 +1,247 @@
+import asyncio
+import json
+import struct
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Optional
+
+from log import log
+
+# TCP frames: target node (or one of the values below) and body length, then a JSON body
+FRAME_HEADER = struct.Struct("!iI")
+TARGET_ALL = -1    # Every node except the sender
+TARGET_HELLO = -2  # First frame from a node, carries its node ID
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECONNECT_DELAY = 0.1      # Seconds before the first attempt to reach the broker again
+MAX_RECONNECT_DELAY = 5.0  # Upper bound of the doubling delay between attempts
+
+
+class Backplane(ABC):
+    """
+    Pub/sub transport between chat server nodes. Messages are JSON-serializable
+    dicts dispatched to the handler registered for their "op"; send() reaches one
+    node and publish() every other node. A transport that loses touch with the
+    other nodes tells its own node with a local "disconnected" message, and
+    with "reconnected" once it is back.
+    """
+
+    def __init__(self, node_id: int):
+        self.node_id = node_id
+        self.handlers: Dict[str, Callable[[Dict], None]] = {}
+        self.messages_sent = 0
+        self.messages_received = 0
+
+    async def start(self):
+        pass
+
+    def register(self, op, handler):
+        self.handlers[op] = handler
+
+    @abstractmethod
+    def send(self, node, message: Dict):
+        pass
+
+    @abstractmethod
+    def publish(self, message: Dict):
+        pass
+
+    def notify(self, op):
+        # A message from this transport to its own node, not counted as received
+        handler = self.handlers.get(op)
+        if handler is not None:
+            handler({"op": op, "node": self.node_id})
+
+    def dispatch(self, message: Dict):
+        self.messages_received += 1
+        handler = self.handlers.get(message.get("op"))
+        if handler is None:
+            log.warning("backplane_unknown_op", node=self.node_id, op=message.get("op"))
+            return
+        try:
+            handler(message)
+        except Exception as e:
+            log.warning("backplane_handler_failed", node=self.node_id, op=message.get("op"), error=repr(e))
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {
+            "node": self.node_id,
+            "messages_sent": self.messages_sent,
+            "messages_received": self.messages_received,
+        }
+
+
+class InProcessBackplane(Backplane):
+    """
+    Nodes sharing one event loop, joined through a common dict. With no peers it
+    is the single-server default; with several it lets tests run a cluster in
+    one process. Delivery is deferred to the next loop iteration like a real
+    transport would be.
+    """
+
+    def __init__(self, node_id: int = 0, nodes: Optional[Dict[int, "InProcessBackplane"]] = None):
+        super().__init__(node_id)
+        self.nodes = nodes if nodes is not None else {}
+        self.nodes[node_id] = self
+
+    def send(self, node, message: Dict):
+        peer = self.nodes.get(node)
+        if peer is not None and peer is not self:
+            self.messages_sent += 1
+            asyncio.get_event_loop().call_soon(peer.dispatch, message)
+
+    def publish(self, message: Dict):
+        for node in list(self.nodes):
+            self.send(node, message)
+
+    def close(self):
+        if self.nodes.get(self.node_id) is self:
+            del self.nodes[self.node_id]
+            self.publish({"op": "node_down", "node": self.node_id})
+
+
+def encode_frame(target: int, message: Dict) -> bytes:
+    body = json.dumps(message).encode('utf-8')
+    return FRAME_HEADER.pack(target, len(body)) + body
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    header = await reader.readexactly(FRAME_HEADER.size)
+    target, length = FRAME_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Backplane frame of {length} bytes is too large")
+    return header, target, await reader.readexactly(length)
+
+
+class TcpBackplane(Backplane):
+    """
+    Node side of the TCP reference broker (BackplaneBroker). When the broker
+    connection drops, the node is told with "disconnected" and the connection
+    is made again with a doubling delay, followed by "reconnected".
+    """
+
+    def __init__(self, node_id: int, host: str, port: int):
+        super().__init__(node_id)
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.reconnects = 0
+
+    async def start(self):
+        await self._connect()
+        self.reader_task = asyncio.ensure_future(self._read_loop())
+
+    async def _connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(encode_frame(TARGET_HELLO, {"node": self.node_id}))
+        log.info("backplane_connected", node=self.node_id, host=self.host, port=self.port)
+
+    async def _read_loop(self):
+        while True:
+            try:
+                while True:
+                    _, _, body = await read_frame(self.reader)
+                    self.dispatch(json.loads(body))
+            except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+                log.warning("backplane_disconnected", node=self.node_id, error=repr(e))
+            # Nothing is written until the broker is back
+            self.writer.close()
+            self.writer = None
+            self.notify("disconnected")
+            await self._reconnect()
+            self.notify("reconnected")
+
+    async def _reconnect(self):
+        delay = RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self._connect()
+            except OSError as e:
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                log.warning("backplane_reconnect_failed", node=self.node_id, error=repr(e), retry_in=delay)
+                continue
+            self.reconnects += 1
+            return
+
+    def _write(self, target, message: Dict):
+        if self.writer is not None and not self.writer.is_closing():
+            self.messages_sent += 1
+            self.writer.write(encode_frame(target, message))
+
+    def send(self, node, message: Dict):
+        if node != self.node_id:
+            self._write(node, message)
+
+    def publish(self, message: Dict):
+        self._write(TARGET_ALL, message)
+
+    def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    def stats(self):
+        stats = super().stats()
+        stats["reconnects"] = self.reconnects
+        return stats
+
+
+class BackplaneBroker:
+    """
+    Reference broker for TcpBackplane: a star that relays frames between nodes
+    by looking only at the frame header. When a node disconnects the others get
+    a node_down message so they can forget its users.
+    """
+
+    def __init__(self):
+        self.nodes: Dict[int, asyncio.StreamWriter] = {}
+        self.frames_relayed = 0
+
+    async def serve(self, host, port):
+        return await asyncio.start_server(self._handle_node, host, port)
+
+    async def _handle_node(self, reader, writer):
+        node = None
+        try:
+            _, target, body = await read_frame(reader)
+            if target != TARGET_HELLO:
+                return
+            node = json.loads(body)["node"]
+            self.nodes[node] = writer
+            log.info("broker_node_joined", node=node, connected=len(self.nodes))
+            while True:
+                header, target, body = await read_frame(reader)
+                frame = header + body
+                if target == TARGET_ALL:
+                    for other, other_writer in self.nodes.items():
+                        if other != node:
+                            other_writer.write(frame)
+                            self.frames_relayed += 1
+                else:
+                    other_writer = self.nodes.get(target)
+                    if other_writer is not None:
+                        other_writer.write(frame)
+                        self.frames_relayed += 1
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            if node is not None and self.nodes.get(node) is writer:
+                del self.nodes[node]
+                log.info("broker_node_left", node=node, connected=len(self.nodes))
+                frame = encode_frame(TARGET_ALL, {"op": "node_down", "node": node})
+                for other_writer in self.nodes.values():
+                    other_writer.write(frame)
+            writer.close()
+
+
+async def run_broker(host, port):
+    broker = BackplaneBroker()
+    server = await broker.serve(host, port)
+    log.info("broker_listening", host=host, port=port)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,395 @@
+"""
+Load generator and latency benchmark for the chat server.
+
+Starts quic_engine.run_server in a child process on localhost, logs in N
+scripted clients (ChatClientRequestHandler connections without the interactive
+prompts) and drives one-to-one, one-to-many or broadcast traffic at a fixed
+rate. Results are printed or written as JSON so runs can be compared:
+
+    python bench.py --clients 100 --workload broadcast --rate 200 --duration 10 -o run.json
+    python bench.py --clients 100 --workload broadcast --rate 200 --baseline run.json
+    python bench.py --clients 100 --workload one_to_one --rate 500 --server-workers 4
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from aioquic.asyncio import connect
+
+import chat_client
+import chat_server
+import pdu
+import quic_engine
+from outbound import batch_config
+from chat_quic import ConnectionState, QuicStreamEvent
+
+WORKLOAD_ONE_TO_ONE = "one_to_one"
+WORKLOAD_ONE_TO_MANY = "one_to_many"
+WORKLOAD_BROADCAST = "broadcast"
+WORKLOADS = [WORKLOAD_ONE_TO_ONE, WORKLOAD_ONE_TO_MANY, WORKLOAD_BROADCAST]
+
+CHAT_MESSAGE_TYPES = (pdu.MSG_TYPE_ONE_TO_ONE, pdu.MSG_TYPE_ONE_TO_MANY, pdu.MSG_TYPE_BROADCAST)
+BENCH_BCRYPT_ROUNDS = 4  # Cheap hashes so account setup does not dominate the run
+
+
+def bench_username(index):
+    return f"bench{index}"
+
+
+def create_user_db(path, clients):
+    from user_db import UserDatabase, SQLiteUserStore
+    db = UserDatabase()
+    db.use_store(SQLiteUserStore(path), seed_demo_users=False)
+    db.import_users(((bench_username(i), bench_username(i)) for i in range(clients)),
+                    rounds=BENCH_BCRYPT_ROUNDS)
+    db.store.close()
+
+
+def server_process(args, user_db_path, ready, index=0, socket_dir=None):
+    # Entry point of a child process running the server (or one of its workers) under test
+    from auth_pool import auth_pool
+    from user_db import user_db, SQLiteUserStore
+    from worker_bus import WorkerBus
+    from log import log, WARNING
+    from rate_limit import sender_limits
+    log.configure(level=WARNING)
+    user_db.use_store(SQLiteUserStore(user_db_path), seed_demo_users=False)
+    auth_pool.configure(max_pending=args.clients)
+    configure_framing(args)
+    chat_server.dispatch_config.configure(mode=args.dispatch)
+    sender_limits.configure(rate=args.sender_rate)
+    config = quic_engine.build_server_quic_config(args.cert_file, args.key_file)
+    if socket_dir is None:
+        asyncio.run(quic_engine.run_server(args.host, args.port, config, on_started=ready.set))
+    else:
+        user_db.configure_id_space(index, args.server_workers)
+        bus = WorkerBus(socket_dir, index, args.server_workers)
+        asyncio.run(quic_engine.run_worker_server(args.host, args.port, config, bus, on_started=ready.set))
+
+
+def configure_framing(args):
+    batch_config.configure(max_delay=args.batch_delay_ms / 1000, max_messages=args.batch_max_messages)
+    pdu.compressor.configure(enabled=not args.no_compression)
+
+
+def read_total_rss_kb(pids):
+    # Summed over all server processes; None if any could not be read
+    current_total, peak_total = 0, 0
+    for pid in pids:
+        current, peak = read_rss_kb(pid)
+        if current is None:
+            return None, None
+        current_total += current
+        peak_total += peak
+    return current_total, peak_total
+
+
+def read_rss_kb(pid):
+    # Current and peak resident set size from /proc (Linux only)
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["VmRSS"].split()[0]), int(fields["VmHWM"].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(int(fraction * len(sorted_samples)), len(sorted_samples) - 1)]
+
+
+class BenchStats:
+    def __init__(self):
+        self.sent = 0
+        self.expected = 0
+        self.delivered = 0
+        self.errors = 0
+        self.latencies = []  # Seconds from send to delivery
+        self.last_delivery = 0.0
+        self.login_latencies = []
+
+
+class BenchClient:
+    def __init__(self, index, stats: BenchStats):
+        self.index = index
+        self.username = bench_username(index)
+        self.stats = stats
+        self.user_id = None
+        self.conn = None
+        self.stream_id = None
+        self.logged_in = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.login_started = 0.0
+
+    async def run(self, args, configuration, stop: asyncio.Event):
+        async with connect(args.host, args.port, configuration=configuration,
+                           create_protocol=quic_engine.AsyncQuicServer) as client:
+            self.conn = client._client_handler.make_connection()
+            await self.conn.start_connection()
+            await self.conn.wait_for(ConnectionState.CONNECTED, ConnectionState.ERROR)
+            self.stream_id = self.conn.new_stream()
+            self.conn.control_stream = self.stream_id
+            receiver = asyncio.ensure_future(self.receive_loop())
+
+            self.login_started = time.perf_counter()
+            versions = {"versions": chat_client.get_supported_versions(),
+                        "features": chat_client.get_supported_features()}
+            await self.send(pdu.MSG_TYPE_VERSIONS, json.dumps(versions), version=1)
+            await self.send_login()
+
+            await stop.wait()
+            if self.logged_in.is_set():
+                await self.send(pdu.MSG_TYPE_LOGOUT, "User logging out")
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.finished.wait(), timeout=5)
+            receiver.cancel()
+
+    async def send(self, mtype, msg, version=None):
+        datagram = pdu.Datagram(mtype, msg, self.conn.version if version is None else version)
+        await self.conn.send(QuicStreamEvent(self.conn.stream_for(mtype), datagram.to_bytes(self.conn.compress), False))
+
+    async def send_login(self):
+        await self.send(pdu.MSG_TYPE_LOGIN, json.dumps({"username": self.username, "password": self.username}))
+
+    async def send_chat(self, workload, targets):
+        # The send time travels in the message text; clients share this process's clock
+        text = f"{time.perf_counter()!r} {self.username}"
+        if workload == WORKLOAD_ONE_TO_ONE:
+            await self.send(pdu.MSG_TYPE_ONE_TO_ONE, json.dumps({"target_user_id": str(targets[0]), "msg": text}))
+        elif workload == WORKLOAD_ONE_TO_MANY:
+            target_ids = ",".join(str(target) for target in targets)
+            await self.send(pdu.MSG_TYPE_ONE_TO_MANY, json.dumps({"target_user_ids": target_ids, "msg": text}))
+        else:
+            await self.send(pdu.MSG_TYPE_BROADCAST, json.dumps({"msg": text}))
+
+    async def receive_loop(self):
+        while True:
+            event = await self.conn.receive()
+            datagram = event.datagram
+            if datagram is None:
+                break
+            if datagram.mtype in CHAT_MESSAGE_TYPES:
+                sent_at = float(json.loads(datagram.msg)["msg"].split(" ", 1)[0])
+                now = time.perf_counter()
+                self.stats.latencies.append(now - sent_at)
+                self.stats.delivered += 1
+                self.stats.last_delivery = now
+            elif datagram.mtype == pdu.MSG_TYPE_VERSIONS:
+                reply = json.loads(datagram.msg)
+                self.conn.version = reply.get("selected_version", self.conn.version)
+                self.conn.features = set(reply.get("features", []))
+                self.conn.compress = pdu.FEATURE_COMPRESSION in self.conn.features
+                self.conn.separate_streams = pdu.FEATURE_STREAMS in self.conn.features
+                self.conn.datagrams = pdu.FEATURE_DATAGRAMS in self.conn.features
+                if pdu.FEATURE_BATCH in self.conn.features:
+                    self.conn.enable_batching()
+            elif datagram.mtype == pdu.MSG_TYPE_LOGIN_ACK:
+                roster = json.loads(datagram.msg)
+                users = roster["users"] if isinstance(roster, dict) else roster
+                self.user_id = next(u["user_id"] for u in users if u["username"] == self.username)
+                self.stats.login_latencies.append(time.perf_counter() - self.login_started)
+                self.logged_in.set()
+            elif datagram.mtype == pdu.MSG_TYPE_LOGIN_UNSUCCESSFUL_RETRY:
+                await asyncio.sleep(0.05)  # Auth pool busy, try again
+                await self.send_login()
+            elif datagram.mtype in (pdu.MSG_TYPE_MSG_UNSUCCESSFUL, pdu.MSG_TYPE_LOGIN_UNSUCCESSFUL_DISCONNECT):
+                self.stats.errors += 1
+            elif datagram.mtype == pdu.MSG_TYPE_LOGOUT_ACK:
+                self.finished.set()
+                break
+
+
+async def drive_traffic(args, clients, stats: BenchStats):
+    loop = asyncio.get_running_loop()
+    user_ids = [client.user_id for client in clients]
+    interval = 1.0 / args.rate
+    deadline = loop.time() + args.duration
+    next_send = loop.time()
+    sequence = 0
+    while loop.time() < deadline:
+        sender = clients[sequence % len(clients)]
+        if args.workload == WORKLOAD_ONE_TO_ONE:
+            targets = [random.choice(user_ids)]
+        elif args.workload == WORKLOAD_ONE_TO_MANY:
+            targets = random.sample(user_ids, min(args.fanout, len(user_ids)))
+        else:
+            targets = user_ids
+        await sender.send_chat(args.workload, targets)
+        stats.sent += 1
+        stats.expected += len(targets)
+        sequence += 1
+        next_send += interval
+        delay = next_send - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def run_clients(args, server_pids):
+    stats = BenchStats()
+    configuration = quic_engine.build_client_quic_config(args.cert_file)
+    stop = asyncio.Event()
+    clients = [BenchClient(i, stats) for i in range(args.clients)]
+
+    login_start = time.perf_counter()
+    tasks = [asyncio.ensure_future(client.run(args, configuration, stop)) for client in clients]
+    await asyncio.wait_for(asyncio.gather(*(client.logged_in.wait() for client in clients)),
+                           timeout=args.login_timeout)
+    login_duration = time.perf_counter() - login_start
+    rss_after_login, _ = read_total_rss_kb(server_pids)
+
+    traffic_start = time.perf_counter()
+    await drive_traffic(args, clients, stats)
+    send_duration = time.perf_counter() - traffic_start
+    await asyncio.sleep(args.drain)  # Let in-flight deliveries arrive
+    rss_end, rss_peak = read_total_rss_kb(server_pids)
+
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    delivery_window = max(stats.last_delivery - traffic_start, send_duration)
+    latencies = sorted(stats.latencies)
+    login_latencies = sorted(stats.login_latencies)
+    to_ms = lambda value: None if value is None else value * 1000
+    return {
+        "label": args.label,
+        "workload": args.workload,
+        "clients": args.clients,
+        "server_workers": args.server_workers,
+        "batch_max_messages": args.batch_max_messages,
+        "compression": not args.no_compression,
+        "dispatch": args.dispatch,
+        "sender_rate": args.sender_rate,
+        "target_rate": args.rate,
+        "fanout": args.fanout if args.workload == WORKLOAD_ONE_TO_MANY else None,
+        "duration_s": send_duration,
+        "sent": stats.sent,
+        "expected_deliveries": stats.expected,
+        "delivered": stats.delivered,
+        "delivery_ratio": stats.delivered / stats.expected if stats.expected else None,
+        "errors": stats.errors,
+        "send_rate_per_s": stats.sent / send_duration,
+        "throughput_deliveries_per_s": stats.delivered / delivery_window,
+        "latency_ms": {
+            "p50": to_ms(percentile(latencies, 0.50)),
+            "p99": to_ms(percentile(latencies, 0.99)),
+            "p999": to_ms(percentile(latencies, 0.999)),
+            "max": to_ms(latencies[-1] if latencies else None),
+        },
+        "login": {
+            "count": len(login_latencies),
+            "duration_s": login_duration,
+            "rate_per_s": len(login_latencies) / login_duration,
+            "latency_ms_p50": to_ms(percentile(login_latencies, 0.50)),
+            "latency_ms_p99": to_ms(percentile(login_latencies, 0.99)),
+        },
+        "server_rss_kb": {
+            "after_login": rss_after_login,
+            "end": rss_end,
+            "peak": rss_peak,
+        },
+    }
+
+
+def compare_to_baseline(result, baseline, tolerance):
+    # Returns a list of regressions beyond the tolerance (as a fraction)
+    regressions = []
+    checks = [
+        ("throughput_deliveries_per_s", result["throughput_deliveries_per_s"],
+         baseline.get("throughput_deliveries_per_s"), False),
+        ("latency_ms.p99", result["latency_ms"]["p99"], baseline.get("latency_ms", {}).get("p99"), True),
+        ("login.rate_per_s", result["login"]["rate_per_s"], baseline.get("login", {}).get("rate_per_s"), False),
+        ("server_rss_kb.peak", result["server_rss_kb"]["peak"], baseline.get("server_rss_kb", {}).get("peak"), True),
+    ]
+    for name, current, previous, lower_is_better in checks:
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if (lower_is_better and change > tolerance) or (not lower_is_better and change < -tolerance):
+            regressions.append(f"{name}: {previous:.3f} -> {current:.3f} ({change:+.1%})")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Chat server load and latency benchmark')
+    parser.add_argument('-n', '--clients', type=int, default=20, help='Number of simulated clients')
+    parser.add_argument('-w', '--workload', choices=WORKLOADS, default=WORKLOAD_BROADCAST)
+    parser.add_argument('-r', '--rate', type=float, default=50.0, help='Messages sent per second, across all clients')
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='Seconds of traffic')
+    parser.add_argument('--fanout', type=int, default=5, help='Recipients per one-to-many message')
+    parser.add_argument('--drain', type=float, default=2.0, help='Seconds to wait for deliveries after sending stops')
+    parser.add_argument('--login-timeout', type=float, default=60.0)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('-p', '--port', type=int, default=4434, help='Port for the benchmark server')
+    parser.add_argument('-c', '--cert-file', default='./certs/quic_certificate.pem')
+    parser.add_argument('-k', '--key-file', default='./certs/quic_private_key.pem')
+    parser.add_argument('--server-workers', type=int, default=1,
+                        help='Run the server as this many SO_REUSEPORT worker processes')
+    parser.add_argument('--batch-delay-ms', type=float, default=batch_config.max_delay * 1000,
+                        help='Milliseconds a frame may wait to be batched, for the server and the clients')
+    parser.add_argument('--batch-max-messages', type=int, default=batch_config.max_messages,
+                        help='Frames per batch (1 turns batching off)')
+    parser.add_argument('--no-compression', action='store_true', help='Run without payload compression')
+    parser.add_argument('--dispatch', choices=chat_server.DISPATCH_MODES, default=chat_server.DISPATCH_DIRECT,
+                        help='Server dispatch mode, see chat.py server --dispatch')
+    parser.add_argument('--sender-rate', type=float, default=0,
+                        help='Server per-sender rate limit, see chat.py server --sender-rate (default: off)')
+    parser.add_argument('--label', default='', help='Free-form tag stored with the results')
+    parser.add_argument('-o', '--output', help='Write results JSON to this file instead of stdout')
+    parser.add_argument('--baseline', help='Earlier results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed relative regression versus the baseline')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        user_db_path = os.path.join(tmp, "bench_users.db")
+        create_user_db(user_db_path, args.clients)
+
+        ctx = multiprocessing.get_context("spawn")
+        socket_dir = tmp if args.server_workers > 1 else None
+        servers = []
+        for index in range(args.server_workers):
+            ready = ctx.Event()
+            server = ctx.Process(target=server_process, args=(args, user_db_path, ready, index, socket_dir),
+                                 daemon=True)
+            server.start()
+            servers.append((server, ready))
+        try:
+            for _, ready in servers:
+                if not ready.wait(timeout=30):
+                    sys.exit("Benchmark server did not start")
+            configure_framing(args)
+            result = asyncio.run(run_clients(args, [server.pid for server, _ in servers]))
+        finally:
+            for server, _ in servers:
+                server.terminate()
+                server.join()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"[bench] Regression {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
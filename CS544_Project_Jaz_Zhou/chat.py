@@ -1,12 +1,40 @@
 import argparse
 import asyncio
+import csv
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import sys
+import tempfile
 from aioquic.quic.configuration import QuicConfiguration
 import chat_client
+import pdu
 import quic_engine
 import chat_server
+from auth_pool import auth_pool
+from user_db import user_db, SQLiteUserStore
+from outbound import outbound_config, batch_config, POLICY_DROP, POLICY_DISCONNECT
+from worker_bus import WorkerBus, announce_node_down
+from backplane import TcpBackplane, run_broker
+from message_store import offline_store
+from history import history_store
+from metrics import metrics
+from log import log, LEVELS, FORMAT_TEXT, FORMAT_JSON
+from profiler import profiler
+from timer_wheel import idle_sessions, DEFAULT_IDLE_TIMEOUT
+from rate_limit import sender_limits, DEFAULT_SENDER_RATE, DEFAULT_SENDER_BURST
+from presence import presence, DEFAULT_DEPARTED_TTL
 
 # Server fixed port for protocol specification
 SERVER_PORT = 4433  # Documented hardcoded server port
+BROKER_PORT = 4500  # Default port of the backplane reference broker
+MAX_CLUSTER_NODES = 1024  # User IDs are striped over this many backplane nodes
+
+
+def configure_logging(args):
+    log.configure(level=args.log_level, format=args.log_format)
 
 
 def client_mode(args):
@@ -14,18 +42,199 @@ def client_mode(args):
     server_port = args.port
     cert_file = args.cert_file
 
-    config = quic_engine.build_client_quic_config(cert_file)
-    asyncio.run(quic_engine.run_client(server_address, server_port, config))
+    configure_logging(args)
+    chat_client.history.load(args.history_file)
+    configure_framing(args)
+    ticket_cache = quic_engine.ClientSessionTicketCache(args.session_ticket_file)
+    config = quic_engine.build_client_quic_config(cert_file, ticket_cache.get(server_address),
+                                                  idle_timeout=args.quic_idle_timeout)
+    asyncio.run(quic_engine.run_client(server_address, server_port, config,
+                                       session_ticket_handler=ticket_cache.add))
+
+
+def configure_framing(args):
+    batch_config.configure(max_delay=args.batch_delay_ms / 1000, max_messages=args.batch_max_messages)
+    pdu.compressor.configure(enabled=not args.no_compression, min_size=args.compress_min_bytes)
+
+
+async def run_observed(args, server, port_offset=0):
+    # Metrics endpoint and periodic snapshots alongside the chat server;
+    # workers each take the next port
+    if args.metrics_port:
+        await metrics.serve_http(args.metrics_listen, args.metrics_port + port_offset)
+        log.info("metrics_listening", host=args.metrics_listen, port=args.metrics_port + port_offset)
+    if args.metrics_interval:
+        metrics.report_every(args.metrics_interval, lambda snapshot: log.info("metrics", **snapshot))
+    # SIGUSR1 starts and stops the profiler; SIGTERM stops the server so a
+    # running profile is still written
+    loop = asyncio.get_running_loop()
+    server = asyncio.ensure_future(server)
+    loop.add_signal_handler(signal.SIGUSR1, profiler.toggle)
+    loop.add_signal_handler(signal.SIGTERM, server.cancel)
+    if args.profile:
+        profiler.start()
+    try:
+        await server
+    except asyncio.CancelledError:
+        pass
+    finally:
+        profiler.stop()
+
+
+def configure_server(args, session_ticket_file, offline_dir):
+    configure_logging(args)
+    if offline_dir:
+        offline_store.open(offline_dir, commit_interval=args.offline_commit_ms / 1000)
+    presence.configure(departed_ttl=args.departed_ttl)
+    if args.history_db:
+        # One file for every worker: sequence numbers come from the database
+        history_store.open(args.history_db)
+    auth_pool.configure(max_workers=args.auth_workers, max_pending=args.auth_queue)
+    user_db.use_store(SQLiteUserStore(args.user_db))
+    outbound_config.configure(max_bytes=args.outbound_max_bytes,
+                              max_messages=args.outbound_max_messages,
+                              policy=args.slow_consumer_policy)
+    sender_limits.configure(rate=args.sender_rate, burst=args.sender_burst)
+    configure_framing(args)
+    idle_sessions.configure(timeout=args.idle_timeout)
+    chat_server.dispatch_config.configure(mode=args.dispatch)
+    profiler.configure(sample_interval=args.profile_interval_ms / 1000,
+                       stall_threshold=args.stall_threshold_ms / 1000, output_dir=args.profile_dir)
+    if session_ticket_file:
+        ticket_store = quic_engine.FileSessionTicketStore(session_ticket_file, args.session_ticket_ttl)
+    else:
+        ticket_store = quic_engine.SessionTicketStore(args.session_ticket_ttl)
+
+    server_config = quic_engine.build_server_quic_config(args.cert_file, args.key_file,
+                                                         idle_timeout=args.quic_idle_timeout)
+    return server_config, ticket_store
+
+
+def make_backplane(args, node_id):
+    # None keeps traffic on this server (or between its workers)
+    if not args.backplane:
+        return None
+    if node_id >= MAX_CLUSTER_NODES:
+        raise SystemExit(f"Backplane node ID {node_id} is out of range (max {MAX_CLUSTER_NODES - 1})")
+    host, _, port = args.backplane.rpartition(':')
+    user_db.configure_id_space(node_id, MAX_CLUSTER_NODES)
+    return TcpBackplane(node_id, host or 'localhost', int(port or BROKER_PORT))
 
 
 def server_mode(args):
     listen_address = args.listen
     listen_port = SERVER_PORT  # Use the hardcoded port
-    cert_file = args.cert_file
-    key_file = args.key_file
 
-    server_config = quic_engine.build_server_quic_config(cert_file, key_file)
-    asyncio.run(quic_engine.run_server(listen_address, listen_port, server_config))
+    if args.workers > 1:
+        run_workers(args)
+        return
+
+    offline_dir = args.offline_dir
+    if offline_dir and args.backplane:
+        offline_dir = os.path.join(offline_dir, f"node-{args.node_id}")
+    server_config, ticket_store = configure_server(args, args.session_ticket_file, offline_dir)
+    backplane = make_backplane(args, args.node_id)
+    asyncio.run(run_observed(args, quic_engine.run_server(listen_address, listen_port, server_config, ticket_store,
+                                                          backplane=backplane)))
+
+
+def worker_main(args, index, socket_dir):
+    # Each worker keeps its own ticket file, the bus keeps their contents in sync
+    session_ticket_file = f"{args.session_ticket_file}.{index}" if args.session_ticket_file else None
+    # In a cluster every worker is a backplane node of its own
+    node_id = args.node_id * args.workers + index
+    offline_dir = os.path.join(args.offline_dir, f"node-{node_id}") if args.offline_dir else None
+    server_config, ticket_store = configure_server(args, session_ticket_file, offline_dir)
+    user_db.configure_id_space(index, args.workers)
+    backplane = make_backplane(args, node_id)
+    bus = WorkerBus(socket_dir, index, args.workers)
+    try:
+        asyncio.run(run_observed(args, quic_engine.run_worker_server(args.listen, SERVER_PORT, server_config, bus,
+                                                                     ticket_store, backplane=backplane),
+                                 index))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(args):
+    # Worker processes share the UDP port through SO_REUSEPORT
+    socket_dir = tempfile.mkdtemp(prefix="chat-workers-")
+    # Workers switching a new database to WAL at the same time can fail with
+    # "disk I/O error", so the file is set up here first
+    SQLiteUserStore(args.user_db).close()
+    workers = [multiprocessing.Process(target=worker_main, args=(args, index, socket_dir),
+                                       name=f"chat-worker-{index}")
+               for index in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    # Stopping the parent stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        running = {worker.sentinel: index for index, worker in enumerate(workers)}
+        while running:
+            for sentinel in multiprocessing.connection.wait(list(running)):
+                index = running.pop(sentinel)
+                workers[index].join()
+                log.warning("worker_exited", worker=index, exitcode=workers[index].exitcode)
+                # Its users are still on the other workers' rosters
+                announce_node_down(socket_dir, index, sorted(running.values()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+def broker_mode(args):
+    configure_logging(args)
+    try:
+        asyncio.run(run_broker(args.listen, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+def import_users_mode(args):
+    # CSV rows of username,password
+    user_db.use_store(SQLiteUserStore(args.user_db), seed_demo_users=False)
+    skipped = []
+    def valid_rows(reader):
+        for row in reader:
+            if len(row) < 2:
+                continue
+            if pdu.valid_username(row[0]):
+                yield row[0], row[1]
+            else:
+                skipped.append(row[0])
+    with open(args.csv_file, newline='') as f:
+        added = user_db.import_users(valid_rows(csv.reader(f)), rounds=args.rounds)
+    print(f"Imported {added} users into {args.user_db}")
+    if skipped:
+        print(f"Skipped {len(skipped)} usernames that are empty or contain ':' or ','")
+
+
+def add_framing_arguments(parser):
+    parser.add_argument('--batch-delay-ms', type=float, default=2.0,
+                        help='Milliseconds a message may wait to be sent in one batch with others')
+    parser.add_argument('--batch-max-messages', type=int, default=32,
+                        help='Messages that fill a batch (1 turns batching off)')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Do not offer zlib payload compression during version negotiation')
+    parser.add_argument('--compress-min-bytes', type=int, default=pdu.DEFAULT_COMPRESSION_MIN_SIZE,
+                        help='Payloads smaller than this are sent uncompressed')
+
+
+def add_quic_arguments(parser):
+    parser.add_argument('--quic-idle-timeout', type=float, default=quic_engine.DEFAULT_QUIC_IDLE_TIMEOUT,
+                        help='Seconds without packets before QUIC drops the connection (clients PING at a third of it)')
+
+
+def add_log_arguments(parser):
+    parser.add_argument('--log-level', choices=list(LEVELS), default='info',
+                        help='Least severe log events to write to stderr')
+    parser.add_argument('--log-format', choices=[FORMAT_TEXT, FORMAT_JSON], default=FORMAT_TEXT)
 
 
 def parse_args():
@@ -37,6 +246,13 @@ def parse_args():
     client_parser.add_argument('-p', '--port', type=int, default=SERVER_PORT, help='Port to connect to')
     client_parser.add_argument('-c', '--cert-file', default='./certs/quic_certificate.pem',
                                help='Certificate file (for self signed certs)')
+    client_parser.add_argument('-t', '--session-ticket-file', default='./session_tickets.pkl',
+                               help='File used to keep TLS session tickets for 0-RTT reconnects')
+    add_framing_arguments(client_parser)
+    add_quic_arguments(client_parser)
+    add_log_arguments(client_parser)
+    client_parser.add_argument('--history-file', default='./history_cursors.json',
+                               help='File used to keep the history catch-up cursor of each user')
 
     server_parser = subparsers.add_parser('server')
     server_parser.add_argument('-c', '--cert-file', default='./certs/quic_certificate.pem',
@@ -45,6 +261,69 @@ def parse_args():
                                help='Key file (for self signed certs)')
     server_parser.add_argument('-l', '--listen', default='localhost', help='Address to listen on')
     # Port argument removed for server since it's hardcoded
+    server_parser.add_argument('--auth-workers', type=int, default=4,
+                               help='Maximum number of concurrent password hashes')
+    server_parser.add_argument('--auth-queue', type=int, default=64,
+                               help='Logins allowed to wait for a hash worker before being rejected')
+    server_parser.add_argument('-u', '--user-db', default='./users.db', help='SQLite user database file')
+    server_parser.add_argument('--outbound-max-bytes', type=int, default=1024 * 1024,
+                               help='High-water mark for bytes queued to one connection')
+    server_parser.add_argument('--outbound-max-messages', type=int, default=1024,
+                               help='High-water mark for messages queued to one connection')
+    server_parser.add_argument('--slow-consumer-policy', choices=[POLICY_DROP, POLICY_DISCONNECT],
+                               default=POLICY_DROP, help='What to do when a connection crosses the high-water mark')
+    server_parser.add_argument('--sender-rate', type=float, default=DEFAULT_SENDER_RATE,
+                               help='Messages per second one user may send to others (0 disables the limit)')
+    server_parser.add_argument('--sender-burst', type=int, default=DEFAULT_SENDER_BURST,
+                               help='Messages one user may send at once before --sender-rate applies')
+    server_parser.add_argument('-t', '--session-ticket-file', default=None,
+                               help='Persist issued TLS session tickets to this file (default: memory only)')
+    server_parser.add_argument('--session-ticket-ttl', type=float, default=quic_engine.DEFAULT_TICKET_TTL,
+                               help='Seconds an issued session ticket stays redeemable')
+    server_parser.add_argument('-w', '--workers', type=int, default=1,
+                               help='Number of server processes sharing the port (at most 256)')
+    server_parser.add_argument('-b', '--backplane', default=None, metavar='HOST:PORT',
+                               help='Join a cluster through the backplane broker at this address')
+    server_parser.add_argument('-n', '--node-id', type=int, default=0,
+                               help='Cluster-unique number of this server when using --backplane')
+    server_parser.add_argument('--offline-dir', default='./offline_messages',
+                               help='Directory of the offline message log (empty string disables it)')
+    server_parser.add_argument('--offline-commit-ms', type=float, default=2.0,
+                               help='Milliseconds an offline message waits to share an fsync with others')
+    server_parser.add_argument('--departed-ttl', type=float, default=DEFAULT_DEPARTED_TTL,
+                               help='Seconds the user ID of a logged out user can still receive offline messages')
+    server_parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                               help='Seconds without any PDU before a session on application keep-alives is closed (0 disables it)')
+    server_parser.add_argument('--dispatch', choices=chat_server.DISPATCH_MODES, default=chat_server.DISPATCH_DIRECT,
+                               help='Handle PDUs as they are decoded (direct) or from a per-connection queue (queue)')
+    add_quic_arguments(server_parser)
+    add_framing_arguments(server_parser)
+    add_log_arguments(server_parser)
+    server_parser.add_argument('--metrics-port', type=int, default=0,
+                               help='Serve /metrics and /snapshot over HTTP on this port (0 disables it)')
+    server_parser.add_argument('--metrics-listen', default='localhost', help='Address for the metrics endpoint')
+    server_parser.add_argument('--metrics-interval', type=float, default=0,
+                               help='Seconds between metrics snapshots written to the log (0 disables them)')
+    server_parser.add_argument('--history-db', default='./history.db',
+                               help='SQLite message history database (empty string disables it)')
+    server_parser.add_argument('--profile', action='store_true',
+                               help='Profile the event loop from startup (SIGUSR1 toggles it at runtime)')
+    server_parser.add_argument('--profile-dir', default='./profiles',
+                               help='Directory the collapsed stacks and summary are written to')
+    server_parser.add_argument('--profile-interval-ms', type=float, default=5.0,
+                               help='Milliseconds between stack samples while profiling')
+    server_parser.add_argument('--stall-threshold-ms', type=float, default=100.0,
+                               help='Callbacks holding the event loop longer than this are reported as stalls')
+
+    broker_parser = subparsers.add_parser('broker')
+    broker_parser.add_argument('-l', '--listen', default='localhost', help='Address to listen on')
+    broker_parser.add_argument('-p', '--port', type=int, default=BROKER_PORT, help='Port to listen on')
+    add_log_arguments(broker_parser)
+
+    import_parser = subparsers.add_parser('import-users')
+    import_parser.add_argument('csv_file', help='CSV file of username,password rows')
+    import_parser.add_argument('-u', '--user-db', default='./users.db', help='SQLite user database file')
+    import_parser.add_argument('--rounds', type=int, default=12, help='bcrypt cost factor')
 
     return parser.parse_args()
 
@@ -55,6 +334,10 @@ if __name__ == '__main__':
         client_mode(args)
     elif args.mode == 'server':
         server_mode(args)
+    elif args.mode == 'broker':
+        broker_mode(args)
+    elif args.mode == 'import-users':
+        import_users_mode(args)
     else:
         print('Invalid mode')
 
@@ -1,14 +1,124 @@
 import asyncio
+import os
+from collections import deque
 from typing import Dict
 import json
 from chat_quic import ChatQuicConnection, QuicStreamEvent, ConnectionState
 import pdu
+from outbound import batch_config
 
 def get_supported_versions():
-    return [1]  # Add more versions as they become available
+    return [pdu.VERSION_JSON, pdu.VERSION_BINARY]  # Add more versions as they become available
+
+def get_supported_features():
+    features = [pdu.FEATURE_PRESENCE_DELTA, pdu.FEATURE_HISTORY, pdu.FEATURE_ROOMS, pdu.FEATURE_STREAMS,
+                pdu.FEATURE_QUIC_KEEPALIVE, pdu.FEATURE_DATAGRAMS]
+    if batch_config.enabled:
+        features.append(pdu.FEATURE_BATCH)
+    if pdu.compressor.enabled:
+        features.append(pdu.FEATURE_COMPRESSION)
+    return features
+
+CATCH_UP_PAGE_SIZE = 100
+HISTORY_PAGE_SIZE = 20
+
+
+class Roster:
+    """
+    Local copy of the active users, kept current by presence deltas. A full
+    snapshot is only requested when a gap in the sequence numbers shows up.
+    """
+
+    def __init__(self):
+        self.users = {}  # user_id -> username
+        self.seq = None
+        self.snapshot_requested = False
+
+    def load(self, snapshot):
+        if isinstance(snapshot, dict):
+            self.seq = snapshot["seq"]
+            users = snapshot["users"]
+        else:
+            self.seq = None  # Plain roster from a server without presence deltas
+            users = snapshot
+        self.users = {user["user_id"]: user["username"] for user in users}
+        self.snapshot_requested = False
+
+    def apply(self, delta):
+        # Returns False when deltas were missed and a snapshot is needed. A
+        # batched delta lists several events ending at its seq.
+        events = delta.get("events") or [delta]
+        first_seq = delta["seq"] - len(events) + 1
+        if self.seq is None or first_seq > self.seq + 1:
+            return False
+        for seq, event in enumerate(events, first_seq):
+            if seq != self.seq + 1:
+                continue  # Older deltas are already covered by the current roster
+            if event["event"] == "join":
+                self.users[event["user_id"]] = event["username"]
+            else:
+                self.users.pop(event["user_id"], None)
+            self.seq = seq
+        return True
+
+    def as_list(self):
+        return [{"user_id": user_id, "username": username} for user_id, username in self.users.items()]
+
+
+roster = Roster()
+
+
+class History:
+    """
+    Client side of message history: the catch-up cursor of each username, kept
+    in a small JSON file between runs, the paging cursor of each conversation
+    and the IDs of recently shown messages, so a message that arrives both
+    live and in a catch-up is only shown once.
+    """
+
+    def __init__(self, max_seen=1000):
+        self.path = None
+        self.cursors = {}  # username -> last catch-up cursor
+        self.username = None
+        self.page_cursors = {}  # conversation -> cursor of the oldest page shown
+        self.seen = deque(maxlen=max_seen)
+        self.seen_set = set()
+
+    def load(self, path):
+        self.path = path
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.cursors = json.load(f)
+            except (OSError, ValueError):
+                self.cursors = {}
+
+    def cursor(self):
+        return self.cursors.get(self.username)
+
+    def set_cursor(self, cursor):
+        self.cursors[self.username] = cursor
+        if self.path:
+            with open(self.path, "w") as f:
+                json.dump(self.cursors, f)
+
+    def first_sighting(self, message_id) -> bool:
+        if message_id is None:
+            return True
+        if message_id in self.seen_set:
+            return False
+        if len(self.seen) == self.seen.maxlen:
+            self.seen_set.discard(self.seen[0])
+        self.seen.append(message_id)
+        self.seen_set.add(message_id)
+        return True
+
+
+history = History()
 
 async def send_version_negotiation(conn, new_stream_id):
-    versions_message = pdu.Datagram(pdu.MSG_TYPE_VERSIONS, json.dumps({"versions": get_supported_versions()}), version=1)
+    versions_message = pdu.Datagram(pdu.MSG_TYPE_VERSIONS, json.dumps({"versions": get_supported_versions(),
+                                                                       "features": get_supported_features()}), version=1)
     
     await conn.send(QuicStreamEvent(new_stream_id, versions_message.to_bytes(), False))
 
@@ -16,20 +126,24 @@ async def send_version_negotiation(conn, new_stream_id):
 async def chat_client_proto(scope: Dict, conn: ChatQuicConnection):
     await conn.start_connection()  # Start the connection properly
 
-    # Loop until the connection is successfully established or an error occurs that cannot be recovered
-    while conn.state not in [ConnectionState.CONNECTED, ConnectionState.ERROR]:
-        await asyncio.sleep(0.1)  # Polling delay to prevent tight loop
+    # On a resumed session VERSIONS and the first LOGIN go out as 0-RTT data,
+    # otherwise wait until the QUIC handshake completes or an error occurs that cannot be recovered
+    early_data = conn.early_data and conn.state == ConnectionState.CONNECTING
+    if not early_data:
+        await conn.wait_for(ConnectionState.CONNECTED, ConnectionState.ERROR)
 
-    if conn.state == ConnectionState.CONNECTED:
+    if early_data or conn.state == ConnectionState.CONNECTED:
         new_stream_id = conn.new_stream()
+        conn.control_stream = new_stream_id
         # Send supported versions first
         await send_version_negotiation(conn, new_stream_id)
 
         while True:
             username = input("Enter username: ")
             password = input("Enter password: ")
-            login_message = pdu.Datagram(pdu.MSG_TYPE_LOGIN, json.dumps({"username": username, "password": password}), version=1)
-            await conn.send(QuicStreamEvent(new_stream_id, login_message.to_bytes(), False))
+            history.username = username
+            login_message = pdu.Datagram(pdu.MSG_TYPE_LOGIN, json.dumps({"username": username, "password": password}), version=conn.version)
+            await conn.send(QuicStreamEvent(new_stream_id, login_message.to_bytes(conn.compress), False))
 
             logout_event = asyncio.Event()
             login_result = await listen_for_messages(conn, logout_event)
@@ -48,7 +162,11 @@ async def listen_for_messages(conn: ChatQuicConnection, logout_event: asyncio.Ev
     while True:
         response: QuicStreamEvent = await conn.receive()
         if response:
-            response_data = pdu.Datagram.from_bytes(response.data)
+            response_data = response.datagram
+            if response_data is None:
+                print("[Sys] Server closed the stream")
+                conn.update_state(ConnectionState.DISCONNECTED)
+                return "unsuccesful_disconnect"
             if response_data.msg:
                 try:
                     parsed_msg = json.loads(response_data.msg)
@@ -60,16 +178,23 @@ async def listen_for_messages(conn: ChatQuicConnection, logout_event: asyncio.Ev
                 continue
 
             if response_data.mtype == pdu.MSG_TYPE_VERSIONS:
-                await handle_version(parsed_msg)
+                await handle_version(conn, parsed_msg)
             elif response_data.mtype == pdu.MSG_TYPE_LOGIN_ACK:
 
                 await handle_login_ack(parsed_msg)
+                if conn.state == ConnectionState.CONNECTING:
+                    await conn.wait_for(ConnectionState.CONNECTED, ConnectionState.ERROR)
                 conn.recover_from_error()
                 conn.authenticate()
-                # Start sending keep-alive messages
-                asyncio.ensure_future(send_keep_alive(conn, response.stream_id))
+                if pdu.FEATURE_QUIC_KEEPALIVE not in conn.features:
+                    # Older servers want keep-alive messages besides the QUIC PINGs
+                    asyncio.ensure_future(send_keep_alive(conn))
                 # Start handling user input
                 asyncio.ensure_future(handle_user_input(conn, response.stream_id, logout_event))
+                if pdu.FEATURE_HISTORY in conn.features:
+                    # Everything missed since the last session, in one request
+                    await send_history_request(conn, response.stream_id, after=history.cursor(),
+                                               limit=CATCH_UP_PAGE_SIZE)
 
                 return "successful"
 
@@ -91,19 +216,39 @@ async def listen_for_messages(conn: ChatQuicConnection, logout_event: asyncio.Ev
                 await handle_broadcast_user_login(parsed_msg)
             elif response_data.mtype == pdu.MSG_TYPE_LOGOUT_BROADCAST:
                 await handle_broadcast_user_logout(parsed_msg)
+            elif response_data.mtype == pdu.MSG_TYPE_PRESENCE_DELTA:
+                await handle_presence_delta(conn, response.stream_id, parsed_msg)
+            elif response_data.mtype == pdu.MSG_TYPE_PRESENCE_SNAPSHOT:
+                await handle_presence_snapshot(parsed_msg)
+            elif response_data.mtype == pdu.MSG_TYPE_HISTORY:
+                await handle_history(conn, response.stream_id, parsed_msg)
             elif response_data.mtype == pdu.MSG_TYPE_ONE_TO_ONE:
                 await handle_one_to_one(parsed_msg)
             elif response_data.mtype == pdu.MSG_TYPE_ONE_TO_MANY:
                 await handle_one_to_many(parsed_msg)
             elif response_data.mtype == pdu.MSG_TYPE_BROADCAST:
                 await handle_broadcast(parsed_msg)
+            elif response_data.mtype == pdu.MSG_TYPE_ROOM_MESSAGE:
+                await handle_room_message(parsed_msg)
+            elif response_data.mtype == pdu.MSG_TYPE_ROOM_ACK:
+                await handle_room_ack(parsed_msg)
+            elif response_data.mtype == pdu.MSG_TYPE_TYPING:
+                await handle_typing(parsed_msg)
             elif response_data.mtype == pdu.MSG_TYPE_LOGOUT_ACK:
                 await handle_logout_ack(logout_event)
                 conn.update_state(ConnectionState.DISCONNECTED)
                 return "logout" # Exit the function to end the connection
 
-async def handle_version(parsed_msg):
+async def handle_version(conn, parsed_msg):
     version_message = parsed_msg
+    if "selected_version" in version_message:
+        conn.version = version_message["selected_version"]
+        conn.features = set(version_message.get("features", []))
+        conn.compress = pdu.FEATURE_COMPRESSION in conn.features
+        conn.separate_streams = pdu.FEATURE_STREAMS in conn.features
+        conn.datagrams = pdu.FEATURE_DATAGRAMS in conn.features and conn.send_datagram is not None
+        if pdu.FEATURE_BATCH in conn.features and conn.enable_batching is not None:
+            conn.enable_batching()
     print("[Sys] ", version_message)
 
 async def handle_login_failure(conn):
@@ -121,9 +266,25 @@ async def handle_user_input(conn: ChatQuicConnection, new_stream_id, logout_even
         if user_input.strip().lower() == "logout":
             conn.update_state(ConnectionState.DISCONNECTING)
 
+            if pdu.FEATURE_HISTORY in conn.features:
+                # Move the catch-up cursor past everything shown in this session
+                await send_history_request(conn, new_stream_id, after=None, limit=0)
             await send_logout_message(conn, new_stream_id)
             await logout_event.wait()
             break  # Exit the loop after logout
+        elif user_input.strip().lower().startswith("history"):
+            await request_history_page(conn, new_stream_id, user_input.strip()[len("history"):].strip())
+        elif user_input.strip().lower().startswith("typing "):
+            send_typing(conn, user_input.strip()[len("typing"):].strip())
+        elif user_input.strip().lower().startswith(("join ", "leave ")):
+            command, room = user_input.strip().split(None, 1)
+            await send_room_membership(conn, new_stream_id, command.lower() == "join", room.strip())
+        elif user_input.startswith("#") and ':' in user_input:  # Room message
+            room, msg = user_input[1:].split(':', 1)
+            if msg.strip():
+                await send_room_message(conn, new_stream_id, room.strip(), msg.strip())
+            else:
+                print("Message cannot be empty.")
         elif user_input.startswith("0:"):  # Broadcast message
             if conn.state != ConnectionState.SENDING_MESSAGE:
                 conn.update_state(ConnectionState.SENDING_MESSAGE)
@@ -156,42 +317,99 @@ async def handle_user_input(conn: ChatQuicConnection, new_stream_id, logout_even
                     else:
                         print("Invalid user ID. User ID must be an integer.")
             except ValueError:
-                print("Invalid input format. Use 'user_id: message' for direct messages, 'user_id,user_id: message' for one-to-many messages, or '0: message' for broadcast.")
+                print("Invalid input format. Use 'user_id: message' for direct messages, 'user_id,user_id: message' for one-to-many messages, '#room: message' for rooms, or '0: message' for broadcast.")
 
 
 async def send_logout_message(conn: ChatQuicConnection, new_stream_id):
-    logout_message = pdu.Datagram(pdu.MSG_TYPE_LOGOUT, "User logging out", version=1)
-    await conn.send(QuicStreamEvent(new_stream_id, logout_message.to_bytes(), False))
+    logout_message = pdu.Datagram(pdu.MSG_TYPE_LOGOUT, "User logging out", version=conn.version)
+    await conn.send(QuicStreamEvent(new_stream_id, logout_message.to_bytes(conn.compress), False))
 
 async def send_one_to_one_message(conn: ChatQuicConnection, new_stream_id, target_user_id, msg):
 
     chat_message = pdu.Datagram(pdu.MSG_TYPE_ONE_TO_ONE,
-                                json.dumps({"target_user_id": target_user_id, "msg": msg}), version=1)
-    await conn.send(QuicStreamEvent(new_stream_id, chat_message.to_bytes(), False))
+                                json.dumps({"target_user_id": target_user_id, "msg": msg}), version=conn.version)
+    await conn.send(QuicStreamEvent(conn.stream_for(chat_message.mtype), chat_message.to_bytes(conn.compress), False))
 
 async def send_one_to_many_message(conn, new_stream_id, target_user_ids, msg):
     one_to_many_message = pdu.Datagram(pdu.MSG_TYPE_ONE_TO_MANY,
-                                       json.dumps({"target_user_ids": target_user_ids, "msg": msg}), version=1)
-    await conn.send(QuicStreamEvent(new_stream_id, one_to_many_message.to_bytes(), False))
+                                       json.dumps({"target_user_ids": target_user_ids, "msg": msg}), version=conn.version)
+    await conn.send(QuicStreamEvent(conn.stream_for(one_to_many_message.mtype), one_to_many_message.to_bytes(conn.compress), False))
 
 async def send_broadcast_message(conn, new_stream_id, msg):
     broadcast_message = pdu.Datagram(pdu.MSG_TYPE_BROADCAST,
-                                     json.dumps({"msg": msg}), version=1)
-    await conn.send(QuicStreamEvent(new_stream_id, broadcast_message.to_bytes(), False))
+                                     json.dumps({"msg": msg}), version=conn.version)
+    await conn.send(QuicStreamEvent(conn.stream_for(broadcast_message.mtype), broadcast_message.to_bytes(conn.compress), False))
+
+async def send_room_membership(conn, new_stream_id, join, room):
+    if pdu.FEATURE_ROOMS not in conn.features:
+        print("Rooms are not available on this server.")
+        return
+    mtype = pdu.MSG_TYPE_ROOM_JOIN if join else pdu.MSG_TYPE_ROOM_LEAVE
+    room_message = pdu.Datagram(mtype, json.dumps({"room": room}), version=conn.version)
+    await conn.send(QuicStreamEvent(new_stream_id, room_message.to_bytes(conn.compress), False))
+
+async def send_room_message(conn, new_stream_id, room, msg):
+    if pdu.FEATURE_ROOMS not in conn.features:
+        print("Rooms are not available on this server.")
+        return
+    room_message = pdu.Datagram(pdu.MSG_TYPE_ROOM_MESSAGE, json.dumps({"room": room, "msg": msg}), version=conn.version)
+    await conn.send(QuicStreamEvent(conn.stream_for(room_message.mtype), room_message.to_bytes(conn.compress), False))
+
+def send_typing(conn, target):
+    # "#room" or a user ID; lost indicators are not resent
+    if target.startswith("#"):
+        request = {"room": target[1:].strip()}
+    elif target.isdigit():
+        request = {"target_user_id": int(target)}
+    else:
+        print("Usage: typing <user_id> or typing #room")
+        return
+    typing_message = pdu.Datagram(pdu.MSG_TYPE_TYPING, json.dumps(request), version=conn.version)
+    conn.send_ephemeral(typing_message.mtype, typing_message.to_bytes(conn.compress))
+
+async def send_history_request(conn, new_stream_id, conversation=None, before=None, after=None, limit=HISTORY_PAGE_SIZE):
+    request = {"limit": limit}
+    if conversation is None:
+        request["after"] = after
+    else:
+        request["conversation"] = conversation
+        request["before"] = before
+    history_message = pdu.Datagram(pdu.MSG_TYPE_HISTORY_REQUEST, json.dumps(request), version=conn.version)
+    await conn.send(QuicStreamEvent(new_stream_id, history_message.to_bytes(conn.compress), False))
+
+async def request_history_page(conn, new_stream_id, target):
+    # "history" or "history 0" pages back through broadcasts, "history <user_id>"
+    # or "history <username>" through direct messages with that user, "history #room"
+    # through a room
+    if pdu.FEATURE_HISTORY not in conn.features:
+        print("History is not available on this server.")
+        return
+    if target in ("", "0"):
+        conversation = pdu.BROADCAST_CONVERSATION
+    elif target.startswith("#"):
+        conversation = pdu.room_conversation(target[1:])
+    else:
+        other = roster.users.get(int(target)) if target.isdigit() else target
+        if other is None:
+            print("Unknown user ID. Use the username of users who are offline.")
+            return
+        conversation = pdu.direct_conversation(history.username, other)
+    await send_history_request(conn, new_stream_id, conversation=conversation,
+                               before=history.page_cursors.get(conversation))
 
 
 # Sending keep-alive messages
-async def send_keep_alive(conn: ChatQuicConnection, new_stream_id):
+async def send_keep_alive(conn: ChatQuicConnection):
     while True:
         # Include version when creating Datagram
-        keep_alive_message = pdu.Datagram(pdu.MSG_TYPE_ALIVE, "keep_alive", version=1)
-        await conn.send(QuicStreamEvent(new_stream_id, keep_alive_message.to_bytes(), False))
+        keep_alive_message = pdu.Datagram(pdu.MSG_TYPE_ALIVE, "keep_alive", version=conn.version)
+        conn.send_ephemeral(keep_alive_message.mtype, keep_alive_message.to_bytes(conn.compress))
         await asyncio.sleep(30)  # Send keep-alive message every 30 seconds
 
 # Handlers for different message types
 async def handle_login_ack(parsed_msg):
-    active_users = parsed_msg
-    print("[Sys] Login successful. Active users:", active_users)
+    roster.load(parsed_msg)
+    print("[Sys] Login successful. Active users:", roster.as_list())
 
 async def handle_broadcast_user_login(parsed_msg):
     active_users = parsed_msg
@@ -201,21 +419,84 @@ async def handle_broadcast_user_logout(parsed_msg):
     active_users = parsed_msg
     print("[Sys] Some user logout. Active users:", active_users)
 
+async def handle_presence_delta(conn, stream_id, parsed_msg):
+    if roster.apply(parsed_msg):
+        for event in parsed_msg.get("events") or [parsed_msg]:
+            action = "login" if event["event"] == "join" else "logout"
+            print(f"[Sys] {event['username']} {action}. Active users:", roster.as_list())
+    elif not roster.snapshot_requested:
+        roster.snapshot_requested = True
+        request = pdu.Datagram(pdu.MSG_TYPE_PRESENCE_SNAPSHOT_REQUEST, "snapshot", version=conn.version)
+        await conn.send(QuicStreamEvent(stream_id, request.to_bytes(conn.compress), False))
+
+async def handle_presence_snapshot(parsed_msg):
+    roster.load(parsed_msg)
+    print("[Sys] Active users:", roster.as_list())
+
 async def handle_one_to_one(parsed_msg):
+    if not history.first_sighting(parsed_msg.get('id')):
+        return
     sender_username = parsed_msg['sender_username']
     msg = parsed_msg['msg']
     print(f"[1-1 Msg] {sender_username}: {msg}")
 
 async def handle_one_to_many(parsed_msg):
+    if not history.first_sighting(parsed_msg.get('id')):
+        return
     sender_username = parsed_msg['sender_username']
     msg = parsed_msg['msg']
     print(f"[1-n Msg] {sender_username}: {msg}")
 
 async def handle_broadcast(parsed_msg):
+    if not history.first_sighting(parsed_msg.get('id')):
+        return
     sender_username = parsed_msg['sender_username']
     msg = parsed_msg['msg']
     print(f"[Broad Msg] {sender_username}: {msg}")
 
+async def handle_room_message(parsed_msg):
+    if not history.first_sighting(parsed_msg.get('id')):
+        return
+    print(f"[Room {parsed_msg['room']}] {parsed_msg['sender_username']}: {parsed_msg['msg']}")
+
+async def handle_typing(parsed_msg):
+    if "room" in parsed_msg:
+        print(f"[Room {parsed_msg['room']}] {parsed_msg['username']} is typing...")
+    else:
+        print(f"[Sys] {parsed_msg['username']} is typing...")
+
+async def handle_room_ack(parsed_msg):
+    if parsed_msg["event"] == "join":
+        print(f"[Sys] Joined room {parsed_msg['room']} ({parsed_msg['members']} members)")
+    else:
+        print(f"[Sys] Left room {parsed_msg['room']}")
+
+async def handle_history(conn, stream_id, parsed_msg):
+    conversation = parsed_msg["conversation"]
+    if conversation is None:
+        # Catch-up: replay what was missed as if it arrived now. Rooms are not
+        # part of it, since room membership ends with the session.
+        for message in parsed_msg["messages"]:
+            payload = json.loads(message["msg"])
+            if message["mtype"] == pdu.MSG_TYPE_ONE_TO_ONE:
+                await handle_one_to_one(payload)
+            elif message["mtype"] == pdu.MSG_TYPE_ONE_TO_MANY:
+                await handle_one_to_many(payload)
+            else:
+                await handle_broadcast(payload)
+        history.set_cursor(parsed_msg["cursor"])
+        if parsed_msg["has_more"]:
+            await send_history_request(conn, stream_id, after=parsed_msg["cursor"], limit=CATCH_UP_PAGE_SIZE)
+        return
+
+    for message in parsed_msg["messages"]:
+        payload = json.loads(message["msg"])
+        print(f"[History {conversation}] {message['sender']}: {payload['msg']}")
+    if parsed_msg["cursor"] is not None:
+        history.page_cursors[conversation] = parsed_msg["cursor"]
+    if not parsed_msg["has_more"]:
+        print(f"[History {conversation}] No older messages")
+
 async def handle_unsuccessful(parsed_msg):
     error_message = parsed_msg
 
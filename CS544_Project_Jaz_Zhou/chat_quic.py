@@ -1,6 +1,8 @@
 from typing import Coroutine,Callable, Optional
 from enum import Enum, auto
 import asyncio
+import pdu
+from log import log
 
 class ConnectionState(Enum):
     DISCONNECTED = auto()
@@ -12,21 +14,61 @@ class ConnectionState(Enum):
     ERROR = auto()
 
 class QuicStreamEvent():
-    def __init__(self, stream_id, data, end_stream):
+    def __init__(self, stream_id, data, end_stream, datagram=None, traffic=pdu.TRAFFIC_CONTROL, sender=None):
         self.stream_id = stream_id
         self.data = data
         self.end_stream = end_stream
+        self.datagram = datagram  # Decoded pdu.Datagram for received frames
+        self.traffic = traffic  # Traffic class and sending user, used by the outbound scheduler
+        self.sender = sender
         
 class ChatQuicConnection:
 
-    def __init__(self, send, receive, close, new_stream):
+    def __init__(self, send, receive, close, new_stream, send_nowait=None, queue_stats=None,
+                 handshake_done: Optional[asyncio.Event] = None, enable_batching=None, open_stream=None,
+                 send_datagram=None, dispatch_directly=None):
         self.send = send
         self.receive = receive
         self.close = close
         self.new_stream = new_stream
+        self.send_nowait = send_nowait  # Queue data without flushing, used for fan-out
+        self.queue_stats = queue_stats  # Outbound queue metrics for this connection
+        self.handshake_done = handshake_done  # Set by the QUIC layer on HandshakeCompleted
+        self.enable_batching = enable_batching  # Coalesce outgoing frames, once FEATURE_BATCH is agreed
+        self.open_stream = open_stream  # Creates a stream for one traffic class, see stream_for
+        self.control_stream = None  # First stream of the connection, carries VERSIONS and LOGIN
+        self.separate_streams = False  # One stream per traffic class, once FEATURE_STREAMS is agreed
+        self.streams = {}  # Traffic class -> stream ID
+        self.send_datagram = send_datagram  # Sends one frame as a QUIC DATAGRAM, False if it cannot
+        self.datagrams = False  # Ephemeral messages as DATAGRAM frames, once FEATURE_DATAGRAMS is agreed
+        self.dispatch_directly = dispatch_directly  # Hands received events to a callback instead of receive()
         self.state = ConnectionState.DISCONNECTED
         self.previous_state = None
+        self.version = 1  # Negotiated protocol version, JSON until VERSIONS completes
+        self.features = set()  # Optional features both peers agreed on
+        self.compress = False  # Compress outgoing payloads, once FEATURE_COMPRESSION is agreed
+        self.early_data = False  # Resumed session that may send 0-RTT data
         self.connection_lock = asyncio.Lock()  # Lock to prevent multiple initiations
+        self.state_changed = asyncio.Event()  # Replaced on every transition, see wait_for
+
+    def stream_for(self, message_type):
+        # Stream that carries this type of message from this side
+        if not self.separate_streams:
+            return self.control_stream
+        traffic = pdu.traffic_class(message_type)
+        if traffic == pdu.TRAFFIC_CONTROL:
+            return self.control_stream
+        stream_id = self.streams.get(traffic)
+        if stream_id is None:
+            stream_id = self.streams[traffic] = self.open_stream()
+        return stream_id
+
+    def send_ephemeral(self, message_type, data, sender=None):
+        # Best effort in a DATAGRAM frame, otherwise queued on the class stream
+        if self.datagrams and self.send_datagram(data):
+            return
+        self.send_nowait(QuicStreamEvent(self.stream_for(message_type), data, False,
+                                         traffic=pdu.traffic_class(message_type), sender=sender))
 
     async def start_connection(self):
         # print("Attempting to start connection...")
@@ -34,26 +76,39 @@ class ChatQuicConnection:
             if self.state == ConnectionState.DISCONNECTED:
                 # print("Lock acquired and initiating connection")
                 self.update_state(ConnectionState.CONNECTING)
-                asyncio.create_task(self.complete_handshake())
+                if self.handshake_done is None or self.handshake_done.is_set():
+                    self.update_state(ConnectionState.CONNECTED)
+                else:
+                    asyncio.create_task(self.complete_handshake())
                 # print("Handshake task started")
             else:
-                print(f"Connection already initiated: Current state is {self.state}")
+                log.warning("connection_already_initiated", state=self.state.name)
 
 
     async def complete_handshake(self):
             try:
-                await asyncio.sleep(1)  # Simulate delay for handshake
-                self.update_state(ConnectionState.CONNECTED)
+                await self.handshake_done.wait()
+                if self.state == ConnectionState.CONNECTING:
+                    self.update_state(ConnectionState.CONNECTED)
             except Exception as e:
-                print(f"Handshake failed: {e}")
+                log.warning("handshake_failed", error=repr(e))
                 self.update_state(ConnectionState.DISCONNECTED)
 
+    async def wait_for(self, *states: ConnectionState) -> ConnectionState:
+        # Wait until the connection reaches any of the given states
+        while self.state not in states:
+            await self.state_changed.wait()
+        return self.state
+
 
     def update_state(self, new_state: ConnectionState):
         if self.state != ConnectionState.ERROR:  # Do not overwrite previous state if current is ERROR
             self.previous_state = self.state
-        print(f"Transitioning from {self.state} to {new_state}")
+        if log.debug_enabled:
+            log.debug("state_transition", old=self.state.name, new=new_state.name)
         self.state = new_state
+        changed, self.state_changed = self.state_changed, asyncio.Event()
+        changed.set()
 
     def handle_error(self):
         if self.state != ConnectionState.ERROR:
@@ -69,7 +124,7 @@ class ChatQuicConnection:
         if self.state == ConnectionState.CONNECTED:
             self.update_state(ConnectionState.AUTHENTICATED)
         else:
-            print("Cannot authenticate: Connection is not established")
+            log.warning("authenticate_not_connected", state=self.state.name)
 
     async def disconnect(self):
         if self.state not in [ConnectionState.DISCONNECTED]:
@@ -77,5 +132,5 @@ class ChatQuicConnection:
             self.close()
             self.update_state(ConnectionState.DISCONNECTED)
         else:
-            print("Connection already disconnected")
+            log.warning("already_disconnected")
 
@@ -1,86 +1,245 @@
 import asyncio
+import os
+import time
 from typing import Dict
 import json
 from chat_quic import ChatQuicConnection, QuicStreamEvent, ConnectionState
 import pdu
 from user_db import user_db  # Import the user database
+from auth_pool import auth_pool, AuthPoolBusy
+from presence import presence
+from rooms import rooms, MAX_ROOMS_PER_USER
+from backplane import InProcessBackplane
+from message_store import offline_store, InboxFull
+from history import history_store, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from outbound import batch_config
+from rate_limit import sender_limits, RATE_LIMITED
+from metrics import metrics, COUNT_BUCKETS
+from log import log
+from profiler import message_type
+from timer_wheel import idle_sessions
+
+# Links this server to the other nodes (or workers) of a cluster, see attach_backplane
+backplane = None
+
+MESSAGES_RECEIVED = metrics.counter("chat_messages_received_total", "PDUs received, by type", ("type",))
+MESSAGES_SENT = metrics.counter("chat_messages_sent_total", "PDUs sent, by type", ("type",))
+HANDLER_SECONDS = metrics.histogram("chat_handler_seconds", "Time to handle one received PDU, by type", ("type",))
+FANOUT_WIDTH = metrics.histogram("chat_fanout_width", "Local recipients of one fanned out message",
+                                 buckets=COUNT_BUCKETS)
+LOGIN_SECONDS = metrics.histogram("chat_login_seconds", "Login attempts from LOGIN to the reply, by result",
+                                  ("result",))
+SESSIONS_LOST = metrics.counter("chat_sessions_lost_total", "Sessions whose connection ended without a LOGOUT")
+IDLE_REAPED = metrics.counter("chat_idle_sessions_reaped_total", "Sessions closed after going silent")
+metrics.gauge("chat_sessions", "Users logged in on this server", lambda: len(presence.local))
+metrics.gauge("chat_rooms", "Rooms with at least one member", lambda: len(rooms))
+metrics.gauge("chat_idle_tracked_sessions", "Sessions watched for inactivity", lambda: len(idle_sessions))
+metrics.gauge("chat_auth_queue_depth", "Logins waiting for a password hashing worker", auth_pool.queue_depth)
+metrics.gauge("chat_offline_pending_messages", "Messages waiting for offline users",
+              lambda: offline_store.stats()["pending_messages"])
+metrics.gauge("chat_history_pending_writes", "Messages not yet written to the history database",
+              lambda: len(history_store.pending))
 
 def get_supported_versions():
-    return [1]  # Add more versions as they become available
-
-async def choose_compatible_version(client_versions, conn, stream_id):
+    return [pdu.VERSION_JSON, pdu.VERSION_BINARY]  # Add more versions as they become available
+
+def get_supported_features():
+    features = [pdu.FEATURE_PRESENCE_DELTA, pdu.FEATURE_ROOMS, pdu.FEATURE_STREAMS, pdu.FEATURE_QUIC_KEEPALIVE,
+                pdu.FEATURE_DATAGRAMS]
+    if history_store.enabled:
+        features.append(pdu.FEATURE_HISTORY)
+    if batch_config.enabled:
+        features.append(pdu.FEATURE_BATCH)
+    if pdu.compressor.enabled:
+        features.append(pdu.FEATURE_COMPRESSION)
+    return features
+
+async def choose_compatible_version(client_versions, conn, stream_id, client_features=()):
     common_versions = set(client_versions).intersection(get_supported_versions())
     if common_versions:
         selected_version = max(common_versions)  # Select the highest compatible version
-        await send_response(conn, stream_id, pdu.MSG_TYPE_VERSIONS, json.dumps({"selected_version": selected_version}), version=1)
+        features = [f for f in get_supported_features() if f in client_features
+                    and (f not in pdu.BINARY_ONLY_FEATURES or selected_version >= pdu.VERSION_BINARY)]
+        # The reply still uses version 1 since the client does not know the outcome yet
+        await send_response(conn, stream_id, pdu.MSG_TYPE_VERSIONS,
+                            json.dumps({"selected_version": selected_version, "features": features}), version=1)
+        conn.version = selected_version
+        conn.features = set(features)
+        conn.compress = pdu.FEATURE_COMPRESSION in conn.features
+        conn.separate_streams = pdu.FEATURE_STREAMS in conn.features
+        conn.datagrams = pdu.FEATURE_DATAGRAMS in conn.features and conn.send_datagram is not None
+        if pdu.FEATURE_BATCH in conn.features and conn.enable_batching is not None:
+            conn.enable_batching()
         return selected_version
     else:
         await send_response(conn, stream_id, pdu.MSG_TYPE_VERSIONS, json.dumps({"error": "No compatible version"}), version=1)
         return None
 
-active_user_connections = {}
+DISPATCH_DIRECT = "direct"  # PDUs are handled from the QUIC event callback, see ServerSession
+DISPATCH_QUEUE = "queue"  # PDUs wait in a queue for the connection's coroutine
+DISPATCH_MODES = (DISPATCH_DIRECT, DISPATCH_QUEUE)
+CLOSED_STATES = (ConnectionState.DISCONNECTED, ConnectionState.ERROR)
 
-async def chat_server_proto(scope: Dict, conn: ChatQuicConnection):
-    if conn.state == ConnectionState.DISCONNECTED:
-        await conn.start_connection()
 
-    while conn.state not in [ConnectionState.DISCONNECTED, ConnectionState.ERROR]:
-        try:
-            message: QuicStreamEvent = await conn.receive()
-            if message:
-
-                # print(f"[svr] Message received: {message.data}")
-                dgram_in = pdu.Datagram.from_bytes(message.data)
-                # print(f"[svr] Processing message of type {dgram_in.mtype}.")
-
-
-                if dgram_in.mtype == pdu.MSG_TYPE_VERSIONS:
-                    client_versions = json.loads(dgram_in.msg)['versions']
-                    selected_version = await choose_compatible_version(client_versions, conn, message.stream_id)
-                    if not selected_version:
-                        break  # End connection if no compatible version found
-                    print("Negotiate version successful on version ", selected_version)
-
-                elif dgram_in.mtype == pdu.MSG_TYPE_LOGIN:
-                    user_id = await handle_login(dgram_in, conn, message)
-                    if user_id:
-                        conn.recover_from_error()
-                        conn.authenticate()
-                    else:
-                        await conn.disconnect()
+class DispatchConfig:
+    def __init__(self, mode=DISPATCH_DIRECT):
+        self.mode = mode
 
-                elif dgram_in.mtype == pdu.MSG_TYPE_ONE_TO_ONE:
-                    await handle_one_to_one(dgram_in, conn, message, user_id)
-                    if conn.state != ConnectionState.SENDING_MESSAGE:
-                        conn.update_state(ConnectionState.SENDING_MESSAGE)
+    def configure(self, mode=None):
+        if mode is not None:
+            self.mode = mode
 
 
-                elif dgram_in.mtype == pdu.MSG_TYPE_ONE_TO_MANY:
-                    await handle_one_to_many(dgram_in, conn, message, user_id)
-                    if conn.state != ConnectionState.SENDING_MESSAGE:
-                        conn.update_state(ConnectionState.SENDING_MESSAGE)
+dispatch_config = DispatchConfig()
 
 
-                elif dgram_in.mtype == pdu.MSG_TYPE_BROADCAST:
-                    await handle_broadcast_message(dgram_in, conn, message, user_id)
-                    if conn.state != ConnectionState.SENDING_MESSAGE:
-                        conn.update_state(ConnectionState.SENDING_MESSAGE)
+class ServerSession:
+    """
+    Chat protocol state of one connection. Each PDU goes to the handler
+    registered for its type in HANDLERS, called as handler(session, message).
+    A handler either finishes before it returns, or returns an awaitable that
+    must complete before the next PDU of the connection is handled; async
+    handlers return their coroutine that way.
+    """
 
+    def __init__(self, conn: ChatQuicConnection):
+        self.conn = conn
+        self.user_id = None
+        self.track_idle = False  # Clients on application keep-alives are watched for silence here
+        self.limit = sender_limits.bucket()  # Rate of FAN_OUT_TYPES messages, checked before fan-out
+        self.done = False
 
-                elif dgram_in.mtype == pdu.MSG_TYPE_LOGOUT:
-                    if await handle_logout(conn, message, user_id):
-                        break  # Exit the loop to end the connection
-
-                elif dgram_in.mtype == pdu.MSG_TYPE_ALIVE:
-                    await handle_keep_alive(user_id)
+    def on_message(self, message: QuicStreamEvent):
+        # Returns None once the PDU is handled, otherwise what is left to await
+        if self.done:
+            return None
+        dgram_in = message.datagram
+        if dgram_in is None or self.conn.state in CLOSED_STATES:
+            self.finish()  # Peer finished the stream, or the connection is closing
+            return None
+        if self.track_idle:
+            idle_sessions.touch(self.user_id)
+        type_name = pdu.message_type_name(dgram_in.mtype)
+        MESSAGES_RECEIVED.labels(type_name).inc()
+        handler = HANDLERS.get(dgram_in.mtype)
+        if handler is None:
+            log.warning("unknown_message_type", mtype=dgram_in.mtype, user_id=self.user_id)
+            return None
+        if self.limit is not None and dgram_in.mtype in pdu.FAN_OUT_TYPES and not self.limit.take():
+            self.refuse(message, type_name)
+            return None
+        if pdu.traffic_class(dgram_in.mtype) != pdu.TRAFFIC_CONTROL and self.conn.state != ConnectionState.SENDING_MESSAGE:
+            self.conn.update_state(ConnectionState.SENDING_MESSAGE)
+        started = time.perf_counter()
+        try:
+            with message_type(type_name):
+                pending = handler(self, message)
+        except Exception as e:
+            self.fail(e)
+            return None
+        if pending is None:
+            HANDLER_SECONDS.labels(type_name).observe(time.perf_counter() - started)
+            return None
+        return self.complete(pending, type_name, started)
 
-                else:
-                    print("[svr] Unknown message type")
+    async def complete(self, pending, type_name, started):
+        try:
+            with message_type(type_name):
+                await pending
         except Exception as e:
-            print(f"Error processing message: {e}")
-            break
+            self.fail(e)
+        finally:
+            HANDLER_SECONDS.labels(type_name).observe(time.perf_counter() - started)
+
+    def refuse(self, message, type_name):
+        # Over the rate limit: nothing is fanned out, and ephemeral messages are dropped silently
+        RATE_LIMITED.labels(type_name).inc()
+        if log.debug_enabled:
+            log.debug("rate_limited", user_id=self.user_id, type=type_name)
+        if message.datagram.mtype not in pdu.EPHEMERAL_TYPES:
+            queue_response(self.conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL,
+                           json.dumps({"error": "Rate limit exceeded"}))
+
+    def fail(self, error):
+        log.error("message_error", error=repr(error), user_id=self.user_id)
+        self.finish()
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        if log.debug_enabled:
+            log.debug("connection_closed", user_id=self.user_id)
+        if self.user_id is not None:
+            end_session(self.user_id, self.conn)
+
+
+async def chat_server_proto(scope: Dict, conn: ChatQuicConnection):
+    session = ServerSession(conn)
+    if conn.state == ConnectionState.DISCONNECTED:
+        await conn.start_connection()
+
+    if dispatch_config.mode == DISPATCH_DIRECT and conn.dispatch_directly is not None:
+        # From here on the QUIC layer calls the session for every PDU
+        conn.dispatch_directly(session.on_message)
+        return
+
+    while not session.done and conn.state not in CLOSED_STATES:
+        pending = session.on_message(await conn.receive())
+        if pending is not None:
+            await pending
+    session.finish()
 
-    print("[Server] Connection closed or error occurred.")
+
+def forget_user(user_id):
+    # Drop a user from presence and from every room, None if not logged in
+    session = presence.remove(user_id)
+    if session is not None:
+        rooms.leave_all(user_id)
+    return session
+
+
+def end_session(user_id, conn):
+    # The connection ended without a LOGOUT: closed by the peer, dropped by the
+    # QUIC idle timeout, or failed. Reaped and logged out sessions are gone already.
+    session = presence.get_local(user_id)
+    if session is None or session.conn is not conn:
+        return
+    forget_user(user_id)
+    idle_sessions.forget(user_id)
+    broadcast_departures([session])
+    publish_presence(False, session)
+    SESSIONS_LOST.inc()
+    log.info("session_lost", user_id=user_id, username=session.username)
+
+
+async def handle_versions(session, message):
+    versions_request = json.loads(message.datagram.msg)
+    selected_version = await choose_compatible_version(versions_request['versions'], session.conn, message.stream_id,
+                                                       versions_request.get('features', []))
+    if not selected_version:
+        session.finish()  # End connection if no compatible version found
+        return
+    if log.debug_enabled:
+        log.debug("version_negotiated", version=selected_version, features=",".join(session.conn.features))
+
+
+async def start_session(session, message):
+    conn = session.conn
+    user_id = await handle_login(message.datagram, conn, message)
+    if user_id:
+        session.user_id = user_id
+        # Clients with QUIC keep-alives are covered by the QUIC idle timeout
+        session.track_idle = pdu.FEATURE_QUIC_KEEPALIVE not in conn.features
+        if session.track_idle:
+            idle_sessions.touch(user_id)
+        if conn.state == ConnectionState.CONNECTING:
+            # LOGIN arrived as 0-RTT data before the handshake finished
+            await conn.wait_for(ConnectionState.CONNECTED, ConnectionState.ERROR)
+        conn.recover_from_error()
+        conn.authenticate()
+    else:
+        await conn.disconnect()
 
 
 MAX_LOGIN_ATTEMPTS = 3  # Maximum number of allowed login attempts
@@ -88,12 +247,21 @@ MAX_LOGIN_ATTEMPTS = 3  # Maximum number of allowed login attempts
 async def handle_login(dgram_in, conn, message):
     attempt_count = 0
     while attempt_count < MAX_LOGIN_ATTEMPTS:
+        started = time.perf_counter()
         try:
             credentials = json.loads(dgram_in.msg)
             username = credentials['username']
             password = credentials['password']
 
-            if await is_user_authenticated(username, password):
+            try:
+                authenticated = await is_user_authenticated(username, password)
+                failure_reason = "Invalid credentials"
+            except AuthPoolBusy:
+                authenticated = False
+                failure_reason = "Server busy"
+                log.warning("login_rejected", reason="auth pool saturated", queue=auth_pool.queue_depth())
+
+            if authenticated:
                 if await is_user_already_logged_in(username):
                     attempt_count += 1
                     if attempt_count < MAX_LOGIN_ATTEMPTS:
@@ -101,30 +269,34 @@ async def handle_login(dgram_in, conn, message):
                                                f"User already logged in. Attempts left: {MAX_LOGIN_ATTEMPTS - attempt_count}")
                     else:
                         await send_login_failure(conn, message.stream_id, "Maximum login attempts exceeded.")
+                    LOGIN_SECONDS.labels("rejected").observe(time.perf_counter() - started)
 
                     conn.handle_error()
                     new_message = await asyncio.wait_for(conn.receive(), timeout=60)
-                    dgram_in = pdu.Datagram.from_bytes(new_message.data)
+                    dgram_in = new_message.datagram
 
                 else:
                     user_id = user_db.generate_unique_user_id()
-                    user_db.add_active_user(user_id, username)
-                    await broadcast_active_users(True)
-                    active_users = user_db.get_active_users()
-                    active_user_connections[user_id] = (conn, message.stream_id)
-                    await send_response(conn, message.stream_id, pdu.MSG_TYPE_LOGIN_ACK, json.dumps(active_users))
+                    session = presence.add(user_id, username, conn, message.stream_id)
+                    broadcast_active_users(True, session)
+                    publish_presence(True, session)
+                    await send_login_success(conn, message.stream_id)
+                    LOGIN_SECONDS.labels("success").observe(time.perf_counter() - started)
+                    log.info("login", user_id=user_id, username=username)
+                    await deliver_offline_messages(session)
                     return user_id
             else:
                 attempt_count += 1
                 if attempt_count < MAX_LOGIN_ATTEMPTS:
                     await send_login_retry(conn, message.stream_id,
-                                           f"Invalid credentials. Attempts left: {MAX_LOGIN_ATTEMPTS - attempt_count}")
+                                           f"{failure_reason}. Attempts left: {MAX_LOGIN_ATTEMPTS - attempt_count}")
                 else:
                     await send_login_failure(conn, message.stream_id, "Maximum login attempts exceeded.")
+                LOGIN_SECONDS.labels("failed").observe(time.perf_counter() - started)
 
                 conn.handle_error()
                 new_message = await asyncio.wait_for(conn.receive(), timeout=60)
-                dgram_in = pdu.Datagram.from_bytes(new_message.data)
+                dgram_in = new_message.datagram
 
 
         except json.JSONDecodeError:
@@ -154,8 +326,11 @@ async def send_login_failure(conn, stream_id, error_message):
 
 
 async def send_login_success(conn, stream_id):
-    active_users = user_db.get_active_users()
-    await send_response(conn, stream_id, pdu.MSG_TYPE_LOGIN_ACK, json.dumps(active_users))
+    if pdu.FEATURE_PRESENCE_DELTA in conn.features:
+        # Delta clients need the roster version to apply later deltas to
+        await send_response(conn, stream_id, pdu.MSG_TYPE_LOGIN_ACK, presence.snapshot_json())
+    else:
+        await send_response(conn, stream_id, pdu.MSG_TYPE_LOGIN_ACK, presence.roster_json())
 
 
 async def handle_login_failure(conn, message):
@@ -165,114 +340,591 @@ async def handle_login_failure(conn, message):
         conn.update_state(ConnectionState.DISCONNECTED)
         await conn.close()
 
-async def handle_one_to_one(dgram_in, conn, message, user_id):
+def handle_one_to_one(session, message):
+    conn, user_id, dgram_in = session.conn, session.user_id, message.datagram
     if user_id is None:
-        await send_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "User not authenticated"}))
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "User not authenticated"}))
         return
 
     message_content = json.loads(dgram_in.msg)
     message_type = dgram_in.mtype
     target_user_id = int(message_content['target_user_id'])
     msg = message_content['msg']
+    payload = forward_payload(user_id, msg)
 
-    if target_user_id in user_db.active_users:
-        await send_message_to_target_user(conn, message_type, message, target_user_id, user_id, msg)
-    else:
+    if target_user_id not in presence:
+        # Only storing the message for later has to wait
+        return store_one_to_one(conn, message, target_user_id, user_id, payload)
+    send_message_to_target_user(conn, message_type, message, target_user_id, user_id, payload)
+    conversation = pdu.direct_conversation(presence.get_username(user_id), presence.last_username(target_user_id))
+    record_history(conversation, user_id, message_type, payload)
+
+async def store_one_to_one(conn, message, target_user_id, user_id, payload):
+    if not await store_offline_message(target_user_id, pdu.MSG_TYPE_ONE_TO_ONE, payload):
         await send_unsuccessful_message_to_sender(conn, message, target_user_id)
+        return
+    conversation = pdu.direct_conversation(presence.get_username(user_id), presence.last_username(target_user_id))
+    record_history(conversation, user_id, pdu.MSG_TYPE_ONE_TO_ONE, payload)
 
-async def handle_one_to_many(dgram_in, conn, message, user_id):
+def handle_one_to_many(session, message):
+    conn, user_id, dgram_in = session.conn, session.user_id, message.datagram
     if user_id is None:
-        await send_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "User not authenticated"}))
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "User not authenticated"}))
         return
 
     message_content = json.loads(dgram_in.msg)
     message_type = dgram_in.mtype
     target_user_ids = [int(uid) for uid in message_content['target_user_ids'].split(',')]
     msg = message_content['msg']
+    payload = forward_payload(user_id, msg)
 
+    targets = []
+    offline = []
+    members = [presence.get_username(user_id)]
     for target_user_id in target_user_ids:
-        if target_user_id in user_db.active_users:
-            await send_message_to_target_user(conn, message_type, message, target_user_id, user_id, msg)
+        target_session = presence.get(target_user_id)
+        if target_session is not None:
+            targets.append(target_session)
+            members.append(presence.last_username(target_user_id))
+        else:
+            offline.append(target_user_id)
+    route(targets, message_type, payload, user_id)
+    if offline:
+        return store_one_to_many(conn, message, offline, user_id, members, payload)
+    if len(members) > 1:
+        record_history(pdu.group_conversation(members), user_id, message_type, payload)
+
+async def store_one_to_many(conn, message, target_user_ids, user_id, members, payload):
+    for target_user_id in target_user_ids:
+        if await store_offline_message(target_user_id, pdu.MSG_TYPE_ONE_TO_MANY, payload):
+            members.append(presence.last_username(target_user_id))
         else:
             await send_unsuccessful_message_to_sender(conn, message, target_user_id)
+    if len(members) > 1:
+        record_history(pdu.group_conversation(members), user_id, pdu.MSG_TYPE_ONE_TO_MANY, payload)
 
-async def handle_broadcast_message(dgram_in, conn, message, user_id):
+def handle_broadcast_message(session, message):
+    conn, user_id, dgram_in = session.conn, session.user_id, message.datagram
     if user_id is None:
-        await send_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "User not authenticated"}))
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "User not authenticated"}))
         return
 
     message_content = json.loads(dgram_in.msg)
     message_type = dgram_in.mtype
     msg = message_content['msg']
-    for target_user_id in user_db.active_users.keys():
-        await send_message_to_target_user(conn, message_type, message, target_user_id, user_id, msg)
+    payload = forward_payload(user_id, msg)
+    fan_out(presence.local_sessions(), message_type, payload, user_id)
+    backplane.publish({"op": "deliver", "user_ids": None, "mtype": message_type, "msg": payload,
+                       "sender_user_id": user_id})
+    record_history(pdu.BROADCAST_CONVERSATION, user_id, message_type, payload)
+
+
+def handle_room_join(session, message):
+    conn, user_id, dgram_in = session.conn, session.user_id, message.datagram
+    if user_id is None:
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "User not authenticated"}))
+        return
+    room = json.loads(dgram_in.msg).get("room")
+    if not rooms.valid_name(room):
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "Invalid room name"}))
+        return
+    if not rooms.is_member(room, user_id):
+        if len(rooms.rooms_for(user_id)) >= MAX_ROOMS_PER_USER:
+            queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "Too many rooms"}))
+            return
+        rooms.join(room, presence.get(user_id))
+        backplane.publish({"op": "room", "event": "join", "room": room, "user_id": user_id})
+    queue_response(conn, message.stream_id, pdu.MSG_TYPE_ROOM_ACK,
+                   json.dumps({"room": room, "event": "join", "members": rooms.size(room)}))
+
+def handle_room_leave(session, message):
+    conn, user_id, dgram_in = session.conn, session.user_id, message.datagram
+    if user_id is None:
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "User not authenticated"}))
+        return
+    room = json.loads(dgram_in.msg).get("room")
+    if not rooms.valid_name(room):
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "Invalid room name"}))
+        return
+    if not rooms.leave(room, user_id):
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "Not a member of this room"}))
+        return
+    backplane.publish({"op": "room", "event": "leave", "room": room, "user_id": user_id})
+    queue_response(conn, message.stream_id, pdu.MSG_TYPE_ROOM_ACK, json.dumps({"room": room, "event": "leave"}))
+
+def handle_room_message(session, message):
+    conn, user_id, dgram_in = session.conn, session.user_id, message.datagram
+    if user_id is None:
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "User not authenticated"}))
+        return
+
+    message_content = json.loads(dgram_in.msg)
+    room = message_content.get("room")
+    if not rooms.valid_name(room):
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "Invalid room name"}))
+        return
+    if not rooms.is_member(room, user_id):
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "Not a member of this room"}))
+        return
+    payload = forward_payload(user_id, message_content['msg'], room=room)
+    # The sender gets the message too, like a broadcast
+    route(rooms.sessions(room), dgram_in.mtype, payload, user_id)
+    record_history(pdu.room_conversation(room), user_id, dgram_in.mtype, payload)
 
 
-async def handle_logout(conn, message, user_id):
-    if user_id is not None and user_id in active_user_connections:
-        print(user_id, " logout")
+async def handle_logout(session, message):
+    conn, user_id = session.conn, session.user_id
+    if user_id is not None and user_id in presence:
+        log.info("logout", user_id=user_id)
         # Set state to DISCONNECTING
         conn.update_state(ConnectionState.DISCONNECTING)
         # Remove user from active connections and perform cleanup
-        del active_user_connections[user_id]
-        user_db.remove_active_user(user_id)
+        departed = forget_user(user_id)
+        idle_sessions.forget(user_id)
         # Broadcast the updated list of active users
-        await broadcast_active_users(False)
+        broadcast_active_users(False, departed)
+        publish_presence(False, departed)
         # Notify client of successful logout
         await send_response(conn, message.stream_id, pdu.MSG_TYPE_LOGOUT_ACK, json.dumps({"sys": "Logout successful"}))
         # Fully disconnect after cleanup
         conn.update_state(ConnectionState.DISCONNECTED)
-        return True
-    return False
+        session.finish()
+
+def handle_keep_alive(session, message):
+    # Activity was already recorded when the PDU arrived
+    if log.debug_enabled:
+        log.debug("keep_alive", user_id=session.user_id)
+
+def handle_typing(session, message):
+    # Best effort like the indicator itself: no reply, nothing stored, and
+    # unknown targets are ignored
+    user_id = session.user_id
+    if user_id is None:
+        return
+    request = json.loads(message.datagram.msg)
+    payload = {"user_id": user_id, "username": presence.get_username(user_id)}
+    room = request.get("room")
+    if room is not None:
+        if not rooms.valid_name(room) or not rooms.is_member(room, user_id):
+            return
+        targets = [member for member in rooms.sessions(room) if member.user_id != user_id]
+        payload["room"] = room
+    else:
+        target_user_id = request.get("target_user_id")
+        target = presence.get(target_user_id) if isinstance(target_user_id, int) else None
+        if target is None:
+            return
+        targets = [target]
+    route(targets, pdu.MSG_TYPE_TYPING, json.dumps(payload), user_id)
+
+def handle_presence_snapshot_request(session, message):
+    conn = session.conn
+    if session.user_id is None:
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "User not authenticated"}))
+        return
+    queue_response(conn, message.stream_id, pdu.MSG_TYPE_PRESENCE_SNAPSHOT, presence.snapshot_json())
+
+async def handle_history_request(session, message):
+    conn, user_id, dgram_in = session.conn, session.user_id, message.datagram
+    if user_id is None:
+        await send_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "User not authenticated"}))
+        return
+    if not history_store.enabled:
+        await send_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "History is not available"}))
+        return
 
-async def handle_keep_alive(user_id):
-    print(user_id, " keep alive")
+    request = json.loads(dgram_in.msg)
+    limit = max(0, min(int(request.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE))
+    username = presence.get_username(user_id)
+    conversation = request.get("conversation")
+    if conversation is None:
+        # Catch-up across all of the user's conversations
+        messages, cursor, has_more = await history_store.catch_up(username, request.get("after"), limit)
+    else:
+        if not can_read_history(user_id, username, conversation):
+            await send_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "Not a member of this conversation"}))
+            return
+        messages, cursor, has_more = await history_store.page(conversation, request.get("before"), limit)
+    await send_response(conn, message.stream_id, pdu.MSG_TYPE_HISTORY,
+                        json.dumps({"conversation": conversation, "messages": messages,
+                                    "cursor": cursor, "has_more": has_more}))
+
+def can_read_history(user_id, username, conversation):
+    if not isinstance(conversation, str):
+        return False
+    if conversation == pdu.BROADCAST_CONVERSATION:
+        return True
+    room = pdu.conversation_room(conversation)
+    if room is not None:
+        return rooms.is_member(room, user_id)
+    members = pdu.conversation_members(conversation)
+    return members is not None and username in members
+
+# Handler for each PDU type, see ServerSession
+HANDLERS = {
+    pdu.MSG_TYPE_VERSIONS: handle_versions,
+    pdu.MSG_TYPE_LOGIN: start_session,
+    pdu.MSG_TYPE_ONE_TO_ONE: handle_one_to_one,
+    pdu.MSG_TYPE_ONE_TO_MANY: handle_one_to_many,
+    pdu.MSG_TYPE_BROADCAST: handle_broadcast_message,
+    pdu.MSG_TYPE_ROOM_MESSAGE: handle_room_message,
+    pdu.MSG_TYPE_ROOM_JOIN: handle_room_join,
+    pdu.MSG_TYPE_ROOM_LEAVE: handle_room_leave,
+    pdu.MSG_TYPE_LOGOUT: handle_logout,
+    pdu.MSG_TYPE_ALIVE: handle_keep_alive,
+    pdu.MSG_TYPE_TYPING: handle_typing,
+    pdu.MSG_TYPE_PRESENCE_SNAPSHOT_REQUEST: handle_presence_snapshot_request,
+    pdu.MSG_TYPE_HISTORY_REQUEST: handle_history_request,
+}
 
 # Response Sending Functions
-async def send_response(conn, stream_id, message_type, message, version=1):
+async def send_response(conn, stream_id, message_type, message, version=None):
+    if version is None:
+        version = conn.version
     response = pdu.Datagram(message_type, message, version)
-    await conn.send(QuicStreamEvent(stream_id, response.to_bytes(), False))
-
-
-async def send_message_to_target_user(conn, message_type, message, target_user_id, user_id, msg, version=1):
-    target_user_name = user_db.get_username(target_user_id)
-    target_conn, stream_id = active_user_connections.get(target_user_id)  # Get the connection for the target user
-    if target_conn is not None:
-        sender_username = user_db.get_username(user_id)
-        forward_message = pdu.Datagram(message_type,
-                                       json.dumps({"sender_user_id": user_id,
-                                                   "sender_username": sender_username,
-                                                   "msg": msg}), version)
-        print("send to ", target_user_name)
-        await target_conn.send(QuicStreamEvent(stream_id, forward_message.to_bytes(), False))
+    MESSAGES_SENT.labels(pdu.message_type_name(message_type)).inc()
+    await conn.send(QuicStreamEvent(stream_id, response.to_bytes(conn.compress), False))
+
+def queue_response(conn, stream_id, message_type, message):
+    # send_response for handlers that do not await, goes out with the next transmit
+    response = pdu.Datagram(message_type, message, conn.version)
+    MESSAGES_SENT.labels(pdu.message_type_name(message_type)).inc()
+    conn.send_nowait(QuicStreamEvent(stream_id, response.to_bytes(conn.compress), False))
+
+
+def send_message_to_target_user(conn, message_type, message, target_user_id, user_id, payload):
+    target_session = presence.get(target_user_id)  # Get the connection for the target user
+    if target_session is not None and not target_session.is_local():
+        # Connected to another node, which will report back if the user is gone
+        backplane.send(target_session.node, {"op": "deliver", "user_ids": [target_user_id],
+                                             "mtype": message_type, "msg": payload,
+                                             "sender_user_id": user_id, "sender_node": backplane.node_id})
+    elif target_session is not None:
+        target_conn = target_session.conn
+        forward_message = pdu.Datagram(message_type, payload, target_conn.version)
+        MESSAGES_SENT.labels(pdu.message_type_name(message_type)).inc()
+        if log.debug_enabled:
+            log.debug("deliver", to=target_session.username, type=pdu.message_type_name(message_type))
+        target_conn.send_nowait(QuicStreamEvent(target_conn.stream_for(message_type),
+                                                forward_message.to_bytes(target_conn.compress), False,
+                                                traffic=pdu.traffic_class(message_type), sender=user_id))
     else:
-        print("unable to send to ", target_user_name)
-        await send_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "Target user connection not available"}), version)
+        if log.debug_enabled:
+            log.debug("undeliverable", to=target_user_id)
+        queue_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "Target user connection not available"}))
+
+def forward_payload(user_id, msg, room=None):
+    # The id lets clients drop copies of a message they get twice, e.g. as an
+    # offline delivery and again in a history catch-up
+    payload = {"sender_user_id": user_id,
+               "sender_username": presence.get_username(user_id),
+               "msg": msg,
+               "id": os.urandom(8).hex()}
+    if room is not None:
+        payload["room"] = room
+    return json.dumps(payload)
+
+
+def fan_out(targets, message_type, message, sender=None):
+    """
+    Deliver one message to many sessions. The payload is encoded (and
+    compressed) once per protocol version and compression setting, and the
+    same bytes are queued on every stream; transmits are coalesced per
+    connection until the next event-loop tick. Ephemeral messages go in
+    DATAGRAM frames where the connection agreed on them. Each connection's
+    outbound scheduler shares its stream time fairly between senders, so
+    messages from users should name the sender.
+    """
+    if not targets:
+        return
+    FANOUT_WIDTH.observe(len(targets))
+    MESSAGES_SENT.labels(pdu.message_type_name(message_type)).inc(len(targets))
+    encoded = {}
+    ephemeral = message_type in pdu.EPHEMERAL_TYPES
+    traffic = pdu.traffic_class(message_type)
+    for session in targets:
+        target_conn = session.conn
+        encoding = (target_conn.version, target_conn.compress)
+        data = encoded.get(encoding)
+        if data is None:
+            data = pdu.Datagram(message_type, message, target_conn.version).to_bytes(target_conn.compress)
+            encoded[encoding] = data
+        if ephemeral:
+            target_conn.send_ephemeral(message_type, data, sender)
+        else:
+            target_conn.send_nowait(QuicStreamEvent(target_conn.stream_for(message_type), data, False,
+                                                    traffic=traffic, sender=sender))
+
+
+def route(targets, message_type, message, sender=None):
+    # Local sessions are fanned out here, the rest are grouped per node so
+    # each node gets a single backplane message.
+    local = []
+    remote = {}
+    for session in targets:
+        if session.is_local():
+            local.append(session)
+        else:
+            remote.setdefault(session.node, []).append(session.user_id)
+    fan_out(local, message_type, message, sender)
+    for node, user_ids in remote.items():
+        backplane.send(node, {"op": "deliver", "user_ids": user_ids, "mtype": message_type, "msg": message,
+                              "sender_user_id": sender})
+
+
+async def store_offline_message(target_user_id, message_type, message):
+    # A user who was logged in before and is offline now gets the message on
+    # their next login. Returns False if it could not be stored.
+    username = presence.last_username(target_user_id)
+    if username is None or not offline_store.enabled or presence.is_logged_in(username):
+        return False
+    try:
+        await offline_store.append(username, message_type, message)
+    except InboxFull:
+        log.warning("inbox_full", to=username)
+        return False
+    except OSError as e:
+        log.error("offline_store_failed", to=username, error=repr(e))
+        return False
+    if log.debug_enabled:
+        log.debug("stored_offline", to=username)
+    return True
+
+
+async def deliver_offline_messages(session):
+    # Pending messages follow MSG_TYPE_LOGIN_ACK, oldest first
+    if not offline_store.enabled or not offline_store.has_pending(session.username):
+        return
+    messages = await offline_store.fetch(session.username)
+    if not messages:
+        return
+    for seq, message_type, message in messages:
+        route([session], message_type, message)
+    offline_store.mark_delivered(session.username, messages[-1][0])
+    log.info("offline_delivered", to=session.username, count=len(messages))
+
+
+def record_history(conversation, user_id, message_type, payload):
+    if history_store.enabled:
+        history_store.record(conversation, presence.get_username(user_id), message_type, payload)
+
 
 async def send_unsuccessful_message_to_sender(conn, message, target_user_id):
-    print("Target user not available")
+    if log.debug_enabled:
+        log.debug("undeliverable", to=target_user_id)
     await send_response(conn, message.stream_id, pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "Target user not available"}))
 
 # User Authentication Functions
 async def is_user_authenticated(username, password):
-    return user_db.authenticate(username, password)
+    return await user_db.authenticate_async(username, password)
 
 async def is_user_already_logged_in(username):
-    active_users = user_db.get_active_users()
-    return username in [user['username'] for user in active_users]
+    return presence.is_logged_in(username)
 
 # Broadcast Functions
-async def broadcast_active_users(user_login: bool, version=1):
+def broadcast_active_users(user_login: bool, session):
+    # Clients that negotiated presence deltas get a small join/leave event,
+    # older clients still get the whole roster. Must run right after the
+    # change, so the delta carries the roster version it created.
+    delta_targets, roster_targets = presence_targets(session.user_id)
+    if delta_targets:
+        delta = json.dumps({"seq": presence.version,
+                            "event": "join" if user_login else "leave",
+                            "user_id": session.user_id,
+                            "username": session.username})
+        fan_out(delta_targets, pdu.MSG_TYPE_PRESENCE_DELTA, delta)
+
+    if roster_targets:
+        if user_login:
+            message_type = pdu.MSG_TYPE_LOGIN_BROADCAST
+        else:
+            message_type = pdu.MSG_TYPE_LOGOUT_BROADCAST
+        fan_out(roster_targets, message_type, presence.roster_json())
+
+
+def presence_targets(exclude_user_id=None):
+    # Local sessions split by the kind of presence update they understand
+    delta_targets = []
+    roster_targets = []
+    for target in presence.local_sessions():
+        if target.user_id == exclude_user_id:
+            continue
+        if pdu.FEATURE_PRESENCE_DELTA in target.conn.features:
+            delta_targets.append(target)
+        else:
+            roster_targets.append(target)
+    return delta_targets, roster_targets
 
-    active_users = user_db.get_active_users()
 
-    if user_login:
-        active_users_message = pdu.Datagram(pdu.MSG_TYPE_LOGIN_BROADCAST, json.dumps(active_users), version)
+def broadcast_departures(sessions):
+    # One presence update per client for a whole batch of users that left.
+    # Must run right after the sessions were removed, so their leaves are the
+    # last len(sessions) roster versions.
+    if not sessions:
+        return
+    delta_targets, roster_targets = presence_targets()
+    if delta_targets:
+        events = [{"event": "leave", "user_id": s.user_id, "username": s.username} for s in sessions]
+        if len(events) == 1:
+            delta = json.dumps(dict(events[0], seq=presence.version))
+        else:
+            delta = json.dumps({"seq": presence.version, "events": events})
+        fan_out(delta_targets, pdu.MSG_TYPE_PRESENCE_DELTA, delta)
+    if roster_targets:
+        fan_out(roster_targets, pdu.MSG_TYPE_LOGOUT_BROADCAST, presence.roster_json())
+
+
+# Idle Session Reaping
+def start_idle_reaper():
+    idle_sessions.start(reap_idle_sessions)
+
+
+def reap_idle_sessions(user_ids):
+    # Sessions that sent nothing, not even a keep-alive, for the idle timeout
+    sessions = []
+    for user_id in user_ids:
+        session = presence.get_local(user_id)
+        if session is None:
+            continue
+        forget_user(user_id)
+        sessions.append(session)
+    if not sessions:
+        return
+    broadcast_departures(sessions)
+    backplane.publish({"op": "presence_leave", "user_ids": [s.user_id for s in sessions]})
+    for session in sessions:
+        session.conn.update_state(ConnectionState.DISCONNECTED)
+        session.conn.close()
+    IDLE_REAPED.inc(len(sessions))
+    log.info("idle_sessions_reaped", count=len(sessions), timeout=idle_sessions.timeout)
+    if log.debug_enabled:
+        log.debug("idle_sessions", usernames=[s.username for s in sessions])
+
+
+# Backplane Functions
+def attach_backplane(new_backplane):
+    global backplane
+    if backplane is not None:
+        backplane.close()
+    backplane = new_backplane
+    backplane.register("presence", handle_backplane_presence)
+    backplane.register("presence_leave", handle_backplane_presence_leave)
+    backplane.register("room", handle_backplane_room)
+    backplane.register("room_snapshot", handle_backplane_room_snapshot)
+    backplane.register("presence_sync", handle_backplane_presence_sync)
+    backplane.register("presence_snapshot", handle_backplane_presence_snapshot)
+    backplane.register("node_down", handle_backplane_node_down)
+    backplane.register("deliver", handle_backplane_deliver)
+    backplane.register("undeliverable", handle_backplane_undeliverable)
+    backplane.register("disconnected", handle_backplane_disconnected)
+    backplane.register("reconnected", handle_backplane_reconnected)
+    # Ask the nodes already running for their users
+    backplane.publish({"op": "presence_sync", "node": backplane.node_id})
+
+def publish_presence(user_login: bool, session):
+    backplane.publish({"op": "presence", "event": "join" if user_login else "leave",
+                       "user_id": session.user_id, "username": session.username, "node": backplane.node_id})
+
+def add_remote_user(user_id, username, node):
+    if presence.get(user_id) is None:
+        session = presence.add_remote(user_id, username, node)
+        broadcast_active_users(True, session)
+        # Messages this node stored while the user was offline
+        asyncio.ensure_future(deliver_offline_messages(session))
+
+def remove_remote_user(user_id):
+    session = forget_user(user_id)
+    if session is not None:
+        broadcast_active_users(False, session)
+
+def handle_backplane_presence(message):
+    if message["event"] == "join":
+        add_remote_user(message["user_id"], message["username"], message["node"])
     else:
-        active_users_message = pdu.Datagram(pdu.MSG_TYPE_LOGOUT_BROADCAST, json.dumps(active_users), version)
-    for (conn, stream_id) in active_user_connections.values():
-
-        await conn.send(QuicStreamEvent(stream_id, active_users_message.to_bytes(), False))
-
+        remove_remote_user(message["user_id"])
+
+def handle_backplane_presence_leave(message):
+    # Batch of users another node dropped at once
+    sessions = [s for s in map(forget_user, message["user_ids"]) if s is not None]
+    broadcast_departures(sessions)
+
+def handle_backplane_presence_sync(message):
+    send_local_users(lambda snapshot: backplane.send(message["node"], snapshot))
+
+def send_local_users(send):
+    users = [[s.user_id, s.username] for s in presence.local_sessions()]
+    send({"op": "presence_snapshot", "node": backplane.node_id, "users": users})
+    # Sent after the users so the other node knows their sessions
+    memberships = [[user_id, rooms.rooms_for(user_id)] for user_id, _ in users if rooms.rooms_for(user_id)]
+    if memberships:
+        send({"op": "room_snapshot", "memberships": memberships})
+
+def handle_backplane_room(message):
+    # Room membership of a user connected to another node
+    if message["event"] == "join":
+        session = presence.get(message["user_id"])
+        if session is not None:
+            rooms.join(message["room"], session)
+    else:
+        rooms.leave(message["room"], message["user_id"])
+
+def handle_backplane_room_snapshot(message):
+    for user_id, user_rooms in message["memberships"]:
+        session = presence.get(user_id)
+        if session is not None:
+            for room in user_rooms:
+                rooms.join(room, session)
+
+def handle_backplane_presence_snapshot(message):
+    for user_id, username in message["users"]:
+        add_remote_user(user_id, username, message["node"])
+
+def handle_backplane_node_down(message):
+    log.info("node_down", node=message["node"])
+    forget_nodes([message["node"]])
+
+def forget_nodes(nodes):
+    # Every user of nodes that left, announced to local clients in one update
+    sessions = []
+    for node in nodes:
+        sessions.extend(presence.remove_node(node))
+    for session in sessions:
+        rooms.leave_all(session.user_id)
+    broadcast_departures(sessions)
+
+def handle_backplane_disconnected(message):
+    # Cut off from the cluster: remote users can no longer be reached, and may
+    # log in here again
+    nodes = {session.node for session in presence.all_sessions() if not session.is_local()}
+    log.warning("backplane_lost", nodes=len(nodes))
+    forget_nodes(nodes)
+
+def handle_backplane_reconnected(message):
+    # The other nodes dropped this node's users when it went away
+    backplane.publish({"op": "presence_sync", "node": backplane.node_id})
+    send_local_users(backplane.publish)
+
+def handle_backplane_deliver(message):
+    if message["user_ids"] is None:
+        targets = presence.local_sessions()
+    else:
+        targets = []
+        for user_id in message["user_ids"]:
+            session = presence.get_local(user_id)
+            if session is not None:
+                targets.append(session)
+            elif "sender_node" in message:
+                # The user left before the message got here
+                backplane.send(message["sender_node"], {"op": "undeliverable", "target_user_id": user_id,
+                                                        "sender_user_id": message["sender_user_id"]})
+    fan_out(targets, message["mtype"], message["msg"], message.get("sender_user_id"))
+
+def handle_backplane_undeliverable(message):
+    session = presence.get_local(message["sender_user_id"])
+    if session is not None:
+        fan_out([session], pdu.MSG_TYPE_MSG_UNSUCCESSFUL, json.dumps({"error": "Target user not available"}))
+
+
+attach_backplane(InProcessBackplane())
 
 # End of chat_server.py
\ No newline at end of file
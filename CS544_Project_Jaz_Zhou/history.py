@@ -0,0 +1,219 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import pdu
+from log import log
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 0.01  # Seconds a recorded message may wait to share a transaction
+DEFAULT_MAX_BATCH = 500
+DEFAULT_CACHE_PAGES = 1024
+
+SQL_CREATE_MESSAGES = ("CREATE TABLE IF NOT EXISTS messages ("
+                       "seq INTEGER PRIMARY KEY AUTOINCREMENT, conversation TEXT NOT NULL, "
+                       "sender TEXT NOT NULL, mtype INTEGER NOT NULL, msg TEXT NOT NULL, ts REAL NOT NULL)")
+SQL_CREATE_MESSAGES_INDEX = "CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation, seq)"
+SQL_CREATE_MEMBERS = ("CREATE TABLE IF NOT EXISTS conversation_members ("
+                      "username TEXT NOT NULL, conversation TEXT NOT NULL, "
+                      "PRIMARY KEY (username, conversation)) WITHOUT ROWID")
+SQL_INSERT_MESSAGE = "INSERT INTO messages (conversation, sender, mtype, msg, ts) VALUES (?, ?, ?, ?, ?)"
+SQL_INSERT_MEMBER = "INSERT OR IGNORE INTO conversation_members (username, conversation) VALUES (?, ?)"
+SQL_HEAD = "SELECT COALESCE(MAX(seq), 0) FROM messages"
+SQL_CONVERSATION_HEAD = "SELECT MAX(seq) FROM messages WHERE conversation = ?"
+SQL_PAGE = ("SELECT seq, conversation, sender, mtype, msg, ts FROM messages "
+            "WHERE conversation = ? AND seq < ? ORDER BY seq DESC LIMIT ?")
+SQL_CATCH_UP = ("SELECT seq, conversation, sender, mtype, msg, ts FROM messages "
+                "WHERE seq > ? AND (conversation = ? OR conversation IN "
+                "(SELECT conversation FROM conversation_members WHERE username = ?)) "
+                "ORDER BY seq LIMIT ?")
+
+
+def row_to_message(row) -> Dict:
+    seq, conversation, sender, mtype, msg, ts = row
+    return {"seq": seq, "conversation": conversation, "sender": sender, "mtype": mtype, "msg": msg, "ts": ts}
+
+
+class PageCache:
+    """
+    LRU cache of history pages. A page is keyed by the exclusive cursor it ends
+    at; messages only ever get higher sequence numbers, so a cached page never
+    goes stale.
+    """
+
+    def __init__(self, capacity=DEFAULT_CACHE_PAGES):
+        self.capacity = capacity
+        self.pages: "OrderedDict[Tuple[str, int, int], Tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        page = self.pages.get(key)
+        if page is None:
+            self.misses += 1
+            return None
+        self.pages.move_to_end(key)
+        self.hits += 1
+        return page
+
+    def put(self, key, page):
+        self.pages[key] = page
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.capacity:
+            self.pages.popitem(last=False)
+
+
+class HistoryStore:
+    """
+    Message history in SQLite, indexed by (conversation, seq). Sequence numbers
+    come from the database, so several worker processes can share one file.
+    Recorded messages are buffered and inserted in batches, one transaction
+    per batch; every database call runs in order on one thread, so a query
+    always sees the batches submitted before it.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.path = None
+        self.lock = threading.Lock()
+        self.executor = None
+        self.flush_interval = DEFAULT_FLUSH_INTERVAL
+        self.max_batch = DEFAULT_MAX_BATCH
+        self.cache = PageCache()
+        self.pending: List[Tuple] = []
+        self.flush_handle = None
+        self.known_members = set()  # (username, conversation) pairs already stored
+        self.recorded = 0
+        self.batches = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.db is not None
+
+    def open(self, path, flush_interval=None, max_batch=None, cache_pages=None):
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if max_batch is not None:
+            self.max_batch = max_batch
+        if cache_pages is not None:
+            self.cache = PageCache(cache_pages)
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SQL_CREATE_MESSAGES)
+        self.db.execute(SQL_CREATE_MESSAGES_INDEX)
+        self.db.execute(SQL_CREATE_MEMBERS)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+
+    def record(self, conversation, sender, mtype, msg):
+        members = pdu.conversation_members(conversation) or ()
+        new_members = [(username, conversation) for username in members
+                       if (username, conversation) not in self.known_members]
+        self.known_members.update(new_members)
+        self.pending.append((conversation, sender, mtype, msg, time.time(), new_members))
+        self.recorded += 1
+        if len(self.pending) >= self.max_batch:
+            self._start_flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        self.batches += 1
+        future = asyncio.get_event_loop().run_in_executor(self.executor, self._insert_batch, batch)
+        future.add_done_callback(self._flush_done)
+
+    def _flush_done(self, future):
+        if future.exception() is not None:
+            log.warning("history_write_failed", error=repr(future.exception()))
+
+    def _insert_batch(self, batch):
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(SQL_INSERT_MESSAGE, (record[:5] for record in batch))
+                self.db.executemany(SQL_INSERT_MEMBER, (member for record in batch for member in record[5]))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    async def _query(self, func, *args):
+        # Pending messages go first so the query sees them
+        self._start_flush()
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def head(self) -> int:
+        return await self._query(self._head)
+
+    def _head(self):
+        with self.lock:
+            return self.db.execute(SQL_HEAD).fetchone()[0]
+
+    async def page(self, conversation, before: Optional[int], limit) -> Tuple[List[Dict], Optional[int], bool]:
+        # Up to limit messages older than the cursor, returned oldest first.
+        # The returned cursor continues further back.
+        return await self._query(self._page, conversation, before, limit)
+
+    def _page(self, conversation, before, limit):
+        with self.lock:
+            if before is None:
+                # The newest page is keyed by the conversation's current end, so
+                # it is served from the cache until the next message arrives
+                last = self.db.execute(SQL_CONVERSATION_HEAD, (conversation,)).fetchone()[0]
+                if last is None:
+                    return [], None, False
+                before = last + 1
+            key = (conversation, before, limit)
+            page = self.cache.get(key)
+            if page is None:
+                rows = self.db.execute(SQL_PAGE, (conversation, before, limit)).fetchall()
+                messages = [row_to_message(row) for row in reversed(rows)]
+                cursor = messages[0]["seq"] if messages else None
+                page = (messages, cursor, len(rows) == limit)
+                self.cache.put(key, page)
+            return page
+
+    async def catch_up(self, username, after: Optional[int], limit) -> Tuple[List[Dict], int, bool]:
+        # Messages newer than the cursor in every conversation of the user,
+        # oldest first. Without a cursor nothing is returned, only the current end.
+        return await self._query(self._catch_up, username, after, limit)
+
+    def _catch_up(self, username, after, limit):
+        with self.lock:
+            if after is None or limit <= 0:
+                return [], self.db.execute(SQL_HEAD).fetchone()[0], False
+            rows = self.db.execute(SQL_CATCH_UP, (after, pdu.BROADCAST_CONVERSATION, username, limit)).fetchall()
+        messages = [row_to_message(row) for row in rows]
+        cursor = messages[-1]["seq"] if messages else after
+        return messages, cursor, len(rows) == limit
+
+    def stats(self):
+        return {
+            "recorded": self.recorded,
+            "batches": self.batches,
+            "pending": len(self.pending),
+            "cached_pages": len(self.cache.pages),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+        }
+
+    def close(self):
+        if self.db is not None:
+            with self.lock:
+                self.db.close()
+            self.db = None
+
+
+history_store = HistoryStore()
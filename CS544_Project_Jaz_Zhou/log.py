@@ -0,0 +1,87 @@
+import json
+import sys
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+FORMAT_TEXT = "text"  # 2024-05-01T12:00:00.123 info login user_id=3 username=pam
+FORMAT_JSON = "json"  # One JSON object per line
+
+
+class Logger:
+    """
+    Level-gated structured logging: an event name plus key=value fields. On
+    hot paths guard the call with the matching flag, e.g.
+
+        if log.debug_enabled:
+            log.debug("deliver", to=username)
+
+    so a disabled level costs one attribute check and builds no arguments.
+    """
+
+    def __init__(self):
+        self.level = INFO
+        self.format = FORMAT_TEXT
+        self.stream = sys.stderr
+        self._update_flags()
+
+    def configure(self, level=None, format=None, stream=None):
+        if level is not None:
+            self.level = LEVELS[level] if isinstance(level, str) else level
+        if format is not None:
+            self.format = format
+        if stream is not None:
+            self.stream = stream
+        self._update_flags()
+
+    def _update_flags(self):
+        self.debug_enabled = self.level <= DEBUG
+        self.info_enabled = self.level <= INFO
+
+    def debug(self, event, **fields):
+        if self.level <= DEBUG:
+            self._write(DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        if self.level <= INFO:
+            self._write(INFO, event, fields)
+
+    def warning(self, event, **fields):
+        if self.level <= WARNING:
+            self._write(WARNING, event, fields)
+
+    def error(self, event, **fields):
+        if self.level <= ERROR:
+            self._write(ERROR, event, fields)
+
+    def _write(self, level, event, fields):
+        now = time.time()
+        if self.format == FORMAT_JSON:
+            record = {"ts": now, "level": LEVEL_NAMES[level], "event": event}
+            record.update(fields)
+            line = json.dumps(record, default=str)
+        else:
+            stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now)) + f".{int(now % 1 * 1000):03d}"
+            parts = [stamp, LEVEL_NAMES[level], event]
+            for key, value in fields.items():
+                if isinstance(value, (dict, list)):
+                    value = json.dumps(value, separators=(",", ":"), default=str)
+                elif not isinstance(value, (int, float)):
+                    value = str(value)
+                    if not value or " " in value or '"' in value:
+                        value = json.dumps(value)
+                parts.append(f"{key}={value}")
+            line = " ".join(parts)
+        try:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
+
+
+log = Logger()
@@ -0,0 +1,299 @@
+import asyncio
+import json
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Tuple
+
+from log import log
+
+RECORD_HEADER = struct.Struct("!IIBQ")  # body length, crc32 of the body, kind, seq
+KIND_MESSAGE = 1    # {"to", "mtype", "msg"}
+KIND_DELIVERED = 2  # {"to", "upto"}: every message to "to" up to seq "upto" was delivered
+
+SEGMENT_SUFFIX = ".seg"
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_COMMIT_INTERVAL = 0.002  # Seconds an append waits for others to share its fsync
+DEFAULT_MAX_BATCH = 4096         # Records that trigger a commit without waiting
+DEFAULT_MAX_INBOX = 10000        # Pending messages kept per user
+
+
+class InboxFull(Exception):
+    pass
+
+
+class Segment:
+    __slots__ = ("base_seq", "path", "size", "live", "unwritten")
+
+    def __init__(self, base_seq, path, size=0):
+        self.base_seq = base_seq
+        self.path = path
+        self.size = size
+        self.live = 0  # Messages in this segment not delivered yet
+        self.unwritten = 0  # Records appended to this segment that the writer has not finished
+
+
+class OfflineMessageStore:
+    """
+    Durable store for messages to users who are offline. Records are appended
+    to a log split into segment files. Appends made while a commit is running
+    or within the commit interval are written and fsynced together (group
+    commit) on a single writer thread. Each user has an inbox index of
+    (seq, segment, position, length) entries pointing into the log. Segments are
+    deleted oldest first, once nothing in them is waiting for delivery.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.segment_bytes = DEFAULT_SEGMENT_BYTES
+        self.commit_interval = DEFAULT_COMMIT_INTERVAL
+        self.max_batch = DEFAULT_MAX_BATCH
+        self.max_inbox = DEFAULT_MAX_INBOX
+        self.segments: Deque[Segment] = deque()
+        self.inboxes: Dict[str, Deque[Tuple[int, Segment, int, int]]] = {}
+        self.next_seq = 1
+        self.pending: List[Tuple[Segment, bytes]] = []  # Appended, not yet handed to the writer
+        self.waiters: List[asyncio.Future] = []         # Resolved once pending is durable
+        self.inflight_waiters: List[asyncio.Future] = []
+        self.inflight: List[Tuple[Segment, bytes]] = []  # Batch the writer thread is working on
+        self.flushing = False
+        self.flush_handle = None
+        self.executor = None
+        self.writer_file = None  # Only touched on the writer thread
+        self.writer_segment = None
+        self.commits = 0
+        self.records_committed = 0
+        self.messages_stored = 0
+        self.messages_delivered = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def open(self, directory, segment_bytes=None, commit_interval=None, max_batch=None, max_inbox=None):
+        if segment_bytes is not None:
+            self.segment_bytes = segment_bytes
+        if commit_interval is not None:
+            self.commit_interval = commit_interval
+        if max_batch is not None:
+            self.max_batch = max_batch
+        if max_inbox is not None:
+            self.max_inbox = max_inbox
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="offline-log")
+        self._recover()
+        if not self.segments:
+            self._roll()
+
+    def _segment_path(self, base_seq):
+        return os.path.join(self.directory, f"{base_seq:020d}{SEGMENT_SUFFIX}")
+
+    def _recover(self):
+        # Rebuild the inboxes by replaying every segment in order
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            segment = Segment(int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(self.directory, name))
+            self.segments.append(segment)
+            with open(segment.path, "rb") as f:
+                data = f.read()
+            position = 0
+            while position + RECORD_HEADER.size <= len(data):
+                length, crc, kind, seq = RECORD_HEADER.unpack_from(data, position)
+                start = position + RECORD_HEADER.size
+                body = data[start:start + length]
+                if len(body) < length or zlib.crc32(body) != crc:
+                    break
+                record = json.loads(body)
+                if kind == KIND_MESSAGE:
+                    self.inboxes.setdefault(record["to"], deque()).append(
+                        (seq, segment, position, RECORD_HEADER.size + length))
+                    segment.live += 1
+                elif kind == KIND_DELIVERED:
+                    self._drop_delivered(record["to"], record["upto"])
+                self.next_seq = max(self.next_seq, seq + 1)
+                position = start + length
+            if position < len(data):
+                # Torn write from a crash: cut the segment back to its last good record
+                log.warning("offline_segment_truncated", path=segment.path, position=position, size=len(data))
+                with open(segment.path, "r+b") as f:
+                    f.truncate(position)
+            segment.size = position
+        self._compact()
+        self.messages_delivered = 0
+
+    def _roll(self):
+        segment = Segment(self.next_seq, self._segment_path(self.next_seq))
+        open(segment.path, "ab").close()
+        self.segments.append(segment)
+        return segment
+
+    def _append(self, kind, body) -> Tuple[int, Segment, int, int]:
+        data = json.dumps(body).encode('utf-8')
+        seq = self.next_seq
+        self.next_seq += 1
+        record = RECORD_HEADER.pack(len(data), zlib.crc32(data), kind, seq) + data
+        segment = self.segments[-1]
+        if segment.size and segment.size + len(record) > self.segment_bytes:
+            segment = self._roll()
+        position = segment.size
+        segment.size += len(record)
+        segment.unwritten += 1
+        self.pending.append((segment, record))
+        self._schedule_commit()
+        return seq, segment, position, len(record)
+
+    def _schedule_commit(self):
+        if self.flushing:
+            return  # The running commit starts the next one when it finishes
+        if len(self.pending) >= self.max_batch:
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+            self._start_commit()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.commit_interval, self._start_commit)
+
+    def _start_commit(self):
+        self.flush_handle = None
+        if self.flushing or not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        self.inflight = batch
+        self.inflight_waiters, self.waiters = self.waiters, []
+        self.flushing = True
+        future = asyncio.get_event_loop().run_in_executor(self.executor, self._write_batch, batch)
+        future.add_done_callback(self._commit_done)
+
+    def _write_batch(self, batch):
+        # Writer thread: one write per segment touched and a single fsync per file
+        index = 0
+        while index < len(batch):
+            segment = batch[index][0]
+            end = index
+            while end < len(batch) and batch[end][0] is segment:
+                end += 1
+            if self.writer_segment is not segment:
+                if self.writer_file is not None:
+                    self.writer_file.close()
+                self.writer_file = open(segment.path, "ab")
+                self.writer_segment = segment
+            self.writer_file.write(b"".join(record for _, record in batch[index:end]))
+            self.writer_file.flush()
+            os.fsync(self.writer_file.fileno())
+            index = end
+        return len(batch)
+
+    def _commit_done(self, future):
+        self.flushing = False
+        for segment, _ in self.inflight:
+            segment.unwritten -= 1
+        self.inflight = []
+        self._compact()  # Segments that only waited on this batch may go now
+        waiters, self.inflight_waiters = self.inflight_waiters, []
+        error = future.exception()
+        if error is None:
+            self.commits += 1
+            self.records_committed += future.result()
+        for waiter in waiters:
+            if not waiter.done():
+                if error is None:
+                    waiter.set_result(None)
+                else:
+                    waiter.set_exception(error)
+        if self.pending:
+            self._start_commit()
+
+    async def sync(self):
+        # Wait until everything appended so far is on disk
+        if self.pending:
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+        elif self.flushing:
+            waiter = asyncio.get_event_loop().create_future()
+            self.inflight_waiters.append(waiter)
+            await waiter
+
+    async def append(self, username, mtype, msg) -> int:
+        inbox = self.inboxes.setdefault(username, deque())
+        if len(inbox) >= self.max_inbox:
+            raise InboxFull(f"Inbox of {username} is full")
+        entry = self._append(KIND_MESSAGE, {"to": username, "mtype": mtype, "msg": msg})
+        inbox.append(entry)
+        entry[1].live += 1
+        self.messages_stored += 1
+        await self.sync()
+        return entry[0]
+
+    def has_pending(self, username) -> bool:
+        return bool(self.inboxes.get(username))
+
+    async def fetch(self, username) -> List[Tuple[int, int, str]]:
+        # Pending messages of a user as (seq, mtype, msg), oldest first
+        entries = list(self.inboxes.get(username, ()))
+        if not entries:
+            return []
+        await self.sync()
+        return await asyncio.get_event_loop().run_in_executor(None, self._read_entries, entries)
+
+    def _read_entries(self, entries):
+        messages = []
+        files = {}
+        try:
+            for seq, segment, position, length in entries:
+                f = files.get(segment.path)
+                if f is None:
+                    f = files[segment.path] = open(segment.path, "rb")
+                data = os.pread(f.fileno(), length, position)
+                record = json.loads(data[RECORD_HEADER.size:])
+                messages.append((seq, record["mtype"], record["msg"]))
+        finally:
+            for f in files.values():
+                f.close()
+        return messages
+
+    def mark_delivered(self, username, upto_seq):
+        # Not awaited: if the marker is lost in a crash the messages are sent again
+        if self._drop_delivered(username, upto_seq):
+            self._append(KIND_DELIVERED, {"to": username, "upto": upto_seq})
+            self._compact()
+
+    def _drop_delivered(self, username, upto_seq) -> int:
+        inbox = self.inboxes.get(username)
+        dropped = 0
+        while inbox and inbox[0][0] <= upto_seq:
+            inbox.popleft()[1].live -= 1
+            dropped += 1
+        if inbox is not None and not inbox:
+            del self.inboxes[username]
+        self.messages_delivered += dropped
+        return dropped
+
+    def _compact(self):
+        # Only a prefix of the log may go: newer segments hold the delivery
+        # markers for messages in older ones. A segment with records still to
+        # be written stays, or the writer would create it again.
+        while len(self.segments) > 1 and self.segments[0].live == 0 and self.segments[0].unwritten == 0:
+            segment = self.segments.popleft()
+            try:
+                os.remove(segment.path)
+            except OSError as e:
+                log.warning("offline_segment_remove_failed", path=segment.path, error=repr(e))
+
+    def stats(self):
+        return {
+            "segments": len(self.segments),
+            "log_bytes": sum(segment.size for segment in self.segments),
+            "users_with_pending": len(self.inboxes),
+            "pending_messages": sum(len(inbox) for inbox in self.inboxes.values()),
+            "messages_stored": self.messages_stored,
+            "messages_delivered": self.messages_delivered,
+            "commits": self.commits,
+            "records_committed": self.records_committed,
+            "records_per_commit": self.records_committed / self.commits if self.commits else 0.0,
+        }
+
+
+offline_store = OfflineMessageStore()
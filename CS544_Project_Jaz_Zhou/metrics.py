@@ -0,0 +1,225 @@
+import asyncio
+import json
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Optional, Tuple
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+INF_BUCKET = 'le="+Inf"'
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ("value", "fn")
+
+    def __init__(self, fn: Optional[Callable[[], float]] = None):
+        self.value = 0
+        self.fn = fn  # Read at collection time instead of value
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def read(self):
+        return self.fn() if self.fn is not None else self.value
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket holding the quantile
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class MetricFamily:
+    """
+    All series of one metric name. Each distinct tuple of label values gets its
+    own child, created on first use and cached, so hot paths should keep the
+    child from labels() rather than look it up per event.
+    """
+
+    def __init__(self, kind, name, help_text, label_names, factory):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.factory = factory
+        self.children: Dict[Tuple, object] = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+    def series_name(self, values, suffix="", extra=""):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.label_names, values)]
+        if extra:
+            pairs.append(extra)
+        return self.name + suffix + ("{" + ",".join(pairs) + "}" if pairs else "")
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms for one process. Updates are plain
+    attribute writes on the event-loop thread, so the hot path takes no locks;
+    code running on other threads hands its measurements back to the loop
+    first. Values are read by render() for the HTTP endpoint and by
+    snapshot() for periodic reports.
+    """
+
+    def __init__(self):
+        self.families: Dict[str, MetricFamily] = {}
+        self.started = time.time()
+
+    def _family(self, kind, name, help_text, label_names, factory):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = MetricFamily(kind, name, help_text, tuple(label_names), factory)
+        # Metrics without labels are used directly
+        return family if label_names else family.labels()
+
+    def counter(self, name, help_text, labels=()):
+        return self._family("counter", name, help_text, labels, Counter)
+
+    def gauge(self, name, help_text, fn=None, labels=()):
+        return self._family("gauge", name, help_text, labels, lambda: Gauge(fn))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._family("histogram", name, help_text, labels, lambda: Histogram(buckets))
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = []
+        for family in self.families.values():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for values, child in list(family.children.items()):
+                if family.kind == "counter":
+                    lines.append(f"{family.series_name(values)} {child.value}")
+                elif family.kind == "gauge":
+                    value = self._read_gauge(child)
+                    if value is not None:
+                        lines.append(f"{family.series_name(values)} {value}")
+                else:
+                    cumulative = 0
+                    for bound, count in zip(child.buckets, child.counts):
+                        cumulative += count
+                        bucket = family.series_name(values, "_bucket", 'le="%s"' % bound)
+                        lines.append(f"{bucket} {cumulative}")
+                    lines.append(f"{family.series_name(values, '_bucket', INF_BUCKET)} {child.count}")
+                    lines.append(f"{family.series_name(values, '_sum')} {child.sum}")
+                    lines.append(f"{family.series_name(values, '_count')} {child.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict:
+        # Flat view keyed by series name; histograms are summarized
+        snapshot = {"time": time.time(), "uptime": time.time() - self.started}
+        for family in self.families.values():
+            for values, child in list(family.children.items()):
+                series = family.series_name(values)
+                if family.kind == "counter":
+                    snapshot[series] = child.value
+                elif family.kind == "gauge":
+                    snapshot[series] = self._read_gauge(child)
+                elif child.count:
+                    snapshot[series] = {"count": child.count, "sum": child.sum,
+                                        "p50": child.quantile(0.50), "p99": child.quantile(0.99)}
+        return snapshot
+
+    @staticmethod
+    def _read_gauge(gauge):
+        try:
+            return gauge.read()
+        except Exception:
+            return None
+
+    def report_every(self, interval, callback: Callable[[Dict], None]) -> asyncio.Task:
+        async def report():
+            while True:
+                await asyncio.sleep(interval)
+                callback(self.snapshot())
+        return asyncio.ensure_future(report())
+
+    async def serve_http(self, host, port):
+        # GET /metrics for the text format, GET /snapshot for JSON
+        return await asyncio.start_server(self._handle_http, host, port)
+
+    async def _handle_http(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass  # Headers are not needed
+            parts = request_line.decode("latin-1").split()
+            path = parts[1] if len(parts) > 1 else ""
+            if path == "/metrics":
+                status, content_type, body = "200 OK", TEXT_CONTENT_TYPE, self.render().encode("utf-8")
+            elif path == "/snapshot":
+                status, content_type, body = "200 OK", "application/json", json.dumps(self.snapshot()).encode("utf-8")
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+metrics = MetricsRegistry()
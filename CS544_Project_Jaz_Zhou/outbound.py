@@ -0,0 +1,375 @@
+import asyncio
+from collections import deque
+from typing import Dict, List
+
+import pdu
+from metrics import metrics
+
+POLICY_DROP = "drop"              # Discard new messages while over the high-water mark
+POLICY_DISCONNECT = "disconnect"  # Close the connection of a consumer that falls behind
+
+# Bytes allowed to sit in a QUIC stream's send buffer (unsent or unacked)
+# before further messages stay in the outbound queue.
+STREAM_BUFFER_LIMIT = 64 * 1024
+
+BYTES_SENT = metrics.counter("chat_bytes_sent_total", "Bytes handed to QUIC streams")
+QUEUED_MESSAGES = metrics.gauge("chat_outbound_queued_messages", "Frames waiting in outbound queues")
+QUEUED_BYTES = metrics.gauge("chat_outbound_queued_bytes", "Bytes waiting in outbound queues")
+DROPPED_MESSAGES = metrics.counter("chat_outbound_dropped_total", "Frames dropped at the outbound high-water mark")
+BATCHES_SENT = metrics.counter("chat_batches_sent_total", "MSG_TYPE_BATCH frames sent")
+BATCHED_FRAMES = metrics.counter("chat_batched_frames_total", "Frames sent inside MSG_TYPE_BATCH frames")
+
+
+class OutboundConfig:
+    def __init__(self, max_bytes=1024 * 1024, max_messages=1024, policy=POLICY_DROP):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.policy = policy
+
+    def configure(self, max_bytes=None, max_messages=None, policy=None):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if max_messages is not None:
+            self.max_messages = max_messages
+        if policy is not None:
+            self.policy = policy
+
+
+outbound_config = OutboundConfig()
+
+
+# Deficit round robin weights, highest priority first. Each scheduling round a
+# class with queued frames may send its weight in quanta, so control replies go
+# ahead of direct messages, then group, then broadcast, without starving any.
+CLASS_WEIGHTS = (
+    (pdu.TRAFFIC_CONTROL, 8),
+    (pdu.TRAFFIC_DIRECT, 4),
+    (pdu.TRAFFIC_GROUP, 2),
+    (pdu.TRAFFIC_BROADCAST, 1),
+)
+QUANTUM = 4096  # Bytes per scheduling turn of a sender, and per unit of class weight
+
+
+class Flow:
+    # Frames from one sender in one traffic class, kept in order
+    __slots__ = ("sender", "items", "deficit", "in_turn")
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.items = deque()  # (stream_id, data, end_stream)
+        self.deficit = 0
+        self.in_turn = False
+
+
+class ClassQueue:
+    __slots__ = ("name", "weight", "flows", "ring", "budget")
+
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        self.flows: Dict[object, Flow] = {}  # sender -> Flow
+        self.ring = deque()  # Flows with queued frames, the leftmost one is served
+        self.budget = 0
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be written into QUIC streams for one
+    handler. Only enough data to keep each stream busy is handed to aioquic;
+    the rest waits here, where it is counted against the high-water marks.
+
+    Waiting frames are scheduled by deficit round robin over traffic classes,
+    weighted by CLASS_WEIGHTS, and within a class over senders, so a flood
+    from one sender or of broadcasts does not hold up unrelated direct
+    messages. Frames of one sender and class keep their order; frames without
+    a sender (replies, presence) share one flow. A stream that is out of
+    buffer space does not hold up the others.
+
+    With coalesce above 1, binary frames picked for the same stream during one
+    drain are written as MSG_TYPE_BATCH frames of up to that many frames.
+    """
+
+    def __init__(self, config=outbound_config):
+        self.max_bytes = config.max_bytes
+        self.max_messages = config.max_messages
+        self.policy = config.policy
+        self.order = [ClassQueue(name, weight) for name, weight in CLASS_WEIGHTS]
+        self.classes = {queue.name: queue for queue in self.order}
+        self.coalesce = 1  # Frames per batch, set once both peers agreed on FEATURE_BATCH
+        self.picked: Dict[int, List[bytes]] = {}  # stream_id -> frames picked for the next batch
+        self.picked_bytes: Dict[int, int] = {}
+        self.stream_bytes: Dict[int, int] = {}  # stream_id -> bytes queued for it
+        self.queued_messages = 0
+        self.queued_bytes = 0
+        self.reported_messages = 0  # Share of the queue gauges held by this queue
+        self.reported_bytes = 0
+        self.peak_bytes = 0
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.dropped_messages = 0
+        self.dropped_bytes = 0
+        self.high_water_hits = 0
+        self.batches_sent = 0
+        self.frames_batched = 0
+
+    def __len__(self):
+        return self.queued_messages
+
+    def put(self, stream_id, data, end_stream=False, traffic=pdu.TRAFFIC_CONTROL, sender=None) -> bool:
+        # Returns False when the message would cross a high-water mark. The
+        # queue gauges catch up on the next drain, see _report.
+        size = len(data)
+        if (self.queued_bytes + size > self.max_bytes
+                or self.queued_messages >= self.max_messages):
+            self.high_water_hits += 1
+            self.dropped_messages += 1
+            self.dropped_bytes += size
+            DROPPED_MESSAGES.inc()
+            return False
+        queue = self.classes[traffic]
+        flow = queue.flows.get(sender)
+        if flow is None:
+            flow = queue.flows[sender] = Flow(sender)
+            queue.ring.append(flow)
+        flow.items.append((stream_id, data, end_stream))
+        self.stream_bytes[stream_id] = self.stream_bytes.get(stream_id, 0) + size
+        self.queued_messages += 1
+        self.queued_bytes += size
+        if self.queued_bytes > self.peak_bytes:
+            self.peak_bytes = self.queued_bytes
+        return True
+
+    def drain(self, quic) -> int:
+        # Move queued frames into their streams while the streams have room
+        queued_messages = self.queued_messages
+        room = {stream_id: STREAM_BUFFER_LIMIT - stream_buffered_bytes(quic, stream_id)
+                for stream_id in self.stream_bytes}
+        if all(self.stream_bytes[stream_id] <= room[stream_id] for stream_id in room):
+            # Nothing has to wait, so the order only follows class priority
+            for queue in self.order:
+                for flow in queue.ring:
+                    for stream_id, data, end_stream in flow.items:
+                        self._pick(quic, stream_id, data, end_stream)
+                queue.flows.clear()
+                queue.ring.clear()
+            self.stream_bytes.clear()
+        else:
+            self._schedule(quic, room)
+        for stream_id in list(self.picked):
+            self._write_batch(quic, stream_id)
+        self._report()
+        return queued_messages - self.queued_messages
+
+    def _report(self):
+        QUEUED_MESSAGES.inc(self.queued_messages - self.reported_messages)
+        QUEUED_BYTES.inc(self.queued_bytes - self.reported_bytes)
+        self.reported_messages = self.queued_messages
+        self.reported_bytes = self.queued_bytes
+
+    def _schedule(self, quic, room):
+        # One round at a time until every class is empty or waiting on a full stream
+        more = True
+        while more and self.queued_messages:
+            more = False
+            for queue in self.order:
+                if not queue.ring:
+                    continue
+                queue.budget += queue.weight * QUANTUM
+                if self._serve(queue, quic, room):
+                    more = True
+                else:
+                    # Empty or blocked, so it does not save up for later rounds
+                    queue.budget = min(queue.budget, queue.weight * QUANTUM)
+
+    def _serve(self, queue, quic, room) -> bool:
+        # Send from one class until its budget runs out. True when the class
+        # still has frames it could send.
+        blocked = 0  # Flows in a row whose next frame is for a full stream
+        ring = queue.ring
+        while ring and blocked < len(ring):
+            flow = ring[0]
+            stream_id, data, end_stream = flow.items[0]
+            if room[stream_id] <= 0:
+                ring.rotate(-1)
+                blocked += 1
+                continue
+            blocked = 0
+            if len(data) > queue.budget:
+                return True
+            if len(data) > flow.deficit:
+                if flow.in_turn:
+                    # Turn over, the remaining deficit carries to its next one
+                    flow.in_turn = False
+                    ring.rotate(-1)
+                else:
+                    flow.deficit += QUANTUM
+                    flow.in_turn = True
+                continue
+            flow.items.popleft()
+            flow.deficit -= len(data)
+            queue.budget -= len(data)
+            room[stream_id] -= len(data)
+            if self.stream_bytes[stream_id] == len(data):
+                del self.stream_bytes[stream_id]
+            else:
+                self.stream_bytes[stream_id] -= len(data)
+            if not flow.items:
+                ring.popleft()
+                del queue.flows[flow.sender]
+            self._pick(quic, stream_id, data, end_stream)
+        return False
+
+    def _pick(self, quic, stream_id, data, end_stream):
+        self.queued_messages -= 1
+        self.queued_bytes -= len(data)
+        if self.coalesce > 1 and not end_stream and data[0] != pdu.JSON_FRAME_START:
+            frames = self.picked.get(stream_id)
+            if frames is not None and (len(frames) >= self.coalesce
+                                       or self.picked_bytes[stream_id] + len(data) > pdu.MAX_FRAME_SIZE):
+                self._write_batch(quic, stream_id)
+                frames = None
+            if frames is None:
+                frames = self.picked[stream_id] = []
+                self.picked_bytes[stream_id] = 0
+            frames.append(data)
+            self.picked_bytes[stream_id] += len(data)
+            return
+        if stream_id in self.picked:
+            self._write_batch(quic, stream_id)
+        self._write(quic, stream_id, data, end_stream)
+
+    def _write_batch(self, quic, stream_id):
+        frames = self.picked.pop(stream_id)
+        del self.picked_bytes[stream_id]
+        if len(frames) == 1:
+            self._write(quic, stream_id, frames[0], False)
+            return
+        self.batches_sent += 1
+        self.frames_batched += len(frames)
+        BATCHES_SENT.inc()
+        BATCHED_FRAMES.inc(len(frames))
+        self._write(quic, stream_id, pdu.encode_batch(frames), False)
+
+    def _write(self, quic, stream_id, data, end_stream):
+        quic.send_stream_data(stream_id=stream_id, data=data, end_stream=end_stream)
+        self.sent_messages += 1
+        self.sent_bytes += len(data)
+        BYTES_SENT.inc(len(data))
+
+    def clear(self):
+        for queue in self.order:
+            queue.flows.clear()
+            queue.ring.clear()
+            queue.budget = 0
+        self.stream_bytes.clear()
+        self.queued_messages = 0
+        self.queued_bytes = 0
+        self._report()
+
+    def stats(self):
+        stats = {
+            "queued_messages": self.queued_messages,
+            "queued_flows": sum(len(queue.flows) for queue in self.order),
+            "queued_bytes": self.queued_bytes,
+            "peak_bytes": self.peak_bytes,
+            "sent_messages": self.sent_messages,
+            "sent_bytes": self.sent_bytes,
+            "dropped_messages": self.dropped_messages,
+            "dropped_bytes": self.dropped_bytes,
+            "high_water_hits": self.high_water_hits,
+            "max_bytes": self.max_bytes,
+            "max_messages": self.max_messages,
+            "policy": self.policy,
+        }
+        if self.coalesce > 1:
+            stats.update(batches_sent=self.batches_sent, frames_batched=self.frames_batched,
+                         frames_per_batch=self.frames_batched / self.batches_sent if self.batches_sent else 0.0)
+        return stats
+
+
+class BatchConfig:
+    def __init__(self, max_delay=0.002, max_messages=32):
+        self.max_delay = max_delay        # Seconds the first frame of a batch may wait
+        self.max_messages = max_messages  # Frames that flush a batch without waiting
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_messages > 1
+
+    def configure(self, max_delay=None, max_messages=None):
+        if max_delay is not None:
+            self.max_delay = max_delay
+        if max_messages is not None:
+            self.max_messages = max_messages
+
+
+batch_config = BatchConfig()
+
+
+class Batcher:
+    """
+    Sender-side coalescing of binary frames into MSG_TYPE_BATCH frames, one
+    batch per stream. Frames written within max_delay of the first one go out
+    together; a batch is flushed early once it holds max_messages frames or
+    would outgrow the maximum frame size. A lone frame is sent unchanged.
+    """
+
+    def __init__(self, emit, config=batch_config):
+        self.emit = emit  # Called with (stream_id, data) for each flushed frame or batch
+        self.max_delay = config.max_delay
+        self.max_messages = config.max_messages
+        self.pending: Dict[int, List[bytes]] = {}
+        self.pending_bytes: Dict[int, int] = {}
+        self.flush_handle = None
+        self.batches_sent = 0
+        self.frames_batched = 0
+
+    def add(self, stream_id, data):
+        frames = self.pending.get(stream_id)
+        if frames is not None and self.pending_bytes[stream_id] + len(data) > pdu.MAX_FRAME_SIZE:
+            self._flush_stream(stream_id)
+            frames = None
+        if frames is None:
+            frames = self.pending[stream_id] = []
+            self.pending_bytes[stream_id] = 0
+        frames.append(data)
+        self.pending_bytes[stream_id] += len(data)
+        if len(frames) >= self.max_messages:
+            self._flush_stream(stream_id)
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.max_delay, self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        for stream_id in list(self.pending):
+            self._flush_stream(stream_id)
+
+    def _flush_stream(self, stream_id):
+        frames = self.pending.pop(stream_id)
+        del self.pending_bytes[stream_id]
+        if len(frames) == 1:
+            self.emit(stream_id, frames[0])
+            return
+        self.batches_sent += 1
+        self.frames_batched += len(frames)
+        BATCHES_SENT.inc()
+        BATCHED_FRAMES.inc(len(frames))
+        self.emit(stream_id, pdu.encode_batch(frames))
+
+    def stats(self):
+        return {
+            "batches_sent": self.batches_sent,
+            "frames_batched": self.frames_batched,
+            "frames_per_batch": self.frames_batched / self.batches_sent if self.batches_sent else 0.0,
+        }
+
+
+def stream_buffered_bytes(quic, stream_id) -> int:
+    # aioquic has no public accessor for this, so peek at the stream sender
+    stream = quic._streams.get(stream_id)
+    if stream is None:
+        return 0
+    sender = stream.sender
+    return sender._buffer_stop - sender._buffer_start
@@ -1,4 +1,7 @@
 import json
+import struct
+import zlib
+from typing import List
 
 MSG_TYPE_VERSIONS = 0x00
 
@@ -19,6 +22,191 @@ MSG_TYPE_LOGOUT = 0x40
 MSG_TYPE_LOGOUT_ACK = 0x41
 MSG_TYPE_LOGOUT_BROADCAST = 0x42
 
+MSG_TYPE_PRESENCE_DELTA = 0x50
+MSG_TYPE_PRESENCE_SNAPSHOT_REQUEST = 0x51
+MSG_TYPE_PRESENCE_SNAPSHOT = 0x52
+
+MSG_TYPE_HISTORY_REQUEST = 0x60
+MSG_TYPE_HISTORY = 0x61
+
+MSG_TYPE_BATCH = 0x70  # Binary frames back to back in one frame body, see encode_batch
+
+MSG_TYPE_ROOM_JOIN = 0x80
+MSG_TYPE_ROOM_LEAVE = 0x81
+MSG_TYPE_ROOM_MESSAGE = 0x82
+MSG_TYPE_ROOM_ACK = 0x83
+
+MSG_TYPE_TYPING = 0x90
+
+# "one_to_one" for MSG_TYPE_ONE_TO_ONE and so on, used in logs and metrics
+MESSAGE_TYPE_NAMES = {value: name[len("MSG_TYPE_"):].lower()
+                      for name, value in list(globals().items()) if name.startswith("MSG_TYPE_")}
+
+
+def message_type_name(mtype):
+    return MESSAGE_TYPE_NAMES.get(mtype, f"0x{mtype:02x}")
+
+# Protocol versions. Version 1 is the original JSON encoding, version 2 is the
+# length-prefixed binary framing. VERSIONS negotiation is always sent as version 1.
+VERSION_JSON = 1
+VERSION_BINARY = 2
+
+# Optional features, offered by the client and echoed back by the server in VERSIONS
+FEATURE_PRESENCE_DELTA = "presence_delta"
+FEATURE_HISTORY = "history"
+FEATURE_BATCH = "batch"  # Binary framing only
+FEATURE_COMPRESSION = "zlib"  # Binary framing only; rename it if COMPRESSION_DICTIONARY changes
+FEATURE_ROOMS = "rooms"
+FEATURE_STREAMS = "streams"  # Chat traffic on one stream per traffic class, see traffic_class
+FEATURE_QUIC_KEEPALIVE = "quic_keepalive"  # Client keeps the connection up with QUIC PINGs, not MSG_TYPE_ALIVE
+FEATURE_DATAGRAMS = "datagrams"  # EPHEMERAL_TYPES go in QUIC DATAGRAM frames
+BINARY_ONLY_FEATURES = (FEATURE_BATCH, FEATURE_COMPRESSION)
+
+# Traffic classes. With FEATURE_STREAMS each non-control class gets a stream of
+# its own in each direction, so a large frame of one class does not hold up
+# the others; everything else (negotiation, login, presence, history, replies)
+# stays on the control stream the client opened first.
+TRAFFIC_CONTROL = "control"
+TRAFFIC_DIRECT = "direct"
+TRAFFIC_GROUP = "group"
+TRAFFIC_BROADCAST = "broadcast"
+TRAFFIC_CLASSES = {
+    MSG_TYPE_ONE_TO_ONE: TRAFFIC_DIRECT,
+    MSG_TYPE_ONE_TO_MANY: TRAFFIC_GROUP,
+    MSG_TYPE_ROOM_MESSAGE: TRAFFIC_GROUP,
+    MSG_TYPE_BROADCAST: TRAFFIC_BROADCAST,
+}
+
+
+def traffic_class(mtype):
+    return TRAFFIC_CLASSES.get(mtype, TRAFFIC_CONTROL)
+
+# Messages that are stale by the time a retransmission would arrive. With
+# FEATURE_DATAGRAMS they are sent one per QUIC DATAGRAM frame, unreliably and
+# unordered; a lost typing indicator or keep-alive is simply not seen.
+EPHEMERAL_TYPES = frozenset((MSG_TYPE_ALIVE, MSG_TYPE_TYPING))
+
+# Messages a client sends for the server to forward to other users. They count
+# against the sender's rate limit before they are fanned out.
+FAN_OUT_TYPES = frozenset((MSG_TYPE_ONE_TO_ONE, MSG_TYPE_ONE_TO_MANY, MSG_TYPE_BROADCAST, MSG_TYPE_ROOM_MESSAGE,
+                           MSG_TYPE_TYPING))
+
+# Conversation IDs used by history requests. Direct and group conversations are
+# named after their members' usernames, sorted so both sides agree on the name.
+BROADCAST_CONVERSATION = "broadcast"
+
+
+def valid_username(username) -> bool:
+    # The separators of conversation names may not appear in usernames, or a
+    # name could be split into members it was not made from
+    return isinstance(username, str) and username != "" and ":" not in username and "," not in username
+
+
+def direct_conversation(username, other_username):
+    return "dm:" + ":".join(sorted((username, other_username)))
+
+
+def group_conversation(usernames):
+    return "group:" + ",".join(sorted(set(usernames)))
+
+
+def room_conversation(room):
+    return "room:" + room
+
+
+def conversation_room(conversation):
+    # Room name of a room conversation, None for any other conversation
+    return conversation[5:] if conversation.startswith("room:") else None
+
+
+def conversation_members(conversation):
+    # None for the broadcast conversation, which every user belongs to, and for
+    # rooms, whose members are only known to the server. A malformed direct or
+    # group name has no members.
+    if conversation.startswith("dm:"):
+        members = conversation[3:].split(":")
+        if len(members) != 2:
+            return []
+    elif conversation.startswith("group:"):
+        members = conversation[6:].split(",")
+    else:
+        return None
+    return members if all(members) else []
+
+# Binary frame header: version, mtype, flags, body length
+HEADER = struct.Struct("!BBBI")
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 1 << 20  # Upper bound on a single frame body, before and after decompression
+
+FLAG_COMPRESSED = 0x01  # Body is raw deflate data, primed with COMPRESSION_DICTIONARY
+
+# Preset dictionary of the field names and message shapes the protocol sends
+# most, so even short messages compress. Both peers must use the same bytes.
+COMPRESSION_DICTIONARY = (
+    b'{"error": "Target user not available"}{"sys": "Logout successful"}'
+    b'{"user_id": 1, "username": "'
+    b'{"seq": 12, "event": "leave", "user_id": 7, "username": "'
+    b'{"seq": 42, "event": "join", "user_id": 3, "username": "'
+    b'{"conversation": null, "messages": [{"seq": 120, "conversation": "broadcast", "sender": "", "mtype": 50, '
+    b'"msg": "{\\"sender_user_id\\": 2, \\"sender_username\\": \\"\\", \\"msg\\": \\"\\", \\"id\\": \\"\\"}", '
+    b'"ts": 1700000000.0}], "cursor": 120, "has_more": false}'
+    b'{"seq": 5, "users": [{"user_id": 1, "username": ""}, {"user_id": 2, "username": ""}]}'
+    b'{"sender_user_id": 2, "sender_username": "", "msg": "", "id": ""}'
+)
+DEFAULT_COMPRESSION_MIN_SIZE = 64  # Smaller bodies are sent as they are
+DEFAULT_COMPRESSION_LEVEL = 6
+
+
+class Compressor:
+    """
+    Per-message zlib compression with a preset dictionary. Priming a stream
+    with the dictionary costs more than the short messages it compresses, so
+    primed compressor and decompressor objects are made once and copied for
+    every message.
+    """
+
+    def __init__(self, min_size=DEFAULT_COMPRESSION_MIN_SIZE, level=DEFAULT_COMPRESSION_LEVEL):
+        self.enabled = True  # Offer FEATURE_COMPRESSION; received frames are always understood
+        self.min_size = min_size
+        self.level = level
+        self._prime()
+
+    def _prime(self):
+        self._compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                            zdict=COMPRESSION_DICTIONARY)
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=COMPRESSION_DICTIONARY)
+
+    def configure(self, enabled=None, min_size=None, level=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if min_size is not None:
+            self.min_size = min_size
+        if level is not None:
+            self.level = level
+            self._prime()
+
+    def compress(self, body: bytes):
+        # None when the body is too small or does not shrink
+        if len(body) < self.min_size:
+            return None
+        compressor = self._compressor.copy()
+        packed = compressor.compress(body) + compressor.flush()
+        return packed if len(packed) < len(body) else None
+
+    def decompress(self, data) -> bytes:
+        decompressor = self._decompressor.copy()
+        try:
+            body = decompressor.decompress(data, MAX_FRAME_SIZE)
+        except zlib.error as e:
+            raise ValueError(f"Corrupt compressed frame: {e}") from e
+        if decompressor.unconsumed_tail:
+            raise ValueError("Compressed frame exceeds maximum frame size")
+        return body
+
+
+compressor = Compressor()
+
+JSON_FRAME_START = ord('{')
 
 
 class Datagram:
@@ -34,12 +222,134 @@ class Datagram:
 
     @staticmethod
     def from_json(json_str):
-        data = json.loads(json_str)
-        return Datagram(data['mtype'], data['msg'], data['version'], len(data['msg']))
+        return Datagram.from_dict(json.loads(json_str))
+
+    @staticmethod
+    def from_dict(data):
+        # Legacy frames come straight from the peer, so check the fields first
+        if not isinstance(data, dict):
+            raise ValueError("JSON frame is not an object")
+        mtype, msg, version = data.get('mtype'), data.get('msg'), data.get('version')
+        if type(mtype) is not int or type(version) is not int or not isinstance(msg, str):
+            raise ValueError("JSON frame needs integer mtype and version and a string msg")
+        return Datagram(mtype, msg, version, len(msg))
 
-    def to_bytes(self):
+    def to_binary(self, compress=False):
+        body = self.msg.encode('utf-8')
+        flags = 0
+        if compress:
+            packed = compressor.compress(body)
+            if packed is not None:
+                body, flags = packed, FLAG_COMPRESSED
+        return HEADER.pack(self.version, self.mtype, flags, len(body)) + body
+
+    @staticmethod
+    def from_binary(frame, offset=0):
+        version, mtype, flags, length = HEADER.unpack_from(frame, offset)
+        start = offset + HEADER_SIZE
+        body = frame[start:start + length]
+        if flags & FLAG_COMPRESSED:
+            body = compressor.decompress(body)
+        msg = str(body, 'utf-8')
+        return Datagram(mtype, msg, version, length)
+
+    def to_bytes(self, compress=False):
+        # compress only applies to the binary framing, see FEATURE_COMPRESSION
+        if self.version >= VERSION_BINARY:
+            return self.to_binary(compress)
         return self.to_json().encode('utf-8')
 
     @staticmethod
-    def from_bytes(json_bytes):
-        return Datagram.from_json(json_bytes.decode('utf-8'))
\ No newline at end of file
+    def from_bytes(data):
+        if data[0] == JSON_FRAME_START:
+            return Datagram.from_json(bytes(data).decode('utf-8'))
+        return Datagram.from_binary(data)
+
+
+def decode_frame(data) -> Datagram:
+    # Exactly one frame, as carried by a QUIC DATAGRAM frame
+    if not data:
+        raise ValueError("Empty datagram")
+    if data[0] != JSON_FRAME_START:
+        if len(data) < HEADER_SIZE or HEADER_SIZE + HEADER.unpack_from(data)[3] != len(data):
+            raise ValueError("Frame length does not match the datagram")
+    return Datagram.from_bytes(data)
+
+
+def encode_batch(frames: List[bytes]) -> bytes:
+    # The batch frame takes the version of the frames it carries
+    length = sum(len(frame) for frame in frames)
+    return HEADER.pack(frames[0][0], MSG_TYPE_BATCH, 0, length) + b"".join(frames)
+
+
+def split_batch(frame, start, end) -> List[Datagram]:
+    # Sub-frames are decoded in place from the batch body
+    datagrams = []
+    while start < end:
+        if end - start < HEADER_SIZE:
+            raise ValueError("Truncated frame in batch")
+        _version, mtype, _flags, length = HEADER.unpack_from(frame, start)
+        if mtype == MSG_TYPE_BATCH:
+            raise ValueError("Nested batch frame")
+        if start + HEADER_SIZE + length > end:
+            raise ValueError("Frame overruns its batch")
+        datagrams.append(Datagram.from_binary(frame, start))
+        start += HEADER_SIZE + length
+    return datagrams
+
+
+class StreamDecoder:
+    """
+    Incremental decoder for one QUIC stream. Stream data may arrive split or
+    coalesced, so bytes are buffered until whole frames are available. Both the
+    binary framing and the legacy back-to-back JSON objects are understood.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.json_decoder = json.JSONDecoder()
+
+    def feed(self, data: bytes) -> List[Datagram]:
+        self.buffer += data
+        datagrams = []
+        # Binary frames are decoded straight from the buffer through this view
+        view = memoryview(self.buffer)
+        try:
+            offset = self._decode(view, datagrams)
+        finally:
+            view.release()
+        del self.buffer[:offset]
+        return datagrams
+
+    def _decode(self, view, datagrams) -> int:
+        offset = 0
+        text = None
+        while offset < len(self.buffer):
+            if self.buffer[offset] == JSON_FRAME_START:
+                # Legacy frames are ASCII JSON objects (json.dumps escapes non-ASCII),
+                # so character and byte offsets line up.
+                if text is None:
+                    text = self.buffer.decode('ascii', errors='replace')
+                try:
+                    obj, end = self.json_decoder.raw_decode(text, offset)
+                except json.JSONDecodeError:
+                    if len(self.buffer) - offset > MAX_FRAME_SIZE:
+                        raise ValueError("Unterminated JSON frame exceeds maximum frame size")
+                    break  # Wait for the rest of the object
+                datagrams.append(Datagram.from_dict(obj))
+                offset = end
+            else:
+                if len(self.buffer) - offset < HEADER_SIZE:
+                    break
+                _version, mtype, _flags, length = HEADER.unpack_from(view, offset)
+                if length > MAX_FRAME_SIZE:
+                    raise ValueError(f"Frame of {length} bytes exceeds maximum frame size")
+                end = offset + HEADER_SIZE + length
+                if end > len(self.buffer):
+                    break
+                if mtype == MSG_TYPE_BATCH:
+                    datagrams.extend(split_batch(view, offset + HEADER_SIZE, end))
+                else:
+                    datagrams.append(Datagram.from_binary(view, offset))
+                offset = end
+        return offset
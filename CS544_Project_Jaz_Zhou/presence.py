@@ -0,0 +1,142 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_DEPARTED_TTL = 7 * 24 * 3600  # Seconds a logged out user ID can still be sent offline messages
+DEFAULT_MAX_DEPARTED = 100000         # Logged out user IDs remembered at most, oldest dropped first
+
+
+class Session:
+    __slots__ = ("user_id", "username", "conn", "stream_id", "node")
+
+    def __init__(self, user_id, username, conn, stream_id, node=None):
+        self.user_id = user_id
+        self.username = username
+        self.conn = conn
+        self.stream_id = stream_id
+        self.node = node  # Backplane node holding the connection, None when local
+
+    def is_local(self) -> bool:
+        return self.node is None
+
+
+class PresenceRegistry:
+    """
+    Active sessions indexed both by user ID and by username. The serialized roster
+    is cached and only rebuilt after the roster version changes. Users connected
+    to other backplane nodes are listed too, which makes the registries of all
+    nodes together a replicated presence directory.
+
+    User IDs are issued per login, so the usernames of logged out users are
+    only remembered for departed_ttl seconds and up to max_departed users.
+    Messages to an ID that was forgotten are refused like those to an unknown
+    user.
+    """
+
+    def __init__(self):
+        self.sessions: Dict[int, Session] = {}  # user_id -> session
+        self.local: Dict[int, Session] = {}  # user_id -> session with a connection here
+        self.user_ids: Dict[str, int] = {}  # username -> user_id
+        self.departed: Dict[int, Tuple[str, float]] = OrderedDict()  # user_id -> (username, logout time), oldest first
+        self.departed_ttl = DEFAULT_DEPARTED_TTL
+        self.max_departed = DEFAULT_MAX_DEPARTED
+        self.version = 0  # Bumped on every join or leave
+        self._roster_json = None
+        self._roster_json_version = -1
+
+    def configure(self, departed_ttl=None, max_departed=None):
+        if departed_ttl is not None:
+            self.departed_ttl = departed_ttl
+        if max_departed is not None:
+            self.max_departed = max_departed
+        self._expire_departed()
+
+    def add(self, user_id, username, conn, stream_id) -> Session:
+        session = Session(user_id, username, conn, stream_id)
+        self.local[user_id] = session
+        return self._insert(session)
+
+    def add_remote(self, user_id, username, node) -> Session:
+        return self._insert(Session(user_id, username, None, None, node))
+
+    def _insert(self, session) -> Session:
+        self.sessions[session.user_id] = session
+        self.user_ids[session.username] = session.user_id
+        self.departed.pop(session.user_id, None)
+        self.version += 1
+        return session
+
+    def remove(self, user_id) -> Optional[Session]:
+        session = self.sessions.pop(user_id, None)
+        self.local.pop(user_id, None)
+        if session is not None:
+            if self.user_ids.get(session.username) == user_id:
+                del self.user_ids[session.username]
+            self.departed[user_id] = (session.username, time.monotonic())
+            self._expire_departed()
+            self.version += 1
+        return session
+
+    def _expire_departed(self):
+        expired = time.monotonic() - self.departed_ttl
+        while self.departed and (len(self.departed) > self.max_departed
+                                 or next(iter(self.departed.values()))[1] < expired):
+            self.departed.popitem(last=False)
+
+    def remove_node(self, node) -> List[Session]:
+        # Forget every user of a node that left the cluster
+        gone = [s for s in self.sessions.values() if s.node == node]
+        for session in gone:
+            self.remove(session.user_id)
+        return gone
+
+    def get(self, user_id) -> Optional[Session]:
+        return self.sessions.get(user_id)
+
+    def get_local(self, user_id) -> Optional[Session]:
+        return self.local.get(user_id)
+
+    def is_logged_in(self, username) -> bool:
+        return username in self.user_ids
+
+    def last_username(self, user_id) -> Optional[str]:
+        # Username behind a user ID, also for a while after that user logged out
+        session = self.sessions.get(user_id)
+        if session is not None:
+            return session.username
+        departed = self.departed.get(user_id)
+        if departed is None or departed[1] < time.monotonic() - self.departed_ttl:
+            return None
+        return departed[0]
+
+    def get_username(self, user_id):
+        return self.sessions[user_id].username
+
+    def all_sessions(self):
+        return self.sessions.values()
+
+    def local_sessions(self):
+        return self.local.values()
+
+    def __contains__(self, user_id) -> bool:
+        return user_id in self.sessions
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def roster(self):
+        return [{"user_id": s.user_id, "username": s.username} for s in self.sessions.values()]
+
+    def snapshot_json(self) -> str:
+        # Roster tagged with its version, used as the base for presence deltas
+        return '{"seq": %d, "users": %s}' % (self.version, self.roster_json())
+
+    def roster_json(self) -> str:
+        if self._roster_json_version != self.version:
+            self._roster_json = json.dumps(self.roster())
+            self._roster_json_version = self.version
+        return self._roster_json
+
+
+presence = PresenceRegistry()
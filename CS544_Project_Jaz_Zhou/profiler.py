@@ -0,0 +1,239 @@
+import asyncio
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from asyncio import events
+from collections import defaultdict, deque
+from typing import Dict, Optional
+
+from log import log
+
+DEFAULT_SAMPLE_INTERVAL = 0.005   # Seconds between stack samples
+DEFAULT_STALL_THRESHOLD = 0.1     # A callback holding the loop longer than this is a stall
+MAX_STALLS_KEPT = 100
+MAX_STACK_DEPTH = 64
+
+# Type of the PDU being handled by the current task, see message_type()
+MESSAGE_TYPE = contextvars.ContextVar("message_type", default=None)
+
+_original_handle_run = events.Handle._run
+
+
+class MessageTypeScope:
+    __slots__ = ("name", "token")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.token = MESSAGE_TYPE.set(self.name)
+
+    def __exit__(self, *exc_info):
+        MESSAGE_TYPE.reset(self.token)
+
+
+def message_type(name) -> MessageTypeScope:
+    # Attributes the CPU time of the enclosed handler to a PDU type
+    return MessageTypeScope(name)
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse_stack(frame) -> str:
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def coroutine_chain(task) -> str:
+    # The task's coroutine and everything it is awaiting, outermost first
+    names = []
+    coro = task.get_coro()
+    while coro is not None and hasattr(coro, "cr_code") and len(names) < MAX_STACK_DEPTH:
+        names.append(coro.__qualname__)
+        coro = coro.cr_await
+    # A finished task awaits nothing, name it after its coroutine
+    return ";".join(names) or getattr(task.get_coro(), "__qualname__", "Task")
+
+
+def callback_name(callback) -> str:
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        return coroutine_chain(owner)
+    if owner is not None and not isinstance(owner, type(sys)):
+        return f"{type(owner).__name__}.{getattr(callback, '__name__', '?')}"
+    return getattr(callback, "__qualname__", repr(callback))
+
+
+class Profiler:
+    """
+    Event-loop profiler. While running it
+    - times every callback the loop runs (asyncio Handle._run), charging its CPU
+      time to the task's coroutine chain and to the PDU type being handled,
+    - samples the stacks of all threads from a background thread, and
+    - has the same thread watch for callbacks that hold the loop longer than
+      the stall threshold, capturing the loop thread's stack while it is stuck.
+    Results are written as collapsed stacks ("frame;frame;frame count"), the
+    input format of flamegraph.pl and speedscope, plus a JSON summary.
+    """
+
+    def __init__(self):
+        self.running = False
+        self.sample_interval = DEFAULT_SAMPLE_INTERVAL
+        self.stall_threshold = DEFAULT_STALL_THRESHOLD
+        self.output_dir = "./profiles"
+        self.loop_thread_id = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self.started = None
+        self.samples: Dict[str, int] = defaultdict(int)          # Sampled stack -> count
+        self.task_cpu: Dict[str, float] = defaultdict(float)     # Coroutine chain -> CPU seconds
+        self.type_cpu: Dict[str, float] = defaultdict(float)     # PDU type -> CPU seconds
+        self.type_calls: Dict[str, int] = defaultdict(int)
+        self.stalls = deque(maxlen=MAX_STALLS_KEPT)
+        self.stall_stacks: Dict[str, float] = defaultdict(float)  # Stack -> stalled seconds
+        self.callbacks = 0
+        self.current_started = None  # perf_counter() when the running callback began
+        self.current_stack = None    # Captured by the watchdog during a stall
+
+    def configure(self, sample_interval=None, stall_threshold=None, output_dir=None):
+        if sample_interval is not None:
+            self.sample_interval = sample_interval
+        if stall_threshold is not None:
+            self.stall_threshold = stall_threshold
+        if output_dir is not None:
+            self.output_dir = output_dir
+
+    def start(self):
+        if self.running:
+            return
+        self._reset()
+        self.started = time.time()
+        self.loop_thread_id = threading.get_ident()
+        self.running = True
+        events.Handle._run = _profiled_handle_run
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+        self.thread.start()
+        log.info("profiler_started", sample_ms=self.sample_interval * 1000,
+                 stall_ms=self.stall_threshold * 1000)
+
+    def stop(self) -> Optional[Dict]:
+        if not self.running:
+            return None
+        events.Handle._run = _original_handle_run
+        self.running = False
+        self.stop_event.set()
+        self.thread.join()
+        return self.write()
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self.stop_event.wait(self.sample_interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            now = time.perf_counter()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = collapse_stack(frame)
+                self.samples[f"{names.get(thread_id, thread_id)};{stack}"] += 1
+                started = self.current_started
+                if (thread_id == self.loop_thread_id and started is not None and self.current_stack is None
+                        and now - started >= self.stall_threshold):
+                    self.current_stack = stack
+
+    def record(self, callback, wall, cpu, label):
+        self.callbacks += 1
+        name = callback_name(callback)
+        self.task_cpu[name] += cpu
+        if label is not None:
+            self.type_cpu[label] += cpu
+            self.type_calls[label] += 1
+        if wall >= self.stall_threshold:
+            stack = self.current_stack or name
+            self.stalls.append({"at": time.time(), "seconds": wall, "callback": name,
+                                "message_type": label, "stack": stack})
+            self.stall_stacks[stack] += wall
+            log.warning("event_loop_stall", ms=round(wall * 1000, 1), callback=name,
+                        frame=stack.rsplit(";", 1)[-1])
+        self.current_stack = None
+
+    def summary(self) -> Dict:
+        duration = time.time() - self.started if self.started else 0.0
+        top_tasks = sorted(self.task_cpu.items(), key=lambda item: item[1], reverse=True)[:20]
+        return {
+            "duration": duration,
+            "callbacks": self.callbacks,
+            "samples": sum(self.samples.values()),
+            "cpu_by_message_type": {name: {"cpu": cpu, "calls": self.type_calls[name]}
+                                    for name, cpu in sorted(self.type_cpu.items(), key=lambda item: -item[1])},
+            "cpu_by_coroutine": dict(top_tasks),
+            "stalls": list(self.stalls),
+        }
+
+    def write(self) -> Dict:
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+        files = {
+            "samples": prefix + ".folded",            # Sampled stacks of every thread
+            "tasks": prefix + "-tasks.folded",        # Loop CPU per coroutine chain, in microseconds
+            "stalls": prefix + "-stalls.folded",      # Stacks of stalls, in milliseconds stalled
+            "summary": prefix + ".json",
+        }
+        write_folded(files["samples"], self.samples, 1)
+        write_folded(files["tasks"], self.task_cpu, 1e6)
+        write_folded(files["stalls"], self.stall_stacks, 1e3)
+        summary = self.summary()
+        with open(files["summary"], "w") as f:
+            json.dump(summary, f, indent=2)
+        log.info("profiler_stopped", seconds=round(summary["duration"], 1), stalls=len(self.stalls),
+                 summary=files["summary"])
+        return files
+
+
+def write_folded(path, stacks, scale):
+    with open(path, "w") as f:
+        for stack, value in sorted(stacks.items()):
+            count = int(round(value * scale))
+            if count:
+                f.write(f"{stack.replace(' ', '_')} {count}\n")
+
+
+def _profiled_handle_run(handle):
+    # Read before running, the callback may cancel its own handle
+    callback = handle._callback
+    context = handle._context
+    label = context.get(MESSAGE_TYPE)
+    started = time.perf_counter()
+    cpu = time.thread_time()
+    profiler.current_started = started
+    try:
+        _original_handle_run(handle)
+    finally:
+        profiler.current_started = None
+        wall = time.perf_counter() - started
+        cpu = time.thread_time() - cpu
+        # A step that starts or ends inside a handler belongs to its PDU type
+        profiler.record(callback, wall, cpu, context.get(MESSAGE_TYPE) or label)
+
+
+profiler = Profiler()
@@ -1,39 +1,66 @@
 # quic_engine.py
 
 import asyncio
+import base64
+import os
+import pickle
+import shelve
+import socket
+import time
+from functools import partial
 from aioquic.asyncio import connect, serve
 from aioquic.asyncio.protocol import QuicConnectionProtocol
-from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import StreamDataReceived
+from aioquic.asyncio.server import QuicServer
+from aioquic.buffer import Buffer
+from aioquic.quic.configuration import QuicConfiguration, SMALLEST_MAX_DATAGRAM_SIZE
+from aioquic.quic.connection import QuicConnection
+from aioquic.quic.events import StreamDataReceived, DatagramFrameReceived, HandshakeCompleted, ConnectionTerminated
+from aioquic.quic.packet import PACKET_TYPE_INITIAL, pull_quic_header
 from typing import Optional, Dict, Callable, Coroutine, Deque, List
 from aioquic.tls import SessionTicket
 
-from collections import deque
+from collections import deque, OrderedDict
 
 import json
 
 from chat_quic import ChatQuicConnection, QuicStreamEvent
 import chat_server, chat_client
 import pdu
+from metrics import metrics
+from log import log
+from outbound import OutboundQueue, Batcher, batch_config, POLICY_DISCONNECT
 
 ALPN_PROTOCOL = "chat-protocol"
+DEFAULT_QUIC_IDLE_TIMEOUT = 60.0  # Seconds without packets before QUIC drops a connection
+PINGS_PER_IDLE_TIMEOUT = 3  # Client PINGs sent within one idle timeout
+MAX_DATAGRAM_FRAME_SIZE = 65536  # Largest DATAGRAM frame accepted, advertised as a transport parameter
+MAX_DATAGRAM_PAYLOAD = 1000  # Largest frame sent as a DATAGRAM, fits a minimum-size QUIC packet
 
 
-def build_server_quic_config(cert_file, key_file) -> QuicConfiguration:
+def build_server_quic_config(cert_file, key_file, idle_timeout=DEFAULT_QUIC_IDLE_TIMEOUT) -> QuicConfiguration:
+    # A client that disappears without closing is dropped after idle_timeout,
+    # which ends its session, see AsyncQuicServer.connection_terminated
     configuration = QuicConfiguration(
         alpn_protocols=[ALPN_PROTOCOL],
-        is_client=False
+        is_client=False,
+        idle_timeout=idle_timeout,
+        max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE
     )
     configuration.load_cert_chain(cert_file, key_file)
 
     return configuration
 
 
-def build_client_quic_config(cert_file=None):
+def build_client_quic_config(cert_file=None, session_ticket: Optional[SessionTicket] = None,
+                             idle_timeout=DEFAULT_QUIC_IDLE_TIMEOUT):
     configuration = QuicConfiguration(alpn_protocols=[ALPN_PROTOCOL],
-                                      is_client=True)
+                                      is_client=True,
+                                      idle_timeout=idle_timeout,
+                                      max_datagram_frame_size=MAX_DATAGRAM_FRAME_SIZE)
     if cert_file:
         configuration.load_verify_locations(cert_file)
+    # A ticket from an earlier connection enables resumption and 0-RTT data
+    configuration.session_ticket = session_ticket
 
     return configuration
 
@@ -42,6 +69,15 @@ def create_msg_payload(msg):
     return json.dumps(msg).encode('utf-8')
 
 
+BYTES_RECEIVED = metrics.counter("chat_bytes_received_total", "Bytes received on QUIC streams")
+DATAGRAMS_SENT = metrics.counter("chat_datagrams_sent_total", "Ephemeral frames sent as QUIC DATAGRAM frames")
+DATAGRAMS_RECEIVED = metrics.counter("chat_datagrams_received_total", "Ephemeral frames received in QUIC DATAGRAM frames")
+DATAGRAM_FALLBACKS = metrics.counter("chat_datagram_fallbacks_total",
+                                     "Ephemeral frames sent on a stream because the peer takes no DATAGRAM frames "
+                                     "or the frame is too large")
+CONNECTIONS_TERMINATED = metrics.counter("chat_connections_terminated_total",
+                                         "QUIC connections that ended, by reason", ("reason",))
+
 SERVER_MODE = 0
 CLIENT_MODE = 1
 
@@ -50,9 +86,14 @@ class AsyncQuicServer(QuicConnectionProtocol):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._handlers: Dict[int, ChatServerRequestHandler] = {}
+        self._session_handler: Optional[ChatServerRequestHandler] = None  # Handler of the first stream
         self._client_handler: Optional[ChatClientRequestHandler] = None
         self._is_client: bool = self._quic.configuration.is_client
         self._mode: int = SERVER_MODE if not self._is_client else CLIENT_MODE
+        self._transmit_scheduled: bool = False
+        self._backlogged = set()  # Handlers whose outbound queue is waiting on stream space
+        self.handshake_done = asyncio.Event()
+        self._keep_alive_task: Optional[asyncio.Task] = None
         if self._mode == CLIENT_MODE:
             self._attach_client_handler()
 
@@ -68,17 +109,52 @@ class AsyncQuicServer(QuicConnectionProtocol):
                 transmit=self.transmit
             )
 
+    def schedule_transmit(self) -> None:
+        # Coalesce writes queued during this event-loop tick into one flush
+        if not self._transmit_scheduled:
+            self._transmit_scheduled = True
+            self._loop.call_soon(self._scheduled_transmit)
+
+    def _scheduled_transmit(self) -> None:
+        self._transmit_scheduled = False
+        self.drain_outbound()
+        self.transmit()
+
+    def drain_outbound(self) -> None:
+        for handler in list(self._backlogged):
+            handler.drain()
+
+    def set_backlogged(self, handler, backlogged: bool) -> None:
+        if backlogged:
+            self._backlogged.add(handler)
+        else:
+            self._backlogged.discard(handler)
+
+    def datagram_received(self, data, addr) -> None:
+        super().datagram_received(data, addr)
+        # ACKs may have freed stream buffer space for queued messages
+        if self._backlogged:
+            self.drain_outbound()
+            self.transmit()
+
     def remove_handler(self, stream_id):
         if stream_id:
-            self._handlers.pop(stream_id)
+            self._handlers.pop(stream_id, None)
 
     def _quic_client_event_dispatch(self, event):
         if isinstance(event, StreamDataReceived):
             self._client_handler.quic_event_received(event)
+        elif isinstance(event, DatagramFrameReceived):
+            self._client_handler.datagram_frame_received(event)
 
     def _quic_server_event_dispatch(self, event):
         handler = None
         if isinstance(event, StreamDataReceived):
+            session = self._session_handler
+            if (event.stream_id not in self._handlers and session is not None
+                    and session.chat_connection is not None and session.chat_connection.separate_streams):
+                # Another traffic class of the same session
+                self._handlers[event.stream_id] = session
             if event.stream_id not in self._handlers:
                 handler = ChatServerRequestHandler(
                     authority=self._quic.configuration.server_name,
@@ -90,49 +166,349 @@ class AsyncQuicServer(QuicConnectionProtocol):
                     transmit=self.transmit
                 )
                 self._handlers[event.stream_id] = handler
+                if session is None:
+                    self._session_handler = handler
                 handler.quic_event_received(event)
                 asyncio.ensure_future(handler.launch_chat())
             else:
                 handler = self._handlers[event.stream_id]
                 handler.quic_event_received(event)
+        elif isinstance(event, DatagramFrameReceived) and self._session_handler is not None:
+            self._session_handler.datagram_frame_received(event)
 
     def quic_event_received(self, event):
+        if isinstance(event, HandshakeCompleted):
+            self.handshake_done.set()
+            if self._mode == CLIENT_MODE and self._keep_alive_task is None:
+                self._keep_alive_task = asyncio.ensure_future(self.keep_alive())
+        elif isinstance(event, ConnectionTerminated):
+            self.connection_terminated(event)
+            return
         if self._mode == SERVER_MODE:
             self._quic_server_event_dispatch(event)
         else:
             self._quic_client_event_dispatch(event)
 
+    async def keep_alive(self) -> None:
+        # QUIC PINGs keep the connection from idling out; the server sees them
+        # as ordinary packets and no chat PDU has to be built or parsed
+        idle_timeout = self._quic.configuration.idle_timeout
+        peer_idle_timeout = self._quic._remote_max_idle_timeout
+        if peer_idle_timeout:
+            idle_timeout = min(idle_timeout, peer_idle_timeout)
+        try:
+            while True:
+                await asyncio.sleep(idle_timeout / PINGS_PER_IDLE_TIMEOUT)
+                await self.ping()
+        except ConnectionError:
+            pass
+
+    def connection_terminated(self, event: ConnectionTerminated) -> None:
+        # Closed by either side or dropped after the idle timeout: every stream
+        # sees its end so the session layer can clean up
+        reason = "idle_timeout" if event.reason_phrase == "Idle timeout" else "closed"
+        CONNECTIONS_TERMINATED.labels(reason).inc()
+        if log.debug_enabled:
+            log.debug("connection_terminated", reason=reason, error_code=event.error_code,
+                      phrase=event.reason_phrase)
+        if self._keep_alive_task is not None:
+            self._keep_alive_task.cancel()
+        self._backlogged.clear()
+        handlers = list(self._handlers.values())
+        if self._client_handler is not None:
+            handlers.append(self._client_handler)
+        for handler in handlers:
+            handler.connection_lost()
+
     def is_client(self) -> bool:
         return self._quic.configuration.is_client
 
 
+DEFAULT_TICKET_TTL = 24 * 3600  # Seconds a server keeps an issued session ticket
+
+
 class SessionTicketStore:
     """
-    Simple in-memory store for session tickets.
+    Simple in-memory store for session tickets. Tickets are evicted once they are
+    older than the TTL or past their own expiry, whichever comes first.
     """
 
-    def __init__(self) -> None:
-        self.tickets: Dict[bytes, SessionTicket] = {}
+    def __init__(self, ttl: float = DEFAULT_TICKET_TTL) -> None:
+        self.ttl = ttl
+        self.tickets: "OrderedDict[bytes, SessionTicket]" = OrderedDict()
+        self.expires: Dict[bytes, float] = {}
 
     def add(self, ticket: SessionTicket) -> None:
+        self.evict_expired()
         self.tickets[ticket.ticket] = ticket
+        self.expires[ticket.ticket] = time.time() + self.ttl
+
+    def pop(self, label: bytes) -> Optional[SessionTicket]:
+        ticket = self.tickets.pop(label, None)
+        expires = self.expires.pop(label, 0)
+        if ticket is None or expires < time.time() or not ticket.is_valid:
+            return None
+        return ticket
+
+    def evict_expired(self) -> None:
+        # Tickets are inserted in expiry order, so only the oldest need checking
+        now = time.time()
+        while self.tickets:
+            label = next(iter(self.tickets))
+            if self.expires[label] >= now:
+                break
+            self.discard(label)
+
+    def discard(self, label: bytes) -> None:
+        self.tickets.pop(label, None)
+        self.expires.pop(label, None)
+
+
+class FileSessionTicketStore(SessionTicketStore):
+    """
+    Session ticket store mirrored to a shelve file so tickets survive a restart.
+    """
+
+    def __init__(self, path: str, ttl: float = DEFAULT_TICKET_TTL) -> None:
+        super().__init__(ttl)
+        self.db = shelve.open(path)
+        now = time.time()
+        for key, (ticket, expires) in sorted(self.db.items(), key=lambda item: item[1][1]):
+            if expires >= now and ticket.is_valid:
+                self.tickets[ticket.ticket] = ticket
+                self.expires[ticket.ticket] = expires
+            else:
+                del self.db[key]
+        self.db.sync()
+
+    def add(self, ticket: SessionTicket) -> None:
+        super().add(ticket)
+        self.db[ticket.ticket.hex()] = (ticket, self.expires[ticket.ticket])
+        self.db.sync()
 
     def pop(self, label: bytes) -> Optional[SessionTicket]:
-        return self.tickets.pop(label, None)
+        self.db.pop(label.hex(), None)
+        self.db.sync()
+        return super().pop(label)
+
+    def discard(self, label: bytes) -> None:
+        super().discard(label)
+        self.db.pop(label.hex(), None)
 
 
-async def run_server(server, server_port, configuration):
-    print("[svr] Server starting...")
+class ClientSessionTicketCache:
+    """
+    Client-side file of the latest session ticket per server name.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.tickets: Dict[str, SessionTicket] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    self.tickets = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                self.tickets = {}
+
+    def get(self, server_name: str) -> Optional[SessionTicket]:
+        ticket = self.tickets.get(server_name)
+        if ticket is not None and ticket.is_valid:
+            return ticket
+        return None
+
+    def add(self, ticket: SessionTicket) -> None:
+        self.tickets[ticket.server_name] = ticket
+        with open(self.path, "wb") as f:
+            pickle.dump(self.tickets, f)
+
+
+class SharedSessionTicketStore:
+    """
+    Wraps one worker's ticket store and mirrors it to the other workers over the
+    bus, so a client can resume on whichever worker its next connection lands.
+    """
+
+    def __init__(self, store: SessionTicketStore, bus) -> None:
+        self.store = store
+        self.bus = bus
+        bus.register("ticket_add", self._remote_add)
+        bus.register("ticket_pop", self._remote_pop)
+
+    def add(self, ticket: SessionTicket) -> None:
+        self.store.add(ticket)
+        self.bus.publish({"op": "ticket_add",
+                          "ticket": base64.b64encode(pickle.dumps(ticket)).decode('ascii')})
+
+    def pop(self, label: bytes) -> Optional[SessionTicket]:
+        # Tickets are single use, so the other copies are dropped as well
+        self.bus.publish({"op": "ticket_pop", "label": label.hex()})
+        return self.store.pop(label)
+
+    def _remote_add(self, message) -> None:
+        self.store.add(pickle.loads(base64.b64decode(message["ticket"])))
+
+    def _remote_pop(self, message) -> None:
+        self.store.discard(bytes.fromhex(message["label"]))
+
+
+def tag_connection_id(cid: bytes, worker_index: int) -> bytes:
+    # The first byte of every server-issued connection ID names its worker
+    return bytes([worker_index]) + cid[1:]
+
+
+def connection_id_owner(cid: bytes, worker_count: int) -> Optional[int]:
+    if cid and cid[0] < worker_count:
+        return cid[0]
+    return None
+
+
+class WorkerQuicConnection(QuicConnection):
+    """
+    Server connection whose connection IDs are tagged with the owning worker.
+    """
+
+    def __init__(self, *args, worker_index: int = 0, **kwargs) -> None:
+        self.worker_index = worker_index
+        super().__init__(*args, **kwargs)
+        cid = tag_connection_id(self._host_cids[0].cid, worker_index)
+        self._host_cids[0].cid = cid
+        self.host_cid = cid
+        self._local_initial_source_connection_id = cid
+
+    def _replenish_connection_ids(self) -> None:
+        start = len(self._host_cids)
+        super()._replenish_connection_ids()
+        for connection_id in self._host_cids[start:]:
+            connection_id.cid = tag_connection_id(connection_id.cid, self.worker_index)
+
+
+class WorkerQuicServer(QuicServer):
+    """
+    QuicServer for one of several processes sharing a SO_REUSEPORT socket. The
+    kernel spreads packets by address, which is right for new connections but
+    not after a client's address changes, so packets for a connection ID owned
+    by another worker are forwarded to it over the bus.
+    """
+
+    def __init__(self, *, bus, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.bus = bus
+
+    def datagram_received(self, data, addr) -> None:
+        try:
+            header = pull_quic_header(Buffer(data=data),
+                                      host_cid_length=self._configuration.connection_id_length)
+        except ValueError:
+            return
+
+        if header.destination_cid not in self._protocols:
+            if header.packet_type == PACKET_TYPE_INITIAL:
+                if (len(data) >= SMALLEST_MAX_DATAGRAM_SIZE
+                        and header.version in self._configuration.supported_versions):
+                    self._accept(header)
+            else:
+                owner = connection_id_owner(header.destination_cid, self.bus.count)
+                if owner is not None and owner != self.bus.index:
+                    self.bus.forward_packet(owner, data, addr)
+                    return
+
+        super().datagram_received(data, addr)
+
+    def _accept(self, header) -> None:
+        # Same as the new-connection path in QuicServer (without retry),
+        # but with connection IDs tagged for this worker
+        connection = WorkerQuicConnection(
+            configuration=self._configuration,
+            original_destination_connection_id=header.destination_cid,
+            session_ticket_fetcher=self._session_ticket_fetcher,
+            session_ticket_handler=self._session_ticket_handler,
+            worker_index=self.bus.index,
+        )
+        protocol = self._create_protocol(connection, stream_handler=self._stream_handler)
+        protocol.connection_made(self._transport)
+        protocol._connection_id_issued_handler = partial(self._connection_id_issued, protocol=protocol)
+        protocol._connection_id_retired_handler = partial(self._connection_id_retired, protocol=protocol)
+        protocol._connection_terminated_handler = partial(self._connection_terminated, protocol=protocol)
+        self._protocols[header.destination_cid] = protocol
+        self._protocols[connection.host_cid] = protocol
+
+
+def reuseport_socket(host, port) -> socket.socket:
+    family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+    return sock
+
+
+async def run_server(server, server_port, configuration, ticket_store: Optional[SessionTicketStore] = None,
+                     on_started: Optional[Callable[[], None]] = None, backplane=None):
+    log.info("server_starting", host=server, port=server_port)
+    if backplane is not None:
+        await backplane.start()
+        chat_server.attach_backplane(backplane)
+    chat_server.start_idle_reaper()
+    if ticket_store is None:
+        ticket_store = SessionTicketStore()
+    # The same store must issue and redeem tickets for resumption to work
     await serve(server, server_port, configuration=configuration,
                 create_protocol=AsyncQuicServer,
-                session_ticket_fetcher=SessionTicketStore().pop,
-                session_ticket_handler=SessionTicketStore().add)
+                session_ticket_fetcher=ticket_store.pop,
+                session_ticket_handler=ticket_store.add)
+    if on_started is not None:
+        on_started()  # The UDP socket is bound
+    await asyncio.Future()
+
+
+async def run_worker_server(server, server_port, configuration, bus,
+                            ticket_store: Optional[SessionTicketStore] = None,
+                            on_started: Optional[Callable[[], None]] = None, backplane=None):
+    # The bus always carries forwarded packets and tickets between the workers;
+    # chat traffic goes over it too unless a cluster backplane is given
+    log.info("server_starting", host=server, port=server_port, worker=bus.index)
+    await bus.start()
+    try:
+        await serve_worker(server, server_port, configuration, bus, ticket_store, on_started, backplane)
+    finally:
+        # Tells the other workers (and the cluster) that this worker's users are gone
+        if backplane is not None:
+            backplane.close()
+        bus.close()
+
+
+async def serve_worker(server, server_port, configuration, bus, ticket_store, on_started, backplane):
+    if backplane is None:
+        backplane = bus
+    else:
+        await backplane.start()
+    if ticket_store is None:
+        ticket_store = SessionTicketStore()
+    ticket_store = SharedSessionTicketStore(ticket_store, bus)
+    loop = asyncio.get_running_loop()
+    _, quic_server = await loop.create_datagram_endpoint(
+        lambda: WorkerQuicServer(bus=bus, configuration=configuration,
+                                 create_protocol=AsyncQuicServer,
+                                 session_ticket_fetcher=ticket_store.pop,
+                                 session_ticket_handler=ticket_store.add),
+        sock=reuseport_socket(server, server_port))
+    bus.on_packet = quic_server.datagram_received
+    chat_server.attach_backplane(backplane)
+    chat_server.start_idle_reaper()
+    if on_started is not None:
+        on_started()
     await asyncio.Future()
 
 
-async def run_client(server, server_port, configuration):
+async def run_client(server, server_port, configuration, session_ticket_handler=None):
+    # With a resumable ticket, skip waiting for the handshake so the first
+    # PDUs can go out as 0-RTT early data.
+    early_data = (configuration.session_ticket is not None
+                  and configuration.session_ticket.max_early_data_size is not None)
     async with connect(server, server_port, configuration=configuration,
-                       create_protocol=AsyncQuicServer) as client:
+                       create_protocol=AsyncQuicServer,
+                       session_ticket_handler=session_ticket_handler,
+                       wait_connected=not early_data) as client:
         await asyncio.ensure_future(client._client_handler.launch_chat())
 
 
@@ -155,32 +531,204 @@ class ChatServerRequestHandler:
         self.scope = scope
         self.stream_id = stream_id
         self.transmit = transmit
+        self.decoders: Dict[int, pdu.StreamDecoder] = {}
+        self.outbound = OutboundQueue()
+        self.batcher: Optional[Batcher] = None  # Set once both peers agreed on FEATURE_BATCH
+        self.drain_handle: Optional[asyncio.TimerHandle] = None  # Frames gathering to be coalesced
+        self.chat_connection: Optional[ChatQuicConnection] = None
+        self.on_message: Optional[Callable] = None  # Set in direct dispatch mode, see dispatch_directly
+        self.dispatching = False
+        self.in_flight: Optional[asyncio.Task] = None  # Handler that had to wait, with the events behind it
 
         if stream_ended:
             self.queue.put_nowait({"type": "quic.stream_end"})
 
     def quic_event_received(self, event: StreamDataReceived) -> None:
-        self.queue.put_nowait(
-            QuicStreamEvent(event.stream_id, event.data,
-                            event.end_stream)
-        )
+        # A chunk may hold part of a frame or several frames, so decode per stream
+        BYTES_RECEIVED.inc(len(event.data))
+        decoder = self.decoders.get(event.stream_id)
+        if decoder is None:
+            decoder = self.decoders[event.stream_id] = pdu.StreamDecoder()
+        try:
+            datagrams = decoder.feed(event.data)
+        except Exception as e:
+            # Any frame that does not decode ends the connection; the bad bytes
+            # go with the decoder so they are not decoded again
+            log.warning("malformed_frame", stream_id=event.stream_id, error=repr(e))
+            self.decoders.pop(event.stream_id, None)
+            self.connection.close(reason_phrase="Malformed frame")
+            self.transmit()
+            return
+        for datagram in datagrams:
+            self.deliver(QuicStreamEvent(event.stream_id, None, False, datagram))
+        if event.end_stream:
+            self.decoders.pop(event.stream_id, None)
+            # Only the end of the control stream ends the session
+            if self.stream_id is None or event.stream_id == self.stream_id:
+                self.deliver(QuicStreamEvent(event.stream_id, None, True))
+
+    def deliver(self, event: QuicStreamEvent) -> None:
+        # Events wait in the queue for receive(), unless they can be handled
+        # right away in direct dispatch mode
+        if self.on_message is None or self.dispatching or self.in_flight is not None:
+            self.queue.put_nowait(event)
+        else:
+            self._dispatch(event)
+
+    def dispatch_directly(self, on_message: Callable) -> None:
+        # From now on events go straight to on_message, which returns None
+        # once an event is handled or an awaitable it is still waiting on
+        self.on_message = on_message
+        self._dispatch(None)
+
+    def _dispatch(self, event: Optional[QuicStreamEvent]) -> None:
+        # Handles events inline until one has to wait. That one and the events
+        # that arrive meanwhile are finished in a task, in order; a handler
+        # reading receive() in the meantime gets them from the queue.
+        self.dispatching = True
+        try:
+            pending = self.on_message(event) if event is not None else None
+            while pending is None and not self.queue.empty():
+                pending = self.on_message(self.queue.get_nowait())
+        finally:
+            self.dispatching = False
+        if pending is not None:
+            self.in_flight = asyncio.ensure_future(self._finish_dispatch(pending))
+
+    async def _finish_dispatch(self, pending) -> None:
+        try:
+            await pending
+            while not self.queue.empty():
+                pending = self.on_message(self.queue.get_nowait())
+                if pending is not None:
+                    await pending
+        finally:
+            self.in_flight = None
+
+    def datagram_frame_received(self, event: DatagramFrameReceived) -> None:
+        # Each DATAGRAM frame holds one whole frame; anything but an ephemeral
+        # type would lose the stream its reply goes to, so it is dropped
+        BYTES_RECEIVED.inc(len(event.data))
+        try:
+            datagram = pdu.decode_frame(event.data)
+        except Exception as e:
+            log.warning("malformed_datagram", error=repr(e))
+            return
+        if datagram.mtype not in pdu.EPHEMERAL_TYPES:
+            log.warning("unexpected_datagram", mtype=datagram.mtype)
+            return
+        DATAGRAMS_RECEIVED.inc()
+        self.deliver(QuicStreamEvent(None, None, False, datagram))
+
+    def send_datagram(self, data: bytes) -> bool:
+        # False when the frame has to go on a stream instead
+        limit = self.connection._remote_max_datagram_frame_size
+        if limit is None or len(data) > min(limit, MAX_DATAGRAM_PAYLOAD):
+            DATAGRAM_FALLBACKS.inc()
+            return False
+        self.connection.send_datagram_frame(data)
+        DATAGRAMS_SENT.inc()
+        self.protocol.schedule_transmit()
+        return True
+
+    def open_stream(self) -> int:
+        # Server pushes go on unidirectional streams, client streams also carry
+        # the server's replies. Writing nothing creates the stream right away,
+        # so the next call gets a new ID even before any data is queued.
+        unidirectional = not self.connection.configuration.is_client
+        stream_id = self.connection.get_next_available_stream_id(is_unidirectional=unidirectional)
+        self.connection.send_stream_data(stream_id, b"")
+        return stream_id
+
+    def connection_lost(self) -> None:
+        self.outbound.clear()
+        self.deliver(QuicStreamEvent(self.stream_id, None, True))
 
     async def receive(self) -> QuicStreamEvent:
         queue_item = await self.queue.get()
         return queue_item
 
     async def send(self, message: QuicStreamEvent) -> None:
-        self.connection.send_stream_data(
-            stream_id=message.stream_id,
-            data=message.data,
-            end_stream=message.end_stream
-        )
-
+        if self.batch(message):
+            return
+        self.enqueue(message)
+        self.drain()
         self.transmit()
 
+    def send_nowait(self, message: QuicStreamEvent) -> None:
+        if self.batch(message):
+            return
+        if self.enqueue(message):
+            self.protocol.schedule_transmit()
+
+    def enable_batching(self) -> None:
+        # Frames the outbound scheduler picks for one stream in the same drain
+        # go out as one batch, so batching does not undo its ordering
+        if batch_config.enabled:
+            self.outbound.coalesce = batch_config.max_messages
+
+    def batch(self, message: QuicStreamEvent) -> bool:
+        # True when the frame was left to the batcher
+        if self.batcher is None:
+            return False
+        if message.end_stream or message.data[0] == pdu.JSON_FRAME_START:
+            # Sent on its own, after everything batched before it
+            self.batcher.flush()
+            return False
+        self.batcher.add(message.stream_id, message.data)
+        return True
+
+    def send_batch(self, stream_id, data) -> None:
+        self.enqueue(QuicStreamEvent(stream_id, data, False))
+        self.protocol.schedule_transmit()
+
+    def enqueue(self, message: QuicStreamEvent) -> bool:
+        # True when the frame is due with the next drain
+        if not self.outbound.put(message.stream_id, message.data, message.end_stream,
+                                 message.traffic, message.sender):
+            if self.outbound.policy == POLICY_DISCONNECT:
+                log.warning("slow_consumer_disconnected", stream_id=self.stream_id, **self.outbound.stats())
+                self.outbound.clear()
+                self.protocol.set_backlogged(self, False)
+                self.connection.close(reason_phrase="Slow consumer")
+                self.protocol.schedule_transmit()
+            return False
+        if self.outbound.coalesce > 1 and len(self.outbound) < self.outbound.coalesce:
+            # Frames gather for up to the batch delay, then are scheduled together
+            if self.drain_handle is None:
+                self.drain_handle = asyncio.get_event_loop().call_later(batch_config.max_delay, self.drain_later)
+            return False
+        self.protocol.set_backlogged(self, True)
+        return True
+
+    def drain_later(self) -> None:
+        self.drain_handle = None
+        self.protocol.set_backlogged(self, True)
+        self.protocol.schedule_transmit()
+
+    def drain(self) -> None:
+        self.outbound.drain(self.connection)
+        if not self.outbound:
+            self.protocol.set_backlogged(self, False)
+
+    def queue_stats(self) -> Dict:
+        stats = self.outbound.stats()
+        if self.batcher is not None:
+            stats.update(self.batcher.stats())
+        return stats
+
     def close(self) -> None:
+        if self.batcher is not None:
+            self.batcher.flush()
+        if self.drain_handle is not None:
+            self.drain_handle.cancel()
+            self.drain_handle = None
+        self.drain()
         self.protocol.remove_handler(self.stream_id)
         self.connection.close()
+        self.protocol.schedule_transmit()
+        # Wake a receive() still waiting on this stream
+        self.deliver(QuicStreamEvent(self.stream_id, None, True))
 
 # def close(self) -> None:
     #     self.protocol.remove_handler(self.stream_id)
@@ -188,7 +736,12 @@ class ChatServerRequestHandler:
 
     async def launch_chat(self):
         qc = ChatQuicConnection(self.send,
-                                self.receive, self.close, None)
+                                self.receive, self.close, None,
+                                self.send_nowait, self.queue_stats,
+                                self.protocol.handshake_done, self.enable_batching,
+                                self.open_stream, self.send_datagram, self.dispatch_directly)
+        qc.control_stream = self.stream_id
+        self.chat_connection = qc
         await chat_server.chat_server_proto(self.scope,
                                             qc)
 
@@ -200,9 +753,23 @@ class ChatClientRequestHandler(ChatServerRequestHandler):
     def get_next_stream_id(self) -> int:
         return self.connection.get_next_available_stream_id()
 
-    async def launch_chat(self):
+    def enable_batching(self) -> None:
+        # Everything comes from this one user, so frames are batched as they are written
+        if batch_config.enabled and self.batcher is None:
+            self.batcher = Batcher(self.send_batch)
+
+    def make_connection(self) -> ChatQuicConnection:
         qc = ChatQuicConnection(self.send,
                                 self.receive, self.close,
-                                self.get_next_stream_id)
+                                self.get_next_stream_id,
+                                self.send_nowait, self.queue_stats,
+                                self.protocol.handshake_done, self.enable_batching,
+                                self.open_stream, self.send_datagram)
+        session_ticket = self.connection.configuration.session_ticket
+        qc.early_data = (session_ticket is not None
+                         and session_ticket.max_early_data_size is not None)
+        return qc
+
+    async def launch_chat(self):
         await chat_client.chat_client_proto(self.scope,
-                                            qc)
+                                            self.make_connection())
@@ -0,0 +1,59 @@
+import time
+from typing import Optional
+
+from metrics import metrics
+
+DEFAULT_SENDER_RATE = 20.0  # Messages per second a user may send to others, 0 for no limit
+DEFAULT_SENDER_BURST = 40   # Messages a user may send at once after being quiet
+
+RATE_LIMITED = metrics.counter("chat_rate_limited_total", "Messages refused by the per-sender rate limit, by type",
+                               ("type",))
+
+
+class TokenBucket:
+    """
+    Holds up to capacity tokens, refilled at rate tokens per second. Each
+    message takes one; a sender with none left has to wait for the refill.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, cost=1, now=None) -> bool:
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class SenderLimits:
+    def __init__(self, rate=DEFAULT_SENDER_RATE, burst=DEFAULT_SENDER_BURST):
+        self.rate = rate
+        self.burst = burst
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def configure(self, rate=None, burst=None):
+        if rate is not None:
+            self.rate = rate
+        if burst is not None:
+            self.burst = burst
+
+    def bucket(self) -> Optional[TokenBucket]:
+        # A fresh bucket for one session, None when senders are not limited
+        if not self.enabled:
+            return None
+        return TokenBucket(self.rate, max(self.burst, 1))
+
+
+sender_limits = SenderLimits()
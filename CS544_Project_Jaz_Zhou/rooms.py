@@ -0,0 +1,71 @@
+from typing import Dict, List, Set
+
+MAX_ROOM_NAME = 64
+MAX_ROOMS_PER_USER = 256
+
+
+class RoomRegistry:
+    """
+    Named rooms indexed both ways: room -> members and member -> rooms. Fan-out
+    to a room is one dict lookup, and dropping a user touches only the rooms
+    that user is in. Members are presence sessions, so a room can hold users
+    connected to other backplane nodes; empty rooms are deleted.
+    """
+
+    def __init__(self):
+        self.members: Dict[str, Dict[int, object]] = {}  # room -> user_id -> session
+        self.rooms_of: Dict[int, Set[str]] = {}  # user_id -> rooms
+
+    @staticmethod
+    def valid_name(room) -> bool:
+        return isinstance(room, str) and 0 < len(room) <= MAX_ROOM_NAME and room.isprintable()
+
+    def join(self, room, session) -> bool:
+        # False if the user is already in the room
+        rooms = self.rooms_of.setdefault(session.user_id, set())
+        if room in rooms:
+            return False
+        rooms.add(room)
+        self.members.setdefault(room, {})[session.user_id] = session
+        return True
+
+    def leave(self, room, user_id) -> bool:
+        rooms = self.rooms_of.get(user_id)
+        if rooms is None or room not in rooms:
+            return False
+        rooms.discard(room)
+        if not rooms:
+            del self.rooms_of[user_id]
+        self._remove_member(room, user_id)
+        return True
+
+    def leave_all(self, user_id) -> List[str]:
+        rooms = self.rooms_of.pop(user_id, ())
+        for room in rooms:
+            self._remove_member(room, user_id)
+        return list(rooms)
+
+    def _remove_member(self, room, user_id):
+        members = self.members[room]
+        del members[user_id]
+        if not members:
+            del self.members[room]
+
+    def is_member(self, room, user_id) -> bool:
+        return room in self.rooms_of.get(user_id, ())
+
+    def sessions(self, room):
+        members = self.members.get(room)
+        return members.values() if members is not None else ()
+
+    def size(self, room) -> int:
+        return len(self.members.get(room, ()))
+
+    def rooms_for(self, user_id) -> List[str]:
+        return sorted(self.rooms_of.get(user_id, ()))
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+
+rooms = RoomRegistry()
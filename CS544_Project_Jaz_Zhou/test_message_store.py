@@ -0,0 +1,102 @@
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+
+from message_store import OfflineMessageStore, SEGMENT_SUFFIX
+
+
+class OfflineMessageStoreTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = tmp.name
+
+    def open_store(self, **kwargs):
+        store = OfflineMessageStore()
+        store.open(self.directory, **kwargs)
+        self.addCleanup(store.executor.shutdown, wait=True)
+        return store
+
+    def segment_files(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def assert_segments_match_disk(self, store):
+        self.assertEqual([os.path.basename(segment.path) for segment in store.segments], self.segment_files())
+
+    async def test_reopen_after_roll_and_delivery(self):
+        # Room for two messages per segment
+        store = self.open_store(segment_bytes=130, commit_interval=0)
+        alice = [await store.append("alice", 3, f"to alice {i}") for i in range(4)]
+        bob = [await store.append("bob", 3, f"to bob {i}") for i in range(2)]
+        self.assertEqual(len(store.segments), 3)
+        self.assertEqual([m for _, _, m in await store.fetch("alice")], [f"to alice {i}" for i in range(4)])
+
+        store.mark_delivered("alice", alice[-1])
+        await store.sync()
+        self.assertFalse(store.has_pending("alice"))
+        # The two segments of alice's messages are gone, bob's and the marker's stay
+        self.assertIs(store.segments[0], store.inboxes["bob"][0][1])
+        self.assertEqual(len(store.segments), 2)
+        self.assert_segments_match_disk(store)
+
+        reopened = self.open_store(segment_bytes=130, commit_interval=0)
+        self.assertFalse(reopened.has_pending("alice"))
+        self.assertEqual(await reopened.fetch("bob"), [(seq, 3, f"to bob {i}") for i, seq in enumerate(bob)])
+        self.assertGreater(reopened.next_seq, bob[-1])
+        self.assert_segments_match_disk(reopened)
+
+    async def test_truncated_final_record(self):
+        store = self.open_store(commit_interval=0)
+        seqs = [await store.append("alice", 3, f"message {i}") for i in range(3)]
+        path = store.segments[-1].path
+        size = os.path.getsize(path)
+        # A crash in the middle of the last write
+        with open(path, "r+b") as f:
+            f.truncate(size - 5)
+
+        reopened = self.open_store(commit_interval=0)
+        self.assertEqual([seq for seq, _, _ in await reopened.fetch("alice")], seqs[:2])
+        self.assertEqual(os.path.getsize(path), reopened.segments[-1].size)
+
+        # Appends after recovery go after the last good record and survive another reopen
+        seq = await reopened.append("alice", 3, "after the crash")
+        self.assertEqual(seq, seqs[1] + 1)
+        again = self.open_store(commit_interval=0)
+        self.assertEqual([m for _, _, m in await again.fetch("alice")], ["message 0", "message 1", "after the crash"])
+
+    async def test_compact_while_write_in_flight(self):
+        store = self.open_store(segment_bytes=1, max_batch=1)
+        first = store.segments[0]
+        # Hold the writer thread so the commit of the next append stays in flight
+        release = threading.Event()
+        blocker = store.executor.submit(release.wait)
+        self.addCleanup(release.set)  # Runs before the executor shutdown, even if an assertion fails
+        append = asyncio.create_task(store.append("alice", 3, "hello"))
+        await asyncio.sleep(0)
+        self.assertTrue(store.flushing)
+        self.assertEqual(first.unwritten, 1)
+
+        # Delivered before it is written: nothing in the segment is live, but it must stay
+        (seq, _, _, _), = store.inboxes["alice"]
+        store.mark_delivered("alice", seq)
+        self.assertEqual(first.live, 0)
+        self.assertIs(store.segments[0], first)
+
+        release.set()
+        await asyncio.wrap_future(blocker)
+        await append
+        await store.sync()
+        # Compacted once the write finished, and not created again by the writer
+        self.assertNotIn(first, store.segments)
+        self.assertFalse(os.path.exists(first.path))
+        self.assert_segments_match_disk(store)
+
+        reopened = self.open_store()
+        self.assertFalse(reopened.has_pending("alice"))
+        self.assertEqual(reopened.next_seq, store.next_seq)
+
+
+if __name__ == "__main__":
+    unittest.main()
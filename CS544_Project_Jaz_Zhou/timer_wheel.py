@@ -0,0 +1,171 @@
+import asyncio
+import math
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from log import log
+
+DEFAULT_TICK = 1.0            # Seconds per tick of the innermost wheel
+DEFAULT_SLOTS = 64            # Slots per wheel
+DEFAULT_LEVELS = 4            # 64 ** 4 one-second ticks is about 194 days
+DEFAULT_IDLE_TIMEOUT = 90.0   # Three missed client keep-alives
+
+
+class TimerWheel:
+    """
+    Hierarchical timing wheel. Each level is a ring of slots, a slot of level n
+    covering slots ** n ticks; a key sits in the coarsest slot that still
+    separates its deadline from the current tick and moves down a level when
+    that slot comes round. Scheduling, re-scheduling and cancelling are O(1),
+    and advancing one tick only touches the keys due around it.
+
+    Pushing a deadline further out (the common case for activity timers) only
+    records the new deadline; the key is re-filed when its old slot expires.
+    """
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, levels=DEFAULT_LEVELS, now=0.0):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.wheels: List[List[Set[Hashable]]] = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.deadlines: Dict[Hashable, int] = {}  # key -> deadline in ticks
+        self.locations: Dict[Hashable, Tuple[int, int]] = {}  # key -> (level, slot)
+        self.origin = now
+        self.current = 0  # Last tick processed
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def __contains__(self, key) -> bool:
+        return key in self.deadlines
+
+    def schedule(self, key, delay):
+        # Expire key delay seconds from now, replacing any earlier schedule
+        deadline = self.current + max(1, math.ceil(delay / self.tick))
+        previous = self.deadlines.get(key)
+        self.deadlines[key] = deadline
+        if previous is not None:
+            if deadline >= previous:
+                return
+            self._unlink(key)
+        self._place(key, deadline)
+
+    def cancel(self, key) -> bool:
+        if self.deadlines.pop(key, None) is None:
+            return False
+        self._unlink(key)
+        return True
+
+    def advance(self, now) -> List[Hashable]:
+        # Process every tick up to now and return the keys that expired
+        target = int((now - self.origin) / self.tick)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            # Outer slots come due first so their keys can fall all the way down
+            level = 1
+            span = self.slots
+            while level < self.levels and self.current % span == 0:
+                level += 1
+                span *= self.slots
+            for outer in range(level - 1, 0, -1):
+                self._cascade(outer)
+            slot = self.current % self.slots
+            due = self.wheels[0][slot]
+            self.wheels[0][slot] = set()
+            for key in due:
+                deadline = self.deadlines[key]
+                if deadline <= self.current:
+                    del self.deadlines[key]
+                    del self.locations[key]
+                    expired.append(key)
+                else:
+                    self._place(key, deadline)
+        return expired
+
+    def _cascade(self, level):
+        slot = (self.current // self.slots ** level) % self.slots
+        keys = self.wheels[level][slot]
+        self.wheels[level][slot] = set()
+        for key in keys:
+            self._place(key, self.deadlines[key])
+
+    def _place(self, key, deadline):
+        level = 0
+        span = 1
+        while level < self.levels - 1 and deadline // span - self.current // span >= self.slots:
+            level += 1
+            span *= self.slots
+        # Beyond the outermost wheel: park in its last slot and re-file from there
+        position = min(deadline // span, self.current // span + self.slots - 1)
+        slot = position % self.slots
+        self.wheels[level][slot].add(key)
+        self.locations[key] = (level, slot)
+
+    def _unlink(self, key):
+        level, slot = self.locations.pop(key)
+        self.wheels[level][slot].discard(key)
+
+
+class IdleTracker:
+    """
+    Last-activity tracking for sessions. Every received PDU re-arms the
+    session's entry in one timer wheel, which a single task advances once per
+    tick, so tracking costs a dict write per message and no asyncio timer per
+    session. Sessions that stay silent for the timeout are handed to the
+    callback together, one list per tick.
+    """
+
+    def __init__(self):
+        self.timeout = DEFAULT_IDLE_TIMEOUT
+        self.tick = DEFAULT_TICK
+        self.wheel: Optional[TimerWheel] = None
+        self.on_idle: Optional[Callable[[List[Hashable]], None]] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.timeout > 0
+
+    def configure(self, timeout=None, tick=None):
+        if timeout is not None:
+            self.timeout = timeout
+        if tick is not None:
+            self.tick = tick
+
+    def start(self, on_idle: Callable[[List[Hashable]], None]):
+        if not self.enabled or self.task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self.on_idle = on_idle
+        self.wheel = TimerWheel(self.tick, now=loop.time())
+        self.task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def touch(self, key):
+        if self.wheel is not None:
+            self.wheel.schedule(key, self.timeout)
+
+    def forget(self, key):
+        if self.wheel is not None:
+            self.wheel.cancel(key)
+
+    def __len__(self) -> int:
+        return len(self.wheel) if self.wheel is not None else 0
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.tick)
+            expired = self.wheel.advance(loop.time())
+            if expired:
+                try:
+                    self.on_idle(expired)
+                except Exception as e:
+                    log.error("idle_callback_failed", error=repr(e), count=len(expired))
+
+
+idle_sessions = IdleTracker()
@@ -1,52 +1,196 @@
 import bcrypt
+import itertools
+from abc import ABC, abstractmethod
+import sqlite3
 import threading
+import pdu
+from auth_pool import auth_pool
 
-class UserDatabase:
+# Example user database. The bcrypt hashes are precomputed (password == username)
+# so that importing this module does no hashing.
+DEMO_USERS = {
+    "one": b"$2b$12$CntUml7VrBBhKM.4PR0poeofO6yoLSG9LkeIoeMN5G7tbDfoyV5cm",
+    "two": b"$2b$12$/gN8anilmK2XvoNAH74Jx..4Qi3xY/u4aauZFngcENG6Pv0aPFNN6",
+    "three": b"$2b$12$.xKwER8.Apf8EB/IXrwPs.LfJv63jWUWGsLH6N.7Zf1SLtiHhonnq",
+    "micheal": b"$2b$12$3o3ck8ZrExxDRb0vCongXO/2koPU5/ivI9me6GQQ29ONG4gzE/ily",
+    "pam": b"$2b$12$ah4gbxJGruNoPy.Fhv7Nhe/hS6xGngdFY4cMCHlqRxin/jPspAaOK",
+    "dwight": b"$2b$12$JSjQvPcZ0oEIS76jD9iq1eBRXTg2AfSJIdnXlapjgpyohfbzeJp9C",
+}
+
+
+class UserStore(ABC):
+    """
+    Storage backend for account credentials (username -> bcrypt hash).
+    """
+
+    @abstractmethod
+    def get_password_hash(self, username):
+        pass
+
+    @abstractmethod
+    def add_user(self, username, password_hash):
+        pass
+
+    @abstractmethod
+    def add_users(self, users):
+        pass
+
+    @abstractmethod
+    def is_empty(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryUserStore(UserStore):
     def __init__(self):
-        # Example user database
-        self.users = {
-            "one": bcrypt.hashpw("one".encode(), bcrypt.gensalt()),
-            "two": bcrypt.hashpw("two".encode(), bcrypt.gensalt()),
-            "three": bcrypt.hashpw("three".encode(), bcrypt.gensalt())
-            "micheal": bcrypt.hashpw("micheal".encode(), bcrypt.gensalt()),
-            "pam": bcrypt.hashpw("pam".encode(), bcrypt.gensalt()),
-            "dwight": bcrypt.hashpw("dwight".encode(), bcrypt.gensalt())
-        }
-        self.active_users = {}  # Maps user ID to username
-        self.user_id_counter = 0
+        self.users = {}
+
+    def get_password_hash(self, username):
+        return self.users.get(username)
+
+    def add_user(self, username, password_hash):
+        if username in self.users:
+            return False
+        self.users[username] = password_hash
+        return True
+
+    def add_users(self, users):
+        added = 0
+        for username, password_hash in users:
+            added += self.add_user(username, password_hash)
+        return added
+
+    def is_empty(self):
+        return not self.users
+
+
+# Fixed SQL text so sqlite3 reuses its cached prepared statements
+SQL_CREATE_USERS = ("CREATE TABLE IF NOT EXISTS users ("
+                    "username TEXT PRIMARY KEY, password_hash BLOB NOT NULL) WITHOUT ROWID")
+SQL_GET_HASH = "SELECT password_hash FROM users WHERE username = ?"
+SQL_INSERT_USER = "INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)"
+SQL_ANY_USER = "SELECT 1 FROM users LIMIT 1"
+
+
+class SQLiteUserStore(UserStore):
+    """
+    SQLite-backed store. Rows are keyed by username (a clustered primary key), so
+    lookups are a single index probe and accounts are never loaded into memory.
+    """
+
+    def __init__(self, path, batch_size=10000):
+        self.path = path
+        self.batch_size = batch_size
         self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SQL_CREATE_USERS)
+
+    def get_password_hash(self, username):
+        with self.lock:
+            row = self.db.execute(SQL_GET_HASH, (username,)).fetchone()
+        return row[0] if row else None
+
+    def add_user(self, username, password_hash):
+        with self.lock:
+            cursor = self.db.execute(SQL_INSERT_USER, (username, password_hash))
+        return cursor.rowcount == 1
+
+    def add_users(self, users):
+        # Insert in batches, one transaction per batch
+        added = 0
+        batch = []
+        for user in users:
+            batch.append(user)
+            if len(batch) >= self.batch_size:
+                added += self._insert_batch(batch)
+                batch = []
+        if batch:
+            added += self._insert_batch(batch)
+        return added
+
+    def _insert_batch(self, batch):
+        with self.lock:
+            before = self.db.total_changes
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(SQL_INSERT_USER, batch)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            return self.db.total_changes - before
+
+    def is_empty(self):
+        with self.lock:
+            return self.db.execute(SQL_ANY_USER).fetchone() is None
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def check_username(username):
+    # Usernames end up in conversation names, see pdu.valid_username
+    if not pdu.valid_username(username):
+        raise ValueError(f"Invalid username {username!r}: it must be non-empty and contain no ':' or ','")
+    return username
+
+
+class UserDatabase:
+    def __init__(self, store=None):
+        self.store = None
+        self.use_store(store if store is not None else MemoryUserStore())
+        self.user_id_counter = itertools.count(1)
+        self.id_offset = 0
+        self.id_stride = 1
+
+    def use_store(self, store, seed_demo_users=True):
+        # Seed the example accounts into an empty store so the demo logins work
+        if seed_demo_users and store.is_empty():
+            store.add_users(DEMO_USERS.items())
+        if self.store is not None:
+            self.store.close()
+        self.store = store
 
     def authenticate(self, username, password):
-        if username in self.users:
+        if not pdu.valid_username(username):
+            return False
+        hashed = self.store.get_password_hash(username)
+        if hashed is not None:
             # Check the hashed password
-            if bcrypt.checkpw(password.encode(), self.users[username]):
+            if bcrypt.checkpw(password.encode(), hashed):
                 return True
         return False
 
+    async def authenticate_async(self, username, password):
+        # Same check as authenticate, run on the auth pool: both the store
+        # lookup and bcrypt would otherwise block the event loop
+        return await auth_pool.run(self.authenticate, username, password)
+
     def add_user(self, username, password):
         # This function can be used to add new users with a hashed password
-        with self.lock:
-            if username not in self.users:
-                self.users[username] = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
-                return True
-        return False
+        check_username(username)
+        return self.store.add_user(username, bcrypt.hashpw(password.encode(), bcrypt.gensalt()))
 
-    def generate_unique_user_id(self):
-        with self.lock:
-            self.user_id_counter += 1
-            return self.user_id_counter
-
-    def add_active_user(self, user_id, username):
-        self.active_users[user_id] = username
+    def import_users(self, credentials, rounds=12):
+        # Bulk import of (username, password) pairs, hashed here and inserted in batches
+        return self.store.add_users(
+            (check_username(username), bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds)))
+            for username, password in credentials)
 
-    def remove_active_user(self, user_id):
-        if user_id in self.active_users:
-            del self.active_users[user_id]
+    def configure_id_space(self, offset, stride):
+        # Workers and cluster nodes draw IDs from disjoint residue classes
+        # (offset mod stride), so they never hand out the same ID without
+        # talking to each other.
+        self.id_offset = offset
+        self.id_stride = stride
 
-    def get_active_users(self):
-        return [{"user_id": user_id, "username": username} for user_id, username in self.active_users.items()]
-
-    def get_username(self, user_id):
-        return self.active_users[user_id]
+    def generate_unique_user_id(self):
+        # next() on itertools.count is atomic under the GIL, so no lock is needed
+        return next(self.user_id_counter) * self.id_stride + self.id_offset
 
 user_db = UserDatabase()
@@ -0,0 +1,217 @@
+import asyncio
+import json
+import os
+import socket
+import struct
+from typing import Dict, List
+
+from backplane import Backplane
+from log import log
+
+KIND_MESSAGE = 0  # JSON control or chat message, dispatched on its "op"
+KIND_PACKET = 1   # Raw QUIC packet that reached the wrong worker
+KIND_CHUNK = 2    # Part of a JSON message too large for one datagram
+
+PACKET_HEADER = struct.Struct("!BH")  # kind, length of the JSON peer address
+CHUNK_HEADER = struct.Struct("!BIHH")  # kind, message number, chunk index, chunk count
+
+# Datagrams above the socket send buffer (about 208 KB by default on Linux)
+# fail with EMSGSIZE, so larger messages go in chunks of this size
+MAX_DATAGRAM = 60 * 1024
+
+PEER_WAIT = 5.0  # Seconds start() waits for the other workers to bind their sockets
+
+
+def socket_path(socket_dir, index):
+    return os.path.join(socket_dir, f"worker-{index}.sock")
+
+
+class WorkerBus(Backplane, asyncio.DatagramProtocol):
+    """
+    IPC between the worker processes of one server. Every worker binds a Unix
+    datagram socket in a shared directory and sends to its peers by index, so a
+    message is a single sendto with no broker in between. Node IDs are the
+    worker indexes.
+
+    Messages larger than MAX_DATAGRAM, such as presence snapshots of a busy
+    server, are split into chunks. Datagrams from one socket arrive in order,
+    so the receiver joins chunks per sender and drops a message that is
+    missing one.
+
+    A worker announces node_down when its bus closes; the parent process does
+    the same for a worker that exited without closing it. Workers that are down
+    get no further messages.
+    """
+
+    def __init__(self, socket_dir, index, count):
+        super().__init__(index)
+        self.socket_dir = socket_dir
+        self.index = index
+        self.count = count
+        self.transport = None
+        self.on_packet = None  # Called with (data, addr) for forwarded QUIC packets
+        self.packets_forwarded = 0
+        self.send_errors = 0
+        self.next_chunked = 0  # Number of the next message sent in chunks
+        self.partial = {}  # Sender socket path -> (message number, chunks received so far)
+        self.chunked_sent = 0
+        self.receive_errors = 0
+        self.down = set()  # Indexes of workers that have exited
+
+    async def start(self):
+        path = socket_path(self.socket_dir, self.index)
+        if os.path.exists(path):
+            os.unlink(path)
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=path, family=socket.AF_UNIX)
+        await self._wait_for_peers()
+
+    async def _wait_for_peers(self):
+        # Workers start together, so the first messages (presence_sync) would
+        # otherwise reach sockets that are not bound yet
+        deadline = asyncio.get_running_loop().time() + PEER_WAIT
+        while True:
+            missing = [i for i in self.peers() if not os.path.exists(socket_path(self.socket_dir, i))]
+            if not missing:
+                return
+            if asyncio.get_running_loop().time() >= deadline:
+                log.warning("worker_bus_peers_missing", worker=self.index, missing=missing)
+                return
+            await asyncio.sleep(0.01)
+
+    def peers(self):
+        return [i for i in range(self.count) if i != self.index and i not in self.down]
+
+    def send(self, worker, message: Dict):
+        if worker in self.down:
+            return
+        self.messages_sent += 1
+        for data in self._encode(message):
+            self._sendto(worker, data)
+
+    def publish(self, message: Dict):
+        # Encoded once and sent to every other worker
+        datagrams = self._encode(message)
+        for worker in self.peers():
+            self.messages_sent += 1
+            for data in datagrams:
+                self._sendto(worker, data)
+
+    def _encode(self, message: Dict) -> List[bytes]:
+        body = json.dumps(message).encode('utf-8')
+        if len(body) < MAX_DATAGRAM:
+            return [bytes([KIND_MESSAGE]) + body]
+        size = MAX_DATAGRAM - CHUNK_HEADER.size
+        count = -(-len(body) // size)
+        number = self.next_chunked
+        self.next_chunked = (number + 1) & 0xFFFFFFFF
+        self.chunked_sent += 1
+        return [CHUNK_HEADER.pack(KIND_CHUNK, number, index, count) + body[index * size:(index + 1) * size]
+                for index in range(count)]
+
+    def forward_packet(self, worker, data, addr):
+        if worker in self.down:
+            return  # The connection died with its worker
+        peer = json.dumps(list(addr)).encode('utf-8')
+        self.packets_forwarded += 1
+        self._sendto(worker, PACKET_HEADER.pack(KIND_PACKET, len(peer)) + peer + data)
+
+    def _sendto(self, worker, data):
+        if self.transport is not None:
+            self.transport.sendto(data, socket_path(self.socket_dir, worker))
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            kind = data[0]
+            if kind == KIND_PACKET:
+                _, length = PACKET_HEADER.unpack_from(data)
+                start = PACKET_HEADER.size
+                peer = tuple(json.loads(data[start:start + length]))
+                if self.on_packet is not None:
+                    self.on_packet(data[start + length:], peer)
+                return
+            if kind == KIND_CHUNK:
+                body = self._join(data, addr)
+                if body is None:
+                    return
+            elif kind == KIND_MESSAGE:
+                body = data[1:]
+            else:
+                raise ValueError(f"unknown kind {kind}")
+            message = json.loads(body)
+        except (ValueError, IndexError, TypeError, struct.error) as e:
+            self.receive_errors += 1
+            log.warning("worker_bus_bad_datagram", worker=self.index, sender=addr, size=len(data), error=repr(e))
+            return
+        self.dispatch(message)
+
+    def _join(self, data, addr):
+        # Whole message body once its last chunk is in, otherwise None
+        _, number, index, count = CHUNK_HEADER.unpack_from(data)
+        chunk = data[CHUNK_HEADER.size:]
+        if index == 0:
+            if addr in self.partial:
+                self._lost_chunk(addr, self.partial[addr][0])
+            chunks = [chunk]
+            self.partial[addr] = (number, chunks)
+        else:
+            expected, chunks = self.partial.get(addr, (None, None))
+            if expected != number or len(chunks) != index:
+                self._lost_chunk(addr, number)
+                self.partial.pop(addr, None)
+                return None
+            chunks.append(chunk)
+        if len(chunks) < count:
+            return None
+        del self.partial[addr]
+        return b"".join(chunks)
+
+    def _lost_chunk(self, addr, number):
+        self.receive_errors += 1
+        log.warning("worker_bus_chunk_lost", worker=self.index, sender=addr, message=number)
+
+    def error_received(self, exc):
+        # A peer socket that is missing or full; the message is lost
+        self.send_errors += 1
+        log.warning("worker_bus_send_failed", worker=self.index, error=repr(exc))
+
+    def dispatch(self, message: Dict):
+        if message.get("op") == "node_down":
+            self.down.add(message["node"])
+            # With a cluster backplane the chat server learns of it from there
+            if "node_down" not in self.handlers:
+                self.messages_received += 1
+                return
+        super().dispatch(message)
+
+    def close(self):
+        if self.transport is not None:
+            self.publish({"op": "node_down", "node": self.index})
+            self.transport.close()
+            self.transport = None
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            "workers": self.count,
+            "packets_forwarded": self.packets_forwarded,
+            "send_errors": self.send_errors,
+            "chunked_sent": self.chunked_sent,
+            "receive_errors": self.receive_errors,
+            "workers_down": len(self.down),
+        })
+        return stats
+
+
+def announce_node_down(socket_dir, index, survivors):
+    # From the parent process, for a worker that exited without closing its bus
+    data = bytes([KIND_MESSAGE]) + json.dumps({"op": "node_down", "node": index}).encode('utf-8')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        for worker in survivors:
+            try:
+                sock.sendto(data, socket_path(socket_dir, worker))
+            except OSError as e:
+                log.warning("worker_bus_send_failed", worker=worker, error=repr(e))